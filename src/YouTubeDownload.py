@@ -13,6 +13,7 @@ from Screens.Screen import Screen
 from Tools.Downloader import downloadWithProgress
 
 from . import _, screenwidth
+from .throughput import throughput
 
 
 class YouTubeDirBrowser(Screen):
@@ -60,9 +61,11 @@ class DownloadTask(Task):
 		self.outputfile = outputfile
 		self.downloadStop = download_stop
 		self.totalSize = 0
+		self.currentSize = 0
 
 	def run(self, callback):
 		self.callback = callback
+		throughput.start_transfer()
 		self.download = downloadWithProgress(self.url, self.outputfile)
 		self.download.addProgress(self.downloadProgress)
 		self.download.start().addCallback(self.downloadFinished)\
@@ -71,8 +74,10 @@ class DownloadTask(Task):
 	def downloadProgress(self, currentbytes, totalbytes):
 		self.progress = int(currentbytes / float(totalbytes) * 100)
 		self.totalSize = totalbytes
+		self.currentSize = currentbytes
 
 	def downloadFinished(self, result):
+		throughput.end_transfer(self.totalSize)
 		Task.processFinished(self, 0)
 		self.downloadStop()
 		if '_suburi.mp4' in self.outputfile and \
@@ -96,6 +101,7 @@ class DownloadTask(Task):
 		if error_message == '' and failure_instance is not None:
 			error_message = failure_instance.getErrorMessage()
 			print('[YouTubeDownload] error', str(error_message))
+		throughput.end_transfer(self.currentSize)
 		Task.processFinished(self, 1)
 		self.downloadStop()
 
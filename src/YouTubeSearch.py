@@ -436,7 +436,11 @@ class GoogleSuggestionsConfigText(ConfigText):
 				charset = content_type.split('charset=', 1)[1]
 			else:
 				charset = 'ISO-8859-1'
-			suggestions_list = loads(response.read().decode(charset).encode('utf-8'))
+			suggestions_list = response.read()
+			# JSON can be loaded from utf-8 bytes, decode only other charsets
+			if charset.lower() not in ('utf-8', 'utf8'):
+				suggestions_list = suggestions_list.decode(charset)
+			suggestions_list = loads(suggestions_list)
 			response.close()
 		except Exception as e:
 			print('[YouTubeSearch] Error in get suggestions from google', e)
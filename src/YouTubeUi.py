@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import os
 from copy import copy
+from time import time
 
 from enigma import eServiceReference, eTimer, iPlayableService
 from Components.ActionMap import ActionMap
@@ -32,6 +33,7 @@ from Tools.LoadPixmap import LoadPixmap
 from Screens.Console import Console
 from .compat import compat_urlretrieve
 from .compat import SUBURI
+from .throughput import throughput
 
 from . import _, screenwidth
 from . import ngettext
@@ -101,6 +103,11 @@ config.plugins.YouTube.login = ConfigYesNo(default=False)
 config.plugins.YouTube.downloadDir = ConfigDirectory(default=resolveFilename(SCOPE_HDD))
 config.plugins.YouTube.useDashMP4 = ConfigYesNo(default=True)
 config.plugins.YouTube.mergeFiles = ConfigYesNo(default=False)
+config.plugins.YouTube.raceClients = ConfigYesNo(default=False)
+config.plugins.YouTube.adaptiveResolution = ConfigYesNo(default=False)
+config.plugins.YouTube.traceLog = ConfigYesNo(default=False)
+config.plugins.YouTube.transpileJS = ConfigYesNo(default=False)
+config.plugins.YouTube.jsWorker = ConfigYesNo(default=False)
 
 if DreamOS():
     config.plugins.YouTube.player = ConfigSelection(default='4097', choices=[
@@ -143,6 +150,7 @@ class YouTubePlayer(MoviePlayer):
 		self.current = current
 		ServiceEventTracker(screen=self, eventmap={
 				iPlayableService.evStart: self.__serviceStart,
+				iPlayableService.evBuffering: self.__serviceBuffering,
 				iPlayableService.evVideoSizeChanged: self.__serviceStart})  # On exteplayer evStart not working
 		self.servicelist = InfoBar.instance and InfoBar.instance.servicelist
 		self.started = False
@@ -155,6 +163,7 @@ class YouTubePlayer(MoviePlayer):
 				'showEventInfo': self.openCurEventView,
 			}, -1)
 		self.lastPosition = []
+		self.lastBuffering = 0
 
 	def __serviceStart(self):
 		if not self.started:
@@ -179,6 +188,13 @@ class YouTubePlayer(MoviePlayer):
 						self.session.openWithCallback(self.messageBoxCallback, MessageBox,
 								text=_('Resume playback from the previous position?'), timeout=5)
 
+	def __serviceBuffering(self):
+		# Buffering on start is normal, later it means that the connection is too slow.
+		# Buffering event is sent many times for every stall, so count it only once.
+		if self.started and time() - self.lastBuffering > 30 and not self.playbackFailed():
+			self.lastBuffering = time()
+			throughput.buffering()
+
 	def messageBoxCallback(self, answer):
 		if answer:
 			service = self.session.nav.getCurrentService()
@@ -214,7 +230,16 @@ class YouTubePlayer(MoviePlayer):
 			self.close(answer)
 
 	def doEofInternal(self, playing):
-		self.close([None, config.plugins.YouTube.onMovieEof.value])
+		self.close([None, config.plugins.YouTube.onMovieEof.value, self.playbackFailed()])
+
+	def playbackFailed(self):
+		# If end of file reached in the first seconds, video url is probably not working
+		service = self.session.nav.getCurrentService()
+		seek = service and service.seek()
+		if seek:
+			position = seek.getPlayPosition()
+			return position[0] != 0 or position[1] < 450000  # 5 seconds in pts
+		return True
 
 	def getPluginList(self):
 		plist = []
@@ -410,6 +435,11 @@ class YouTubeMain(Screen):
 			self.splitTaimer.timeout.callback.append(self.splitTaimerStop)
 		except:
 			self.splitTaimer_conn = self.splitTaimer.timeout.connect(self.splitTaimerStop)
+		self.prefetchTimer = eTimer()
+		try:
+			self.prefetchTimer.callback.append(self.prefetchVideoUrls)
+		except Exception:
+			self.prefetchTimer_conn = self.prefetchTimer.timeout.connect(self.prefetchVideoUrls)
 		self.active_downloads = 0
 		self.is_auth = False
 		self.picloads = {}
@@ -498,7 +528,10 @@ class YouTubeMain(Screen):
 			print('[YouTube] install update', e)
 
 	def cleanVariables(self):
+		self.prefetchTimer.stop()
+		self.ytdl.close()
 		del self.splitTaimer
+		del self.prefetchTimer
 		del self.picloads
 		del self.thumbnails
 		del self.ytapi
@@ -734,10 +767,23 @@ class YouTubeMain(Screen):
 			else:
 				self['list'].index = self['list'].count() - 1
 
+	def prefetchVideoUrls(self):
+		# Resolve in background the video urls which may be played when video ends
+		on_movie_eof = config.plugins.YouTube.onMovieEof.value
+		entry_list = self.yts[1]['entry_list']
+		index = self.yts[1]['index']
+		if on_movie_eof in ('playnext', 'ask') and index + 1 < len(entry_list):
+			self.ytdl.prefetch(entry_list[index + 1][0], self.ytapi.get_yt_auth())
+		if on_movie_eof in ('playprev', 'ask') and index > 0:
+			self.ytdl.prefetch(entry_list[index - 1][0], self.ytapi.get_yt_auth())
+
 	def playCallback(self, action=None):
+		self.prefetchTimer.stop()
 		self.yts.pop(0)
 		self.setEntryList()
 		if action:
+			if len(action) > 2 and action[2]:
+				self.ytdl.clear_url_cache(self['list'].getCurrent()[0])
 			action = action[1]
 			if action == 'quit':
 				pass  # No need to check anything else
@@ -795,20 +841,33 @@ class YouTubeMain(Screen):
 			self.search_result = config.plugins.YouTube.searchResult.value
 			self.screenCallback(search_value, 'search')
 
-	def useVideoUrl(self):
+	def retryVideoUrl(self, answer):
+		if answer:
+			self.useVideoUrl(True)
+		else:
+			self.yts.pop(0)
+			self.setEntryList()
+
+	def useVideoUrl(self, force=False):
 		current = self.yts[1]['entry_list'][self.yts[1]['index']]
 		video_id = current[0]
 		er = 'Video url not found!'
 		video_url = None
+		cached_error = False
 		try:
-			video_url = self.ytdl.extract(video_id, self.ytapi.get_yt_auth())
+			video_url = self.ytdl.extract(video_id, self.ytapi.get_yt_auth(), force)
 		except Exception as e:
 			er = e
+			cached_error = getattr(e, 'cached', False)
 			print('[YouTube] Error in extract info:', er)
 		if not video_url:
-			self.session.open(MessageBox,
-				_('There was an error in extract video url:\n%s\nVideo Id %s') % (er, str(video_id)),
-				MessageBox.TYPE_INFO, timeout=8)
+			msg = _('There was an error in extract video url:\n%s\nVideo Id %s') % (er, str(video_id))
+			if cached_error:
+				# Video was not playable a short time ago, let the user decide whether to try again
+				self.session.openWithCallback(self.retryVideoUrl, MessageBox,
+					msg + '\n' + _('Try again?'), MessageBox.TYPE_YESNO, default=False)
+				return
+			self.session.open(MessageBox, msg, MessageBox.TYPE_INFO, timeout=8)
 			self.yts.pop(0)
 			self.setEntryList()
 		else:
@@ -833,6 +892,8 @@ class YouTubeMain(Screen):
 				print('[YouTube] Play:', video_url)
 				self.session.openWithCallback(self.playCallback,
 					YouTubePlayer, service=service, current=current)
+				# Delay prefetch to not slow down the start of playback
+				self.prefetchTimer.start(10000, True)
 			else:
 				self.videoDownload(video_url, current)
 				self.yts.pop(0)
@@ -1195,6 +1256,8 @@ class YouTubeMain(Screen):
 		if len(self.yts) == 1:
 			self.close()
 		else:
+			if self.yts[0].get('list') == 'videolist':
+				self.ytdl.cancel_prefetch()
 			self.yts.pop(0)
 			if len(self.yts) == 1:
 				# Authentication can be changes in setup in another list,
@@ -1561,6 +1624,21 @@ class YouTubeSetup(ConfigListScreen, Screen):
 			self.list.append((_('Merge downloaded files:'),
 				config.plugins.YouTube.mergeFiles,
 				_('FFmpeg will be used to merge downloaded DASH video and audio files.\nFFmpeg will be installed if necessary.')))
+		self.list.append((_('Request all clients at once:'),
+			config.plugins.YouTube.raceClients,
+			_('Request video info from all YouTube clients at the same time and use the first usable answer.\nThe video can start faster, but more network traffic is used.')))
+		self.list.append((_('Adapt resolution to connection speed:'),
+			config.plugins.YouTube.adaptiveResolution,
+			_('Choose the highest video resolution which your connection speed allows to play without buffering.\nMaximum video resolution is still the upper limit.')))
+		self.list.append((_('Write video extraction log:'),
+			config.plugins.YouTube.traceLog,
+			_('Append details of every video info extraction to /tmp/youtube_trace.log.\nUse it to find out why video starts slowly.')))
+		self.list.append((_('Translate player code to Python:'),
+			config.plugins.YouTube.transpileJS,
+			_('Run signature decoding of the YouTube player as Python code translated from JavaScript.\nIt is faster, translated code is used only if it gives the same results as the JavaScript interpreter.')))
+		self.list.append((_('Decode signatures in a helper process:'),
+			config.plugins.YouTube.jsWorker,
+			_('Run signature decoding of the YouTube player in a separate process which uses another CPU core.\nThe user interface stays responsive, the process is started again if it fails.')))
 		self.list.append((_('Choose VirtualKeyBoard Style:'),
 			config.plugins.YouTube.VirtualKeyBoard,
 			_('You can choose what style of VirtualKeyBoard to use it.\nYouTube OR Image (VirtualKeyBoard).')))
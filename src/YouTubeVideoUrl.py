@@ -3,25 +3,43 @@
 
 from __future__ import print_function
 
+from collections import deque
+from collections import OrderedDict
+from re import compile
 from re import escape
 from re import findall
 from re import match
 from re import search
-from re import sub
 from json import dumps
 from json import loads
+from threading import Event
+from threading import local
+from threading import Lock
+from threading import Thread
+from time import time
 
 from Components.config import config
 
 from .compat import compat_parse_qs
+from .compat import compat_Empty
+from .compat import compat_Queue
 from .compat import compat_Request
 from .compat import compat_urlopen
 from .compat import compat_URLError
 from .compat import SUBURI
+from .cache import Cache
+from .jscompile import JSCompiler
+from .jstranspile import JSTranspiler
 from .jsinterp import JSInterpreter
+from .jsworker import fixup_n_function_code
+from .jsworker import JSDecodeError
+from .jsworker import JSWorker
+from .jsworker import PlayerDecoder
+from .jsworker import player_globals
+from .throughput import throughput
 
 
-IGNORE_VIDEO_FORMAT = (
+IGNORE_VIDEO_FORMAT = frozenset((
 	'43', '44', '45', '46',  # webm
 	'82', '83', '84', '85',  # 3D
 	'100', '101', '102',  # 3D
@@ -32,38 +50,228 @@ IGNORE_VIDEO_FORMAT = (
 	'394', '395', '396', '397', '398', '399', '400', '401', '402', '694', '695', '696', '697', '698', '699', '700', '701', '571',  # AV1
 	'249', '250', '251',  # webm
 	'302'  # webm
+))
+
+# Video itags grouped by resolution, the first itag in group is used in maxResolution setting
+VIDEO_FORMATS = (
+	(144, ('17', '91', '13', '151', '160', '269')),  # 176x144
+	(240, ('5', '36', '92', '132', '133', '229')),  # 400x240
+	(360, ('18', '93', '34', '6', '134', '230')),  # 640x360
+	(480, ('35', '59', '78', '94', '135', '212', '231')),  # 854x480
+	(720, ('22', '95', '300', '136', '298', '232')),  # 1280x720
+	(1080, ('37', '96', '301', '137', '299', '248', '303', '271', '270')),  # 1920x1080
+	(2160, ('38', '266', '264', '138', '313', '315', '272', '308'))  # 4096x3072
+)
+
+DASH_AUDIO_RANKS = {itag: rank for rank, itag in enumerate(('141', '140', '139', '258', '265', '325', '328', '233', '234'))}
+
+ITAG_HEIGHT = {itag: height for height, itags in VIDEO_FORMATS for itag in itags}
+
+HDR_TRANSFER = ('COLOR_TRANSFER_CHARACTERISTICS_SMPTEST2084', 'COLOR_TRANSFER_CHARACTERISTICS_ARIB_STD_B67')
+
+# Cached video url is used only if it is valid for at least this many seconds
+URL_EXPIRE_MARGIN = 1800
+
+# How many seconds extract waits for prefetch of the same video before it extracts the url itself
+PREFETCH_WAIT = 10
+
+# How many seconds wait for the clients answers when all clients are requested at once
+RACE_TIMEOUT = 20
+
+# Clients which can give a usable player response for each content class, in default order.
+# 'live' is web response or ios client, depending on DASH MP4 format setting.
+CONTENT_CLIENTS = {
+	'normal': (3, 7),
+	'live': (3, 'live'),
+	'age': (56, 85)
+}
+
+# How many seconds visitor data is reused before it is requested again
+VISITOR_DATA_TTL = 86400
+
+# Every this many extractions clients are tried in default order to recheck their scores
+EXPLORE_INTERVAL = 20
+
+# Weight of the latest outcome in the client scores moving averages
+SCORE_WEIGHT = 0.3
+
+# How many seconds player id from iframe api is reused
+PLAYER_ID_TTL = 600
+
+# Player profile format version, profiles cached in other format are analyzed again
+PLAYER_PROFILE_VERSION = 4
+
+# How many seconds cached player profiles are kept
+PLAYER_PROFILE_TTL = 30 * 86400
+
+# How many decoded nsig values are kept, the oldest are dropped first
+NSIG_CACHE_SIZE = 64
+
+# Larger player profiles are not cached, the cache directory is in RAM
+PLAYER_PROFILE_MAX_CODE = 256 * 1024
+
+# Test values decoded with the whole player and the profile code to check the profile
+PLAYER_TEST_SIG = ''.join(chr(ord('A') + x % 26) + str(x % 10) for x in range(54))
+PLAYER_TEST_NSIG = 'ABCDEFGHabcdefgh0123'
+PLAYER_TESTS = (('sig', PLAYER_TEST_SIG), ('nsig', PLAYER_TEST_NSIG))
+
+# Names in the decode functions which are not searched from the player code
+JS_BUILTINS = frozenset((
+	'Array', 'Date', 'Infinity', 'JSON', 'Math', 'NaN', 'Number', 'Object', 'RegExp', 'String',
+	'break', 'case', 'catch', 'const', 'continue', 'decodeURIComponent', 'default', 'delete', 'do', 'else',
+	'encodeURIComponent', 'false', 'finally', 'for', 'function', 'if', 'in', 'instanceof', 'isNaN', 'let',
+	'new', 'null', 'parseFloat', 'parseInt', 'return', 'switch', 'this', 'throw', 'true', 'try',
+	'typeof', 'undefined', 'var', 'void', 'while'
+))
+
+JS_STRING = compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+
+JS_NAME = compile(r'(?<![\w$.])[a-zA-Z_$][\w$]*')
+
+# Assigned names and function arguments are taken as local names
+JS_LOCALS = compile(r'(?<![\w$.])([a-zA-Z_$][\w$]*)\s*=(?!=)|\b(?:function\s*[\w$]*|catch\s*)\(([^)]*)\)')
+
+# How many seconds video which was not playable fails without trying again
+UNPLAYABLE_TTL = 3600
+
+# Playability statuses of private, removed or blocked videos, other statuses like
+# LIVE_STREAM_OFFLINE can change soon and are not cached
+UNPLAYABLE_STATUSES = ('ERROR', 'UNPLAYABLE', 'LOGIN_REQUIRED')
+
+# How many extraction traces are kept in memory
+TRACE_COUNT = 20
+
+TRACE_LOG = '/tmp/youtube_trace.log'
+
+WATCH_URL = 'https://www.youtube.com/watch?v=%s&bpctr=9999999999&has_verified=1'
+
+# JSON objects searched in the watch page, ytcfg is used only if it has innertube context
+WATCH_PAGE_JSON = (
+	('ytcfg', compile(br'ytcfg\.set\s*\(\s*(?={)')),
+	('player_response', compile(br'ytInitialPlayerResponse\s*=\s*(?={)'))
 )
 
-PRIORITY_VIDEO_FORMAT = ()
+M3U8_ATTRIBUTES = compile(r'(?P<key>[A-Z0-9-]+)=(?P<val>"[^"]+"|[^",]+)(?:,|$)')
+
+JSON_TOKEN = compile(br'"(?:[^"\\]+|\\.)*"|"|[{}]')
+
+WATCH_PAGE_CHUNK = 16384
 
 
-def create_priority_formats():
-	global PRIORITY_VIDEO_FORMAT
-	itag = config.plugins.YouTube.maxResolution.value
-	video_formats = (
-		('17', '91', '13', '151', '160', '269'),  # 176x144
-		('5', '36', '92', '132', '133', '229'),  # 400x240
-		('18', '93', '34', '6', '134', '230'),  # 640x360
-		('35', '59', '78', '94', '135', '212', '231'),  # 854x480
-		('22', '95', '300', '136', '298', '232'),  # 1280x720
-		('37', '96', '301', '137', '299', '248', '303', '271', '270'),  # 1920x1080
-		('38', '266', '264', '138', '313', '315', '272', '308')  # 4096x3072
-	)
-	for video_format in video_formats:
-		PRIORITY_VIDEO_FORMAT = video_format + PRIORITY_VIDEO_FORMAT
-		if video_format[0] == itag:
-			break
+class UnplayableError(RuntimeError):
+	""" Video is private, removed, blocked or needs login, cached is True if error is from cache """
+
+	def __init__(self, reason, cached=False):
+		RuntimeError.__init__(self, reason)
+		self.cached = cached
+
+
+_video_ranks = {}
+
+
+def video_ranks(max_itag):
+	"""
+	Return itag to rank dict and resolution to rank dict for formats up to max itag resolution.
+	Higher resolution has lower rank, not listed itags are ranked after known itags of same resolution.
+	"""
+	if max_itag not in _video_ranks:
+		itag_ranks = {}
+		height_ranks = {}
+		groups = []
+		for height, itags in VIDEO_FORMATS:
+			groups.insert(0, (height, itags))
+			if itags[0] == max_itag:
+				break
+		for height, itags in groups:
+			for itag in itags:
+				itag_ranks[itag] = len(itag_ranks) + len(height_ranks)
+			height_ranks[height] = len(itag_ranks) + len(height_ranks)
+		_video_ranks[max_itag] = (itag_ranks, height_ranks)
+	return _video_ranks[max_itag]
+
+
+class FormatPolicy():
+	"""
+	Video format ranking policy, use YouTubeVideoUrl.format_policy to replace it.
+	codecs - allowed codecs prefixes, e.g. ('avc1', 'mp4a'), empty allows all
+	max_fps, max_bitrate - upper limits, unknown values are not limited
+	hdr - allow HDR formats
+	"""
+
+	def __init__(self, codecs=(), max_fps=None, max_bitrate=None, hdr=False):
+		self.codecs = codecs
+		self.max_fps = max_fps
+		self.max_bitrate = max_bitrate
+		self.hdr = hdr
+
+	@staticmethod
+	def height(fmt):
+		""" Resolution is the short side, so vertical video have the same resolution as landscape """
+		if fmt.get('width') and fmt.get('height'):
+			return min(fmt['width'], fmt['height'])
+		return fmt.get('height')
 
+	def allowed(self, fmt):
+		mime_type = fmt.get('mimeType', '')
+		if self.codecs and not any(('"%s' % codec in mime_type or ' %s' % codec in mime_type) for codec in self.codecs):
+			return False
+		if self.max_fps and fmt.get('fps', 0) > self.max_fps:
+			return False
+		if self.max_bitrate and int(fmt.get('bitrate', 0)) > self.max_bitrate:
+			return False
+		if not self.hdr and (
+				'HDR' in fmt.get('qualityLabel', '') or
+				fmt.get('colorInfo', {}).get('transferCharacteristics') in HDR_TRANSFER):
+			return False
+		return True
 
-create_priority_formats()
+	def rank(self, fmt, itag, ranks):
+		""" Return format rank, lower is better, or None if format should not be used """
+		itag_ranks, height_ranks = ranks
+		if not self.allowed(fmt):
+			return None
+		if itag in itag_ranks:
+			return itag_ranks[itag]
+		if itag in ITAG_HEIGHT:
+			return None  # Higher than max resolution
+		if 'video/mp4' not in fmt.get('mimeType', '').lower():
+			return None
+		height = self.height(fmt)
+		if height:
+			# Use the nearest listed resolution which is not lower than format height
+			for listed_height in sorted(height_ranks):
+				if height <= listed_height:
+					return height_ranks[listed_height]
+			return None
+		return len(itag_ranks) + len(height_ranks)
 
 
 class YouTubeVideoUrl():
-	def __init__(self):
+	def __init__(self, cache=None):
 		self.use_dash_mp4 = ()
-		self._code_cache = {}
+		self.format_policy = FormatPolicy()
+		self._decoders = {}
 		self._player_cache = {}
-		self.nsig_cache = (None, None)
+		self._player_lock = Lock()
+		# Lock for each player id, analysis of a new player does not block other players
+		self._player_locks = {}
+		self._player_id = (None, 0)
+		self._player_id_lock = Lock()
+		self._code_lock = Lock()
+		self._worker = JSWorker()
+		self._nsig_cache = OrderedDict()
+		self._nsig_lock = Lock()
+		self._m3u8_cache = {}
+		self._prefetch = {}
+		self._local = local()
+		self.traces = deque(maxlen=TRACE_COUNT)
+		self.cache = cache or Cache()
+		self._prune_cache()
+		self._visitor = self.cache.load('clients', 'visitor', {})
+		self._scores_lock = Lock()
+		self._scores = self.cache.load('clients', 'scores', {})
+		if self._scores:
+			print('[YouTubeVideoUrl] Client scores\n%s' % self.client_scores())
 
 	@staticmethod
 	def try_get(src, getter):
@@ -74,6 +282,17 @@ class YouTubeVideoUrl():
 				return None
 		return src
 
+	def _trace(self, key, value):
+		""" Add value to the trace of the extraction running in this thread """
+		trace = getattr(self._local, 'trace', None)
+		if trace is not None:
+			if isinstance(trace.get(key), list):
+				trace[key].append(value)
+			elif isinstance(trace.get(key), float):
+				trace[key] += value
+			else:
+				trace[key] = value
+
 	@staticmethod
 	def _guess_encoding_from_content(content_type, webpage_bytes):
 		m = match(r'[a-zA-Z0-9_.-]+/[a-zA-Z0-9_.-]+\s*;\s*charset=(.+)', content_type)
@@ -90,9 +309,10 @@ class YouTubeVideoUrl():
 
 		return encoding
 
-	def _download_webpage(self, url, data=None, headers={}):
-		""" Return the data of the page as a string """
-
+	def _open_url(self, url, data=None, headers={}):
+		cancel = getattr(self._local, 'cancel', None)
+		if cancel and cancel.is_set():
+			raise RuntimeError('Prefetch cancelled')
 		if data:
 			data = dumps(data).encode('utf8')
 		if data or headers:
@@ -103,9 +323,15 @@ class YouTubeVideoUrl():
 			urlh = compat_urlopen(url, timeout=5)
 		except compat_URLError as e:  # pragma: no cover
 			raise RuntimeError(e.reason)
+		return urlh
 
+	def _download_webpage(self, url, data=None, headers={}, decode=True):
+		""" Return the data of the page as a string, or bytes without decode, e.g. for JSON """
+		urlh = self._open_url(url, data, headers)
 		content_type = urlh.headers.get('Content-Type', '')
 		webpage_bytes = urlh.read()
+		if not decode:
+			return webpage_bytes
 		encoding = self._guess_encoding_from_content(content_type, webpage_bytes)
 
 		try:
@@ -155,43 +381,232 @@ class YouTubeVideoUrl():
 				return real_nfunc.group(1)[1:-1]
 
 	def _extract_player_info(self):
-		res = self._download_webpage('https://www.youtube.com/iframe_api')
-		if res:
-			player_id = search(r'player\\?/([0-9a-fA-F]{8})\\?/', res)
-			if player_id:
-				return player_id.group(1)
+		with self._player_id_lock:  # Ask player id only once for all threads
+			if self._player_id[1] > time() - PLAYER_ID_TTL:
+				return self._player_id[0]
+			res = self._download_webpage('https://www.youtube.com/iframe_api')
+			if res:
+				player_id = search(r'player\\?/([0-9a-fA-F]{8})\\?/', res)
+				if player_id:
+					self._player_id = (player_id.group(1), time())
+					return player_id.group(1)
 		print('[YouTubeVideoUrl] Cannot get player info')
 
 	def _load_player(self, player_id):
-		if player_id and player_id not in self._player_cache:
-			self._player_cache[player_id] = self._download_webpage(
-				'https://www.youtube.com/s/player/%s/player_ias.vflset/en_US/base.js' % player_id
-			)
+		""" Return the player profile, base.js is downloaded and analyzed only for a new player """
+		if not player_id:
+			raise RuntimeError('Player id not found')
+		with self._player_lock:
+			lock = self._player_locks.setdefault(player_id, Lock())
+		with lock:  # Download the player only once if called from several threads
+			profile = self._player_cache.get(player_id)
+			if profile:
+				self._trace('player_cache', 'hit')
+			else:
+				profile = self.cache.load('players', player_id)
+				if profile and profile.get('version') == PLAYER_PROFILE_VERSION:
+					self._trace('player_cache', 'disk')
+					# Executable code is not taken from the cache directory, older versions stored it
+					profile.pop('python', None)
+				else:
+					self._trace('player_cache', 'miss')
+					profile = self._analyze_player(self._download_webpage(
+						'https://www.youtube.com/s/player/%s/player_ias.vflset/en_US/base.js' % player_id
+					))
+					if len(profile['code']) <= PLAYER_PROFILE_MAX_CODE:
+						self.cache.store('players', player_id, profile)
+				self._player_cache[player_id] = profile
+			if config.plugins.YouTube.transpileJS.value and 'python' not in profile:
+				self._translate_player(player_id, profile)
+			return profile
+
+	def _translate_player(self, player_id, profile):
+		""" Add decode functions translated to Python to the profile, only when the option is used.
+		They are executed, so they are kept only in memory and translated again after restart """
+		start = time()
+		# Profile code was checked with the whole player, so the interpreter with it is the reference
+		profile['python'] = self._transpile_profile(profile, {key: None for key, _ in PLAYER_TESTS if profile[key]})
+		print('[YouTubeVideoUrl] Player %s translated in %.2f s' % (player_id, time() - start))
+
+	def _analyze_player(self, jscode):
+		""" Search base.js once for everything later steps need and return it as a compact player profile """
+		start = time()
+		profile = {
+			'version': PLAYER_PROFILE_VERSION,
+			'time': int(start),
+			'sts': None,
+			'sig': None,
+			'nsig': None
+		}
+		for key, find in (
+				('sts', lambda: search(r'(?:signatureTimestamp|sts)\s*:\s*(?P<sts>\d{5})', jscode).group('sts')),
+				('sig', lambda: self._parse_sig_js(jscode)),
+				('nsig', lambda: self._extract_n_function_name(jscode))):
+			try:
+				profile[key] = find()
+			except Exception as ex:
+				print('[YouTubeVideoUrl] Player analysis did not find', key, ex)
+		jsi = JSInterpreter(jscode)
+		profile['code'], profile['globals'] = self._player_definitions(jsi, (profile['sig'], profile['nsig']))
+		profile['symbols'] = JSInterpreter.build_symbol_index(profile['code'])
+		expected = self._player_tests(jsi, profile)
+		if not self._check_profile(profile, expected):
+			print('[YouTubeVideoUrl] Player profile is not complete, use the whole player code')
+			profile['code'], profile['symbols'] = jscode, jsi.symbol_index()
+		print('[YouTubeVideoUrl] Player analyzed in %.2f s, %d of %d bytes of code used' % (
+			time() - start, len(profile['code']), len(jscode)))
+		return profile
 
 	@staticmethod
-	def _fixup_n_function_code(argnames, code):
-		return argnames, sub(
-			r';\s*if\s*\(\s*typeof\s+[a-zA-Z0-9_$]+\s*===?\s*(["\'])undefined\1\s*\)\s*return\s+%s;' % argnames[0],
-			';', code)
+	def _player_definitions(jsi, names):
+		"""
+		Return source of the named functions and objects with all player functions and objects they use,
+		and the global variables they use as (name, expression) list in evaluation order.
+		"""
+		code = []
+		global_vars = []
+		found = set()
+		names = [name for name in names if name]
+		while names:
+			name = names.pop()
+			if name in found or name in JS_BUILTINS:
+				continue
+			found.add(name)
+			argnames = []
+			try:
+				argnames, body = jsi.extract_function_code(name)
+			except RuntimeError:
+				try:
+					body = jsi.extract_variable_code(name)
+				except RuntimeError:
+					continue
+				if body.startswith('{'):
+					code.append('var %s=%s;' % (name, body))
+				else:
+					global_vars.append([name, body])
+			else:
+				code.append('function %s(%s){%s}' % (name, ','.join(argnames), body))
+			local_names = set(argnames)
+			for var, args in JS_LOCALS.findall(body):
+				local_names.add(var)
+				local_names.update(arg.strip() for arg in args.split(','))
+			names.extend(n for n in JS_NAME.findall(JS_STRING.sub('""', body)) if n not in local_names)
+		# Variables are found after the code which uses them
+		return '\n'.join(code), global_vars[::-1]
+
+	_player_globals = staticmethod(player_globals)
+
+	def _player_tests(self, jsi, profile):
+		""" Decode test values with the whole player, None if the whole player does not work either """
+		expected = {}
+		for key, test in PLAYER_TESTS:
+			if profile[key]:
+				try:
+					expected[key] = jsi.extract_function_from_code(
+						*self._fixup_n_function_code(*jsi.extract_function_code(profile[key])))([test])
+				except Exception:
+					expected[key] = None
+		return expected
+
+	def _check_profile(self, profile, expected):
+		""" Decode test values with the profile code, results must be the same as with the whole player """
+		global_vars = self._player_globals(profile)
+		compact = JSCompiler(profile['code'], symbols=profile['symbols'], constants=global_vars)
+		for key, test in PLAYER_TESTS:
+			if key not in expected:
+				continue
+			try:
+				got = compact.extract_function_from_code(
+					*self._fixup_n_function_code(*compact.extract_function_code(profile[key])) + (global_vars, ))([test])
+			except Exception as ex:
+				print('[YouTubeVideoUrl] Profile %s function failed' % key, ex)
+				return False
+			# Profile is checked only if the whole player works
+			if expected[key] is not None and got != expected[key]:
+				return False
+		return True
+
+	def _transpile_profile(self, profile, expected):
+		""" Return decode functions translated to Python source, only if they decode test values like the interpreter """
+		python = {}
+		global_vars = self._player_globals(profile)
+		jsi = JSTranspiler(profile['code'], symbols=profile['symbols'], constants=global_vars)
+		for key, test in PLAYER_TESTS:
+			if key not in expected:
+				continue
+			try:
+				code = self._fixup_n_function_code(*jsi.extract_function_code(profile[key]))
+				reference = expected[key]
+				if reference is None:
+					# Whole player does not work, check with the interpreter and the profile variables
+					reference = JSInterpreter(profile['code'], symbols=profile['symbols']).extract_function_from_code(*code + (global_vars, ))([test])
+				source = jsi.transpile(*code)
+				got = jsi.load(source, global_vars)([test])
+			except Exception as ex:
+				print('[YouTubeVideoUrl] Cannot translate %s function' % key, ex)
+				continue
+			if got == reference:
+				python[key] = source
+			else:
+				print('[YouTubeVideoUrl] Translated %s function gives wrong result' % key)
+		return python
+
+	_fixup_n_function_code = staticmethod(fixup_n_function_code)
 
 	def _extract_function(self, player_id, s_id):
-		if player_id not in self._player_cache:
-			self._load_player(player_id)
-		jsi = JSInterpreter(self._player_cache[player_id])
-		if s_id not in self._code_cache:
-			if s_id.startswith('nsig_'):
-				funcname = self._extract_n_function_name(self._player_cache[player_id])
+		profile = self._load_player(player_id)
+		key = 'nsig' if s_id.startswith('nsig_') else 'sig'
+		if config.plugins.YouTube.jsWorker.value and self._worker.available:
+			func = self._worker_function(player_id, profile, key, s_id)
+		else:
+			func = self._decoder_function(player_id, profile, key, s_id)
+
+		def run(s):
+			start = time()
+			try:
+				return func(s)
+			finally:
+				self._trace('js_run_time', time() - start)
+		return run
+
+	def _decoder_function(self, player_id, profile, key, s_id):
+		""" Return decode function which runs in this process """
+		with self._code_lock:  # Decode functions are built once per player
+			decoder = self._decoders.get(player_id)
+			if decoder is None:
+				decoder = self._decoders[player_id] = PlayerDecoder(profile)
+			built = len(decoder.functions)
+			start = time()
+			func = decoder.function(key, config.plugins.YouTube.transpileJS.value)
+			if len(decoder.functions) > built:
+				self._trace('code_cache', '%s miss' % s_id)
+				self._trace('js_parse_time', time() - start)
 			else:
-				funcname = self._parse_sig_js(self._player_cache[player_id])
-			self._code_cache[s_id] = self._fixup_n_function_code(*jsi.extract_function_code(funcname))
-		return lambda s: jsi.extract_function_from_code(*self._code_cache[s_id])([s])
+				self._trace('code_cache', '%s hit' % s_id)
+		return lambda s: func([s])
+
+	def _worker_function(self, player_id, profile, key, s_id):
+		""" Return decode function which runs in the helper process, or in this process if the helper fails """
+		transpile = config.plugins.YouTube.transpileJS.value
+
+		def decode(s):
+			try:
+				return self._worker.decode(player_id, profile, key, s, transpile)
+			except JSDecodeError:
+				raise  # Same function would fail in this process too
+			except RuntimeError as ex:
+				print('[YouTubeVideoUrl] Helper process failed, decode in this process', ex)
+				return self._decoder_function(player_id, profile, key, s_id)(s)
+		return decode
 
 	def _unthrottle_url(self, url, player_id):
 		n_param = search(r'&n=(.+?)&', url).group(1)
 		n_id = 'nsig_%s_%s' % (player_id, '.'.join(str(len(p)) for p in n_param.split('.')))
-		if self.nsig_cache[0] != n_param:
+		key = (player_id, n_param)
+		ret = self._nsig_cache.get(key)
+		self._trace('nsig_cache', 'hit' if ret else 'miss')
+		if not ret:
 			print('[YouTubeVideoUrl] Decrypt nsig', n_id)
-			self.nsig_cache = (None, None)
 			try:
 				ret = self._extract_function(player_id, n_id)(n_param)
 			except Exception as ex:
@@ -199,13 +614,16 @@ class YouTubeVideoUrl():
 			else:
 				if ret.startswith('enhanced_except_') or ret.endswith(n_param):
 					print('[YouTubeVideoUrl] Unhandled exception in decode', ret)
+					ret = None
 				else:
-					self.nsig_cache = (n_param, ret)
-		if self.nsig_cache[1]:
-			print('[YouTubeVideoUrl] Decrypted nsig %s => %s' % self.nsig_cache)
-			return url.replace(self.nsig_cache[0], self.nsig_cache[1])
-		if n_id in self._code_cache:
-			del self._code_cache[n_id]
+					with self._nsig_lock:
+						self._nsig_cache[key] = ret
+						while len(self._nsig_cache) > NSIG_CACHE_SIZE:
+							self._nsig_cache.popitem(last=False)
+		if ret:
+			print('[YouTubeVideoUrl] Decrypted nsig %s => %s' % (n_param, ret))
+			return url.replace(n_param, ret)
+		self._decoders.pop(player_id, None)
 		return url
 
 	def _decrypt_signature_url(self, sc, player_id):
@@ -217,8 +635,7 @@ class YouTubeVideoUrl():
 			sig = self._extract_function(player_id, s_id)(s)
 		except Exception as ex:
 			print('[YouTubeVideoUrl] Signature extraction failed', ex)
-			if s_id in self._code_cache:
-				del self._code_cache[s_id]
+			self._decoders.pop(player_id, None)
 		else:
 			return '%s&%s=%s' % (sc['url'][0], sc['sp'][0] if 'sp' in sc else 'signature', sig)
 
@@ -251,43 +668,72 @@ class YouTubeVideoUrl():
 
 	@staticmethod
 	def _parse_m3u8_attributes(attrib):
-		return {key: val[1:-1] if val.startswith('"') else val for (key, val) in findall(r'(?P<key>[A-Z0-9-]+)=(?P<val>"[^"]+"|[^",]+)(?:,|$)', attrib)}
+		return {key: val[1:-1] if val.startswith('"') else val for (key, val) in M3U8_ATTRIBUTES.findall(attrib)}
 
-	def _get_m3u8_audio_urls(self, manifest):
+	def _parse_m3u8(self, manifest):
+		""" Return variant streams of the master playlist as format dicts, in one pass over lines """
 		audio_urls = {}
-		if '#EXT-X-MEDIA:' in manifest:
-			for line in manifest.splitlines():
-				if line.startswith('#EXT-X-MEDIA:'):
-					audio_info = self._parse_m3u8_attributes(line)
-					audio_urls[audio_info.get('GROUP-ID')] = audio_info.get('URI')
-		return audio_urls
+		variants = []
+		stream_info = None
+		for line in manifest.splitlines():
+			if line.startswith('#EXT-X-STREAM-INF:'):
+				stream_info = self._parse_m3u8_attributes(line[18:])
+			elif line.startswith('#EXT-X-MEDIA:'):
+				media = self._parse_m3u8_attributes(line[13:])
+				if media.get('URI'):
+					audio_urls[media.get('GROUP-ID')] = media['URI']
+			elif stream_info is not None and line.startswith('https'):
+				itag = search(r'/sgovp/[^/]+itag%3D(\d+?)/', line) or search(r'/itag/(\d+?)/', line)
+				resolution = stream_info.get('RESOLUTION', 'x').split('x')
+				variants.append({
+					'url': line,
+					'itag': itag.group(1) if itag else '',
+					'bitrate': int(stream_info.get('BANDWIDTH', 0)),
+					'width': int(resolution[0] or 0),
+					'height': int(resolution[1] or 0),
+					'fps': float(stream_info.get('FRAME-RATE', 0)),
+					'mimeType': 'video/mp4; codecs="%s"' % stream_info.get('CODECS', ''),
+					'audio': stream_info.get('AUDIO')
+				})
+				stream_info = None
+		# Audio is added after all lines are read, media can be listed after variants
+		for variant in variants:
+			audio_url = audio_urls.get(variant.pop('audio'))
+			if audio_url:
+				variant['url'] += SUBURI + audio_url
+		return variants
 
-	@staticmethod
-	def _url_map_append(url_map, itag, url):
-		if itag not in IGNORE_VIDEO_FORMAT:
-			url_map.append({
-				'url': url,
-				'preference': PRIORITY_VIDEO_FORMAT.index(itag) if itag in PRIORITY_VIDEO_FORMAT else 100
-			})
+	def _sort_m3u8(self, variants):
+		""" Sort variants by resolution and bandwidth, skip not allowed by format policy """
+		max_height = ITAG_HEIGHT.get(config.plugins.YouTube.maxResolution.value, 2160)
+		variants = sorted((
+			variant for variant in variants
+			if variant['itag'] not in IGNORE_VIDEO_FORMAT and
+			(FormatPolicy.height(variant) or 0) <= max_height and
+			self.format_policy.allowed(variant)
+		), key=lambda k: (FormatPolicy.height(k) or 0, k['bitrate']), reverse=True)
+		if config.plugins.YouTube.adaptiveResolution.value:
+			variants = self._fit_throughput(variants, None, probe=False)
+		return variants
 
-	def _extract_from_m3u8(self, manifest_url):
-		url_map = []
-		audio_url = ''
+	def _extract_from_m3u8(self, manifest_url, video_id, yt_auth):
+		"""
+		Parsed manifests are kept per video until they expire, so live stream can be reopened at once.
+		Manifest url changes with every player response, so it cannot be the key.
+		"""
+		key = (video_id, bool(yt_auth))
+		cached = self._m3u8_cache.get(key)
+		if cached and cached[0] > time() + URL_EXPIRE_MARGIN:
+			print('[YouTubeVideoUrl] Use cached manifest')
+			return self._sort_m3u8(cached[1])
 
-		manifest = self._download_webpage(manifest_url)
-		audio_urls = self._get_m3u8_audio_urls(manifest)
-
-		for line in manifest.splitlines():
-			if audio_urls and line.startswith('#EXT-X-STREAM-INF:'):
-				audio_id = self._parse_m3u8_attributes(line).get('AUDIO')
-				if audio_id and audio_id in audio_urls:
-					audio_url = SUBURI + audio_urls.get(audio_id)
-			elif line.startswith('https'):
-				itag = search(r'/sgovp/[^/]+itag%3D(\d+?)/', line) or search(r'/itag/(\d+?)/', line)
-				if itag:
-					self._url_map_append(url_map, itag.group(1), line + audio_url)
-					audio_url = ''
-		return sorted(url_map, key=lambda k: k['preference'])
+		variants = self._parse_m3u8(self._download_webpage(manifest_url))
+		expire = self._url_expire(manifest_url)
+		if expire:
+			for old in [old for old, (e, _) in self._m3u8_cache.items() if e <= time()]:
+				del self._m3u8_cache[old]
+			self._m3u8_cache[key] = (expire, variants)
+		return self._sort_m3u8(variants)
 
 	def _skip_fmt(self, fmt, itag):
 		return (
@@ -308,38 +754,53 @@ class YouTubeVideoUrl():
 			return url
 
 	@staticmethod
-	def _video_pref(fmt, prefer):
-		if prefer == 100:
-			prefer = 20 if 'video/mp4' in fmt.get('mimeType').lower() else 200
-		return prefer
-
-	@staticmethod
-	def _audio_pref(fmt, prefer, get_audio):
+	def _audio_pref(fmt, itag, get_audio):
+		prefer = DASH_AUDIO_RANKS.get(itag, 100)
 		audio_track = fmt.get('audioTrack', {})
 		if get_audio == '' and 'original' in audio_track.get('displayName', '').lower():
 			prefer -= 40
 		if audio_track.get('audioIsDefault'):
 			prefer -= 20
 		if prefer == 100:
-			prefer = 20 if 'audio/mp4' in fmt.get('mimeType').lower() else 200
+			return 20 if 'audio/mp4' in fmt.get('mimeType').lower() else None
 		return prefer
 
-	def _sort_formats(self, priority_formats, streaming_formats, get_audio=None):
+	def _sort_formats(self, streaming_formats, get_audio=None):
+		""" Return usable video or audio formats sorted by preference """
+		ranks = video_ranks(config.plugins.YouTube.maxResolution.value)
 		sorted_fmt = []
 		for fmt in streaming_formats:
 			itag = str(fmt.get('itag', ''))
 			if self._skip_fmt(fmt, itag):
 				continue
-			prefer = priority_formats.index(itag) if itag in priority_formats else 100
-			prefer = self._video_pref(fmt, prefer) if get_audio is None else self._audio_pref(fmt, prefer, get_audio)
-			if prefer < 200:
-				fmt['preference'] = prefer
-				sorted_fmt.append(fmt)
-		return sorted(sorted_fmt, key=lambda k: k['preference'])
+			if get_audio is None:
+				prefer = self.format_policy.rank(fmt, itag, ranks)
+			else:
+				prefer = self._audio_pref(fmt, itag, get_audio)
+			if prefer is not None:
+				sorted_fmt.append((prefer, len(sorted_fmt), fmt))
+		return [fmt for _, _, fmt in sorted(sorted_fmt, key=lambda k: k[:2])]
+
+	def _fit_throughput(self, formats, player_id, probe=True):
+		""" Move formats with too high bitrate for the estimated throughput to the end, lowest first """
+		if probe and formats and throughput.stale():
+			url = self._extract_url(formats[0], player_id)
+			if url:
+				throughput.probe(url)
+		max_bitrate = throughput.max_bitrate()
+		if not max_bitrate:
+			return formats
+		fitting = [fmt for fmt in formats if int(fmt.get('bitrate', 0)) <= max_bitrate]
+		too_high = [fmt for fmt in formats if int(fmt.get('bitrate', 0)) > max_bitrate]
+		print('[YouTubeVideoUrl] Max bitrate %d, %d formats are too high' % (max_bitrate, len(too_high)))
+		return fitting + too_high[::-1]
 
 	def _extract_fmt_video_format(self, streaming_formats, player_id):
 		print('[YouTubeVideoUrl] Try fmt url')
-		for fmt in self._sort_formats(PRIORITY_VIDEO_FORMAT, streaming_formats):
+		formats = self._sort_formats(streaming_formats)
+		if config.plugins.YouTube.adaptiveResolution.value:
+			formats = self._fit_throughput(formats, player_id)
+		for fmt in formats:
 			url = self._extract_url(fmt, player_id)
 			if url:
 				print('[YouTubeVideoUrl] Found fmt url')
@@ -349,8 +810,7 @@ class YouTubeVideoUrl():
 	def _extract_dash_audio_format(self, streaming_formats, player_id, lang):
 		""" If DASH MP4 video add also DASH MP4 audio track"""
 		print('[YouTubeVideoUrl] Try fmt audio url')
-		DASH_AUDIO_FORMATS = ('141', '140', '139', '258', '265', '325', '328', '233', '234')
-		for fmt in self._sort_formats(DASH_AUDIO_FORMATS, streaming_formats, lang):
+		for fmt in self._sort_formats(streaming_formats, lang):
 			url = self._extract_url(fmt, player_id)
 			if url:
 				print('[YouTubeVideoUrl] Found fmt audio url')
@@ -361,34 +821,84 @@ class YouTubeVideoUrl():
 		sts = None
 		player_id = self._extract_player_info()
 		if player_id:
-			if player_id not in self._player_cache:
-				self._load_player(player_id)
-			sts = search(
-				r'(?:signatureTimestamp|sts)\s*:\s*(?P<sts>\d{5})',
-				self._player_cache[player_id]
-			).group('sts')
+			sts = self._load_player(player_id)['sts']
 		return sts, player_id
 
+	def _scan_watch_page(self, video_id):
+		"""
+		Read the watch page in chunks and return the ytcfg and ytInitialPlayerResponse JSON bytes.
+		Reading stops as soon as both are found, the rest of the page is not downloaded.
+		"""
+		urlh = self._open_url(WATCH_URL % video_id)
+		found = {}
+		data = bytearray()  # Extended in place, without copying all read data for every chunk
+		pos = 0
+		name = None
+		try:
+			while len(found) < len(WATCH_PAGE_JSON):
+				chunk = urlh.read(WATCH_PAGE_CHUNK)
+				if not chunk:
+					break
+				data.extend(chunk)
+				while len(found) < len(WATCH_PAGE_JSON):
+					if not name:
+						matches = []
+						for json_name, marker in WATCH_PAGE_JSON:
+							m = json_name not in found and marker.search(data, pos)
+							if m:
+								matches.append((m.end(), json_name))
+						if not matches:
+							# Keep only the end where marker can begin in the next chunk
+							data = data[-64:]
+							pos = 0
+							break
+						start, name = min(matches)
+						pos = start
+						depth = 0
+					# Skip strings in one step, braces in them do not count
+					for m in JSON_TOKEN.finditer(data, pos):
+						token = m.group()
+						if token == b'"':
+							pos = m.start()  # String continues in the next chunk
+							break
+						pos = m.end()
+						if token == b'{':
+							depth += 1
+						elif token == b'}':
+							depth -= 1
+							if depth == 0:
+								if name != 'ytcfg' or b'"INNERTUBE_CONTEXT"' in data[start:pos]:
+									found[name] = bytes(data[start:pos])  # JSON is loaded from bytes
+								name = None
+								break
+					else:
+						pos = len(data)
+					if name:
+						break  # JSON continues in the next chunk
+		finally:
+			urlh.close()
+		return found
+
 	def _extract_visitor_id(self, webpage):
-		ytcfg = search(r'ytcfg\.set\s*\(\s*({.+?})\s*\)\s*;', webpage)
+		ytcfg = webpage.get('ytcfg')
 		if ytcfg:
 			try:
-				return self.try_get(loads(ytcfg.group(1)), ('INNERTUBE_CONTEXT', 'client', 'visitorData'))
+				return self.try_get(loads(ytcfg), ('INNERTUBE_CONTEXT', 'client', 'visitorData'))
 			except ValueError:  # pragma: no cover
 				pass
 		print('[YouTubeVideoUrl] Failed to extract visitor id')
 
 	def _extract_web_response(self, webpage):
-		player_response = search(r'ytInitialPlayerResponse\s*=\s*({[^>]*})\s*;\s*(?:var\s+meta|</script|\n)', webpage)
+		player_response = webpage.get('player_response')
 		if player_response:
 			try:
-				return loads(player_response.group(1)), self._extract_player_info()
+				return loads(player_response), self._extract_player_info()
 			except ValueError:  # pragma: no cover
 				pass
 		print('[YouTubeVideoUrl] Failed to extract web response')
 		return None, None
 
-	def _extract_player_response(self, video_id, yt_auth, client, lang, webpage=None):
+	def _extract_player_response(self, video_id, yt_auth, client, lang, visitor_data=None):
 		player_id = None
 		url = 'https://www.youtube.com/youtubei/v1/player?prettyPrint=false'
 		data = {
@@ -454,14 +964,200 @@ class YouTubeVideoUrl():
 			if sts:
 				data['playbackContext']['contentPlaybackContext']['signatureTimestamp'] = sts
 		if client in (5, 7):
-			headers['X-Goog-Visitor-Id'] = self._extract_visitor_id(webpage) or ''
+			headers['X-Goog-Visitor-Id'] = visitor_data or ''
 		headers['X-YouTube-Client-Version'] = VERSION
 		try:
-			return loads(self._download_webpage(url, data, headers)), player_id
+			return loads(self._download_webpage(url, data, headers, decode=False)), player_id
 		except ValueError:  # pragma: no cover
 			print('[YouTubeVideoUrl] Failed to parse JSON')
 			return None, None
 
+	def _webpage_getter(self, video_id):
+		""" Return function which scans the watch page once, when it is needed first """
+		webpage = []
+		lock = Lock()
+
+		def get_webpage():
+			with lock:
+				if not webpage:
+					webpage.append(self._scan_watch_page(video_id))
+			return webpage[0]
+		return get_webpage
+
+	def _get_visitor_data(self, get_webpage):
+		""" Return cached visitor data, the watch page is downloaded only if it is expired """
+		if self._visitor.get('expire', 0) > time():
+			return self._visitor.get('data')
+		visitor_data = self._extract_visitor_id(get_webpage())
+		self._store_visitor_data(visitor_data)
+		return visitor_data
+
+	def _store_visitor_data(self, visitor_data):
+		if visitor_data and self._visitor.get('expire', 0) <= time():
+			self._visitor = {'data': visitor_data, 'expire': int(time() + VISITOR_DATA_TTL)}
+			self.cache.store('clients', 'visitor', self._visitor)
+
+	def _request_client(self, client, video_id, yt_auth, lang, get_webpage):
+		if client == 'web':
+			response = self._extract_web_response(get_webpage())
+		elif client in (5, 7):
+			response = self._extract_player_response(video_id, None, client, lang, self._get_visitor_data(get_webpage))
+		else:
+			response = self._extract_player_response(video_id, yt_auth if client == 85 else None, client, lang)
+		# Every response brings visitor data, keep it for clients which need it
+		self._store_visitor_data(self.try_get(response[0], ('responseContext', 'visitorData')))
+		return response
+
+	def _content_class(self, player_response):
+		if self.try_get(player_response, ('videoDetails', 'isLive')):
+			return 'live'
+		if self.try_get(player_response, ('playabilityStatus', 'status')) == 'LOGIN_REQUIRED':
+			return 'age'
+
+	def _score_client(self, content, client, usable, latency):
+		""" Update moving averages of the client success rate and response time """
+		with self._scores_lock:
+			score = self._scores.setdefault(content, {}).get(str(client))
+			if score:
+				score['success'] += SCORE_WEIGHT * (usable - score['success'])
+				score['latency'] += SCORE_WEIGHT * (latency - score['latency'])
+				score['tries'] += 1
+			else:
+				self._scores[content][str(client)] = {'success': float(usable), 'latency': latency, 'tries': 1}
+
+	def _store_scores(self):
+		with self._scores_lock:
+			self.cache.store('clients', 'scores', self._scores)
+
+	def _client_order(self, content, explore):
+		"""
+		Sort clients by expected time to usable response (latency / success rate),
+		not scored clients and explore runs keep the default order.
+		"""
+		# Live video with skipped DASH MP4 format use web response, otherwise ios client
+		clients = [('web' if self.use_dash_mp4 else 5) if c == 'live' else c for c in CONTENT_CLIENTS[content]]
+		if explore:
+			return clients
+		scores = self._scores.get(content, {})
+
+		def expected_time(client):
+			score = scores.get(str(client))
+			if score:
+				return score['latency'] / max(score['success'], 0.01)
+			return 1.0
+		return sorted(clients, key=expected_time)
+
+	def client_scores(self):
+		""" Return client scores as text for troubleshooting """
+		lines = []
+		for content in sorted(CONTENT_CLIENTS):
+			for client, score in sorted(self._scores.get(content, {}).items()):
+				lines.append('%s client %s: success %.2f, latency %.2fs, tries %d' % (
+					content, client, score['success'], score['latency'], score['tries']))
+		return '\n'.join(lines)
+
+	def _try_clients(self, video_id, yt_auth, lang):
+		""" Request clients one after another until the player response is usable """
+		get_webpage = self._webpage_getter(video_id)
+		with self._scores_lock:
+			count = self._scores.get('count', 0)
+			self._scores['count'] = count + 1
+		# Periodically try clients in default order to notice if they work again
+		explore = count % EXPLORE_INTERVAL == 0
+		content = 'normal'
+		tried = []
+		fallback = (None, None)
+		while True:
+			clients = [c for c in self._client_order(content, explore) if c not in tried]
+			if not clients:
+				break
+			print('[YouTubeVideoUrl] Client order for %s content:' % content, clients)
+			client = clients[0]
+			tried.append(client)
+			start = time()
+			try:
+				player_response, player_id = self._request_client(client, video_id, yt_auth, lang, get_webpage)
+			except Exception as ex:
+				cancel = getattr(self._local, 'cancel', None)
+				if cancel and cancel.is_set():
+					raise
+				print('[YouTubeVideoUrl] Client %s request failed' % client, ex)
+				player_response, player_id = None, None
+			content = self._content_class(player_response) or content
+			usable = self._usable_response(player_response, video_id)
+			self._score_client(content, client, usable, time() - start)
+			self._trace('clients', {'client': client, 'usable': usable, 'latency': round(time() - start, 3)})
+			if usable:
+				print('[YouTubeVideoUrl] Use player response from client', client)
+				fallback = (player_response, player_id)
+				break
+			print('[YouTubeVideoUrl] Player response from client %s is not usable' % client)
+			# Keep not usable response to report the reason if no one is usable,
+			# response for another (placeholder) video must not give its url
+			if video_id == self.try_get(player_response, ('videoDetails', 'videoId')):
+				fallback = (player_response, player_id)
+				if self.try_get(player_response, ('playabilityStatus', 'status')) in ('ERROR', 'UNPLAYABLE'):
+					break  # Video itself is not playable, other clients will not help
+		self._store_scores()
+		return fallback
+
+	def _usable_response(self, player_response, video_id):
+		if self.try_get(player_response, ('playabilityStatus', 'status')) != 'OK' or \
+				video_id != self.try_get(player_response, ('videoDetails', 'videoId')):
+			return False
+		streaming_data = player_response.get('streamingData', {})
+		if self.try_get(player_response, ('videoDetails', 'isLive')):
+			return bool(streaming_data.get('hlsManifestUrl'))
+		return bool(streaming_data.get('formats') or streaming_data.get('adaptiveFormats'))
+
+	def _race_clients(self, video_id, yt_auth, lang):
+		""" Request all clients at once and return the first usable player response """
+		results = compat_Queue()
+		cancel = Event()
+		get_webpage = self._webpage_getter(video_id)
+
+		def request_client(client):
+			self._local.cancel = cancel
+			try:
+				response = self._request_client(client, video_id, yt_auth, lang, get_webpage)
+			except Exception as ex:
+				print('[YouTubeVideoUrl] Client %s request failed' % client, ex)
+				response = (None, None)
+			results.put((client, response))
+
+		# Live video with skipped DASH MP4 format use web response, otherwise ios client
+		clients = [3, 7, 'web' if self.use_dash_mp4 else 5, 56]
+		if yt_auth:
+			clients.append(85)
+		start = time()
+		for client in clients:
+			thread = Thread(target=request_client, args=(client,))
+			thread.daemon = True
+			thread.start()
+
+		fallback = (None, None)
+		deadline = start + RACE_TIMEOUT
+		try:
+			for _ in clients:
+				client, (player_response, player_id) = results.get(timeout=max(deadline - time(), 0))
+				usable = self._usable_response(player_response, video_id)
+				self._score_client(self._content_class(player_response) or 'normal', client, usable, time() - start)
+				self._trace('clients', {'client': client, 'usable': usable, 'latency': round(time() - start, 3)})
+				if usable:
+					print('[YouTubeVideoUrl] Use player response from client', client)
+					return player_response, player_id
+				# Keep not usable response to report the reason if no one is usable,
+				# response for another (placeholder) video must not give its url
+				if video_id == self.try_get(player_response, ('videoDetails', 'videoId')) and \
+						(not fallback[0] or client == 3):
+					fallback = (player_response, player_id)
+		except compat_Empty:
+			print('[YouTubeVideoUrl] Timeout while waiting for clients')
+		finally:
+			cancel.set()  # Stop requests that are not yet started
+			self._store_scores()
+		return fallback
+
 	def _real_extract(self, video_id, yt_auth):
 		DASHMP4_FORMAT = (
 			'133', '134', '135', '136', '137', '138', '160',
@@ -478,47 +1174,22 @@ class YouTubeVideoUrl():
 			print('[YouTubeVideoUrl] skip DASH MP4 format')
 			self.use_dash_mp4 = DASHMP4_FORMAT
 
-		player_response, player_id = self._extract_player_response(video_id, None, 3, lang)
+		if config.plugins.YouTube.raceClients.value:
+			player_response, player_id = self._race_clients(video_id, yt_auth, lang)
+		else:
+			player_response, player_id = self._try_clients(video_id, yt_auth, lang)
 		if not player_response:
 			raise RuntimeError('Player response not found!')
 
 		is_live = self.try_get(player_response, ('videoDetails', 'isLive'))
 
-		if self.try_get(player_response, ('videoDetails', 'videoId')) != video_id:
-			webpage = self._download_webpage('https://www.youtube.com/watch?v=%s&bpctr=9999999999&has_verified=1' % video_id)
-			if not webpage:
-				raise RuntimeError('Webpage not found!')
-
-			if not is_live:
-				print('[YouTubeVideoUrl] Got wrong player response, try mweb response')
-				player_response, player_id = self._extract_player_response(video_id, None, 7, lang, webpage)
-			else:
-				if self.use_dash_mp4:
-					print('[YouTubeVideoUrl] Got wrong player response, try for live web response')
-					player_response, player_id = self._extract_web_response(webpage)
-				else:
-					print('[YouTubeVideoUrl] Got wrong player response, try for live ios client')
-					player_response, player_id = self._extract_player_response(video_id, None, 5, lang, webpage)
-
-		if self.try_get(player_response, ('playabilityStatus', 'status')) == 'LOGIN_REQUIRED':
-			print('[YouTubeVideoUrl] Age gate content, try web embedded client')
-			player_response, player_id = self._extract_player_response(video_id, None, 56, lang)
-			if not player_response or self.try_get(player_response, ('playabilityStatus', 'status')) != 'OK':
-				print('[YouTubeVideoUrl] Player response is not usable, try authorized tv embedded client')
-				player_response, player_id = self._extract_player_response(video_id, yt_auth, 85, lang)
-			if not player_response:
-				raise RuntimeError('Age gate content player response not found!')
-
 		streaming_data = player_response.get('streamingData', {})
 		streaming_formats = streaming_data.get('formats', [])
 
-		# If priority format changed in config, recreate priority list
-		if PRIORITY_VIDEO_FORMAT[0] != config.plugins.YouTube.maxResolution.value:
-			create_priority_formats()
-
 		if not is_live:
 			streaming_formats.extend(streaming_data.get('adaptiveFormats', []))
 			url, our_format = self._extract_fmt_video_format(streaming_formats, player_id)
+			self._trace('itag', our_format)
 			if url and our_format in DASHMP4_FORMAT:
 				audio_url = self._extract_dash_audio_format(streaming_formats, player_id, lang)
 				if audio_url:
@@ -528,8 +1199,9 @@ class YouTubeVideoUrl():
 			print('[YouTubeVideoUrl] Try manifest url')
 			hls_manifest_url = streaming_data.get('hlsManifestUrl')
 			if hls_manifest_url:
-				for fmt in self._extract_from_m3u8(hls_manifest_url):
+				for fmt in self._extract_from_m3u8(hls_manifest_url, video_id, yt_auth):
 					url = fmt.get('url')
+					self._trace('itag', fmt.get('itag'))
 					print('[YouTubeVideoUrl] Found manifest url')
 					break
 
@@ -542,15 +1214,203 @@ class YouTubeVideoUrl():
 					if isinstance(subreason, list):
 						subreason = subreason[0]
 					reason += '\n%s' % subreason
+			status = playability_status.get('status')
+			if status in UNPLAYABLE_STATUSES:
+				self._store_unplayable(video_id, status, reason, yt_auth)
+				raise UnplayableError(reason)
 			raise RuntimeError(reason)
 
 		return str(url)
 
-	def extract(self, video_id, yt_auth=None):
+	@staticmethod
+	def _url_expire(url):
+		expire = findall(r'[?&/]expire[=/](\d+)', url)
+		if expire:
+			return min(int(x) for x in expire)
+
+	def _prune_cache(self):
+		for video_id in self.cache.keys('urls'):
+			urls = self.cache.load('urls', video_id, {})
+			if not any(u.get('expire', 0) > time() + URL_EXPIRE_MARGIN for u in urls.values()):
+				self.cache.remove('urls', video_id)
+		for video_id in self.cache.keys('unplayable'):
+			if self.cache.load('unplayable', video_id, {}).get('expire', 0) <= time():
+				self.cache.remove('unplayable', video_id)
+		for player_id in self.cache.keys('players'):
+			if (self.cache.age('players', player_id) or 0) > PLAYER_PROFILE_TTL:
+				self.cache.remove('players', player_id)
+
+	def _store_unplayable(self, video_id, status, reason, yt_auth):
+		print('[YouTubeVideoUrl] Video is not playable', video_id, status)
+		self.cache.store('unplayable', video_id, {
+			'status': status,
+			'reason': reason,
+			'auth': bool(yt_auth),
+			'expire': int(time() + UNPLAYABLE_TTL)
+		})
+
+	def _load_unplayable(self, video_id, yt_auth):
+		unplayable = self.cache.load('unplayable', video_id)
+		# Video can be playable after login, so do not use error cached without login
+		if unplayable and unplayable['expire'] > time() and (unplayable['auth'] or not yt_auth):
+			return unplayable
+
+	def _load_url(self, video_id, url_id):
+		url = self.cache.load('urls', video_id, {}).get(url_id)
+		if url and url.get('expire', 0) > time() + URL_EXPIRE_MARGIN:
+			return url.get('url')
+
+	def _store_url(self, video_id, url_id, url):
+		expire = self._url_expire(url)
+		if expire:
+			urls = self.cache.load('urls', video_id, {})
+			urls[url_id] = {'url': url, 'expire': expire}
+			self.cache.store('urls', video_id, urls)
+
+	def clear_url_cache(self, video_id):
+		""" Remove cached urls, e.g. if playback failed """
+		print('[YouTubeVideoUrl] Clear cached url', video_id)
+		self.cache.remove('urls', video_id)
+		for key in [key for key in self._m3u8_cache if key[0] == video_id]:
+			del self._m3u8_cache[key]
+
+	def _prefetch_url(self, video_id, yt_auth, cancel):
+		self._local.cancel = cancel
+		try:
+			self._extract(video_id, yt_auth)
+		except Exception as ex:
+			print('[YouTubeVideoUrl] Prefetch failed', video_id, ex)
+		else:
+			print('[YouTubeVideoUrl] Prefetch done', video_id)
+
+	def prefetch(self, video_id, yt_auth=None):
+		""" Resolve video url in background, later extract will use cached url """
+		if video_id not in self._prefetch:
+			print('[YouTubeVideoUrl] Prefetch', video_id)
+			cancel = Event()
+			thread = Thread(target=self._prefetch_url, args=(video_id, yt_auth, cancel))
+			thread.daemon = True
+			self._prefetch[video_id] = (thread, cancel)
+			thread.start()
+
+	def close(self):
+		""" Stop the helper process, call it when the plugin is closed """
+		self.cancel_prefetch()
+		self._worker.close()
+
+	def cancel_prefetch(self):
+		for _, cancel in self._prefetch.values():
+			cancel.set()
+		self._prefetch = {}
+
+	def extract(self, video_id, yt_auth=None, force=False):
+		""" Return video url, force tries again even if video was not playable recently """
+		prefetch = self._prefetch.pop(video_id, None)
+		if prefetch and prefetch[0].is_alive():
+			print('[YouTubeVideoUrl] Wait for prefetch', video_id)
+			prefetch[0].join(PREFETCH_WAIT)
+			if prefetch[0].is_alive():
+				print('[YouTubeVideoUrl] Prefetch is stuck, extract without it', video_id)
+				prefetch[1].set()
+		return self._extract(video_id, yt_auth, force)
+
+	def _extract_worker(self, tasks, results, yt_auth, cancel):
+		self._local.cancel = cancel
+		while not cancel.is_set():
+			try:
+				video_id = tasks.get_nowait()
+			except compat_Empty:
+				break
+			try:
+				results.put((video_id, self.extract(video_id, yt_auth), None))
+			except Exception as ex:
+				results.put((video_id, None, str(ex)))
+
+	def extract_many(self, video_ids, yt_auth=None, concurrency=4):
+		"""
+		Resolve several videos at once and yield (video_id, url, error) as soon as each one is done.
+		Error is None if url is found, otherwise url is None.
+		Closing the generator before the end stops the remaining work.
+		"""
+		tasks = compat_Queue()
+		results = compat_Queue()
+		cancel = Event()
+		unique_ids = []
+		for video_id in video_ids:
+			if video_id not in unique_ids:
+				unique_ids.append(video_id)
+				tasks.put(video_id)
+		for _ in range(min(concurrency, len(unique_ids))):
+			thread = Thread(target=self._extract_worker, args=(tasks, results, yt_auth, cancel))
+			thread.daemon = True
+			thread.start()
+		try:
+			for _ in unique_ids:
+				yield results.get()
+		finally:
+			cancel.set()
+
+	def _extract(self, video_id, yt_auth, force=False):
+		""" Resolve video url and keep the trace of what was done """
+		trace = self._local.trace = {
+			'video_id': video_id,
+			'time': int(time()),
+			'background': getattr(self._local, 'cancel', None) is not None,
+			'clients': [],
+			'player_cache': [],
+			'code_cache': [],
+			'nsig_cache': [],
+			'js_parse_time': 0.0,
+			'js_run_time': 0.0
+		}
+		start = time()
+		try:
+			return self._resolve(video_id, yt_auth, force)
+		except Exception as ex:
+			trace['error'] = str(ex)
+			raise
+		finally:
+			trace['total'] = round(time() - start, 3)
+			trace['js_parse_time'] = round(trace['js_parse_time'], 3)
+			trace['js_run_time'] = round(trace['js_run_time'], 3)
+			self._local.trace = None
+			self.traces.append(trace)
+			print('[YouTubeVideoUrl] Trace', dumps(trace))
+			if config.plugins.YouTube.traceLog.value:
+				try:
+					with open(TRACE_LOG, 'a') as f:
+						f.write(dumps(trace) + '\n')
+				except IOError as e:
+					print('[YouTubeVideoUrl] Writing trace failed', e)
+
+	def _resolve(self, video_id, yt_auth, force):
+		if force:
+			self.cache.remove('unplayable', video_id)
+		else:
+			unplayable = self._load_unplayable(video_id, yt_auth)
+			self._trace('unplayable_cache', 'hit' if unplayable else 'miss')
+			if unplayable:
+				print('[YouTubeVideoUrl] Video was not playable recently', unplayable['status'])
+				raise UnplayableError(unplayable['reason'], cached=True)
+		url_id = '%s_%s_%s_%s' % (
+			config.plugins.YouTube.maxResolution.value,
+			config.plugins.YouTube.useDashMP4.value,
+			config.plugins.YouTube.searchLanguage.value,
+			config.plugins.YouTube.adaptiveResolution.value
+		)
+		url = self._load_url(video_id, url_id)
+		self._trace('url_cache', 'hit' if url else 'miss')
+		if url:
+			print('[YouTubeVideoUrl] Use cached url')
+			return url
 		error_message = None
 		for _ in range(3):
 			try:
-				return self._real_extract(video_id, yt_auth)
+				url = self._real_extract(video_id, yt_auth)
+				self._store_url(video_id, url_id, url)
+				return url
+			except UnplayableError:
+				raise
 			except Exception as ex:
 				if ex is None:
 					print('No supported formats found, trying again!')
@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+# This cache code based on youtube-dl: https://github.com/ytdl-org/youtube-dl
+
+from __future__ import print_function
+
+import errno
+import os
+import re
+
+from json import dump
+from json import load
+from time import time
+
+
+CACHE_DIR = '/tmp/youtube_cache'
+
+
+class Cache():
+	def __init__(self, root=CACHE_DIR):
+		self.root = root
+
+	def _get_cache_fn(self, section, key):
+		if not re.match(r'^[a-zA-Z0-9_.-]+$', section):
+			raise ValueError('Invalid section %r' % section)
+		if not re.match(r'^[a-zA-Z0-9_.-]+$', key):
+			raise ValueError('Invalid key %r' % key)
+		return os.path.join(self.root, section, '%s.json' % key)
+
+	def store(self, section, key, data):
+		""" Store data in the cache, errors are only printed """
+		fn = self._get_cache_fn(section, key)
+		try:
+			try:
+				os.makedirs(os.path.dirname(fn))
+			except OSError as ose:
+				if ose.errno != errno.EEXIST:
+					raise
+			tmp_fn = '%s.%s.tmp' % (fn, os.getpid())
+			with open(tmp_fn, 'w') as cache_file:
+				dump(data, cache_file)
+			os.rename(tmp_fn, fn)
+		except Exception as e:
+			print('[Cache] Writing to cache failed', fn, e)
+
+	def load(self, section, key, default=None):
+		fn = self._get_cache_fn(section, key)
+		try:
+			with open(fn, 'r') as cache_file:
+				return load(cache_file)
+		except ValueError:
+			print('[Cache] Cache file is corrupted', fn)
+		except (IOError, OSError):
+			pass  # No cache available
+		return default
+
+	def age(self, section, key):
+		""" Return seconds since the entry was stored, None if there is no entry """
+		try:
+			return time() - os.path.getmtime(self._get_cache_fn(section, key))
+		except OSError:
+			return None
+
+	def keys(self, section):
+		try:
+			return [fn[:-5] for fn in os.listdir(os.path.join(self.root, section)) if fn.endswith('.json')]
+		except OSError:
+			return []
+
+	def remove(self, section, key):
+		fn = self._get_cache_fn(section, key)
+		try:
+			os.remove(fn)
+		except OSError:
+			pass
@@ -25,6 +25,8 @@ if version_info[0] == 2:
 	from urllib2 import Request as compat_Request
 	from urllib2 import HTTPError as compat_HTTPError
 	from urllib2 import URLError as compat_URLError
+	from Queue import Queue as compat_Queue
+	from Queue import Empty as compat_Empty
 
 	def _unquote_to_bytes(string):
 		if not string:
@@ -97,6 +99,8 @@ else:
 	from urllib.request import Request as compat_Request
 	from urllib.error import HTTPError as compat_HTTPError
 	from urllib.error import URLError as compat_URLError
+	from queue import Queue as compat_Queue
+	from queue import Empty as compat_Empty
 
 
 if version_info >= (3, 4):
@@ -156,19 +160,18 @@ def compat_urlopen(url, timeout=5):
 	an exception is raised if the server has not issued a response.
 	It does not enforce a time limit on the entire function call.
 	"""
-	compat_urlopen.response = None
-	compat_urlopen.error = None
+	result = {}  # Local for each call, so it can be used from several threads
 
 	def open_url(url, timeout):
 		try:
-			compat_urlopen.response = urlopen(url, timeout=timeout)
+			result['response'] = urlopen(url, timeout=timeout)
 		except Exception as e:
-			compat_urlopen.error = e
+			result['error'] = e
 
 	t = Thread(target=open_url, args=(url, timeout))
 	t.setDaemon(True)
 	t.start()
 	t.join(timeout + 1)
-	if compat_urlopen.error:
-		raise compat_urlopen.error
-	return compat_urlopen.response
+	if result.get('error'):
+		raise result['error']
+	return result.get('response')
@@ -0,0 +1,1397 @@
+# coding: utf-8
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import operator
+import re
+
+from json import loads
+from threading import Lock
+
+from .compat import compat_basestring
+from .compat import compat_integer_types
+from .compat import compat_str
+from .jsinterp import _COMP_OPERATORS
+from .jsinterp import _Infinity
+from .jsinterp import _js_add
+from .jsinterp import _js_arith_op
+from .jsinterp import _js_bit_op
+from .jsinterp import _js_ternary
+from .jsinterp import _js_typeof
+from .jsinterp import _LOG_OPERATORS
+from .jsinterp import _NaN
+from .jsinterp import _OPERATORS
+from .jsinterp import js_to_json
+from .jsinterp import JSBreak
+from .jsinterp import JSBudgetExceeded
+from .jsinterp import JSContinue
+from .jsinterp import JSInterpreter
+from .jsinterp import JSThrow
+from .jsinterp import JSUndefined
+from .jsinterp import LocalNameSpace
+from .jsinterp import unified_timestamp
+
+
+# How many parsed function bodies are kept, the cache is emptied when it is full
+AST_CACHE_SIZE = 256
+
+# Runtime frame of a compiled function call is a list of the global namespace,
+# the frame of the enclosing function and the local variables from _FRAME_SLOTS on
+_FRAME_GLOBALS, _FRAME_PARENT, _FRAME_SLOTS = 0, 1, 2
+
+_TOKEN_RE = re.compile(r'''(?sx)
+	(?P<space>\s+|//[^\n]*|/\*.*?\*/)|
+	(?P<num>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|
+	(?P<name>[a-zA-Z_$][\w$]*)|
+	(?P<str>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')|
+	(?P<punct>>>>=?|===|!==|\*\*=?|<<=|>>=|\.\.\.|=>|[=!<>&|^+\-*/%]=|&&|\|\||\?\?|\?\.(?!\d)|\+\+|--|<<|>>|
+		[{}()\[\];,<>+\-*/%&|^!~?:=.])
+''')
+
+_REGEX_FLAGS_RE = re.compile(r'[a-z]*')
+
+# Keywords after which slash starts a regular expression and not a division
+_REGEX_KEYWORDS = frozenset(('case', 'delete', 'do', 'else', 'in', 'new', 'return', 'throw', 'typeof', 'void'))
+
+_RESERVED = frozenset((
+	'break', 'case', 'catch', 'class', 'const', 'continue', 'default', 'delete', 'do', 'else', 'finally',
+	'for', 'function', 'if', 'in', 'instanceof', 'let', 'new', 'return', 'switch', 'throw', 'try', 'typeof',
+	'var', 'void', 'while'
+))
+
+_CONSTANTS = {
+	'true': True,
+	'false': False,
+	'null': None,
+	'undefined': JSUndefined,
+	'NaN': _NaN,
+	'Infinity': _Infinity
+}
+
+# Binding power of binary operators, ** is right associative
+_BINARY_PRECEDENCE = {
+	'??': 1, '||': 1,
+	'&&': 2,
+	'|': 3,
+	'^': 4,
+	'&': 5,
+	'==': 6, '!=': 6, '===': 6, '!==': 6,
+	'<': 7, '>': 7, '<=': 7, '>=': 7,
+	'<<': 8, '>>': 8,
+	'+': 9, '-': 9,
+	'*': 10, '/': 10, '%': 10,
+	'**': 11
+}
+
+_BINARY_OPERATORS = dict(_OPERATORS + _LOG_OPERATORS + _COMP_OPERATORS)
+
+_ASSIGN_OPERATORS = {'=': None}
+_ASSIGN_OPERATORS.update(('%s=' % op, op) for op in ('+', '-', '*', '/', '%', '**', '<<', '>>', '&', '|', '^'))
+
+_BUILTIN_TYPES = {
+	'String': compat_str,
+	'Math': float,
+	'Array': list,
+}
+
+_js_neg = _js_arith_op(operator.sub)
+_js_pos = _js_arith_op(operator.add)
+_js_inv = _js_bit_op(lambda a, _: ~a)
+
+_UNARY_OPERATORS = {
+	'!': lambda value: not _js_ternary(value),
+	'-': lambda value: _js_neg(0, value),
+	'+': lambda value: _js_pos(0, value),
+	'~': lambda value: _js_inv(value, 0),
+	'typeof': _js_typeof,
+	'void': lambda value: JSUndefined,
+}
+
+# Statements after these in the same block never run
+_ABRUPT_STATEMENTS = frozenset(('return', 'throw', 'break', 'continue'))
+
+
+class JSCompileError(RuntimeError):
+	""" Code uses JavaScript which the compiler does not support """
+	pass
+
+
+def _regex_allowed(tokens):
+	if not tokens:
+		return True
+	kind, value = tokens[-1][:2]
+	if kind == 'punct':
+		return value not in (')', ']', '}')
+	return kind == 'name' and value in _REGEX_KEYWORDS
+
+
+def _scan_regex(code, pos):
+	""" Return (pattern, flags) of regular expression literal at pos and its end """
+	idx, in_class = pos + 1, False
+	while idx < len(code):
+		char = code[idx]
+		if char == '\\':
+			idx += 1
+		elif char == '\n':
+			break
+		elif in_class:
+			in_class = char != ']'
+		elif char == '[':
+			in_class = True
+		elif char == '/':
+			flags = _REGEX_FLAGS_RE.match(code, idx + 1)
+			return (code[pos + 1:idx], flags.group()), flags.end()
+		idx += 1
+	raise JSCompileError('Unterminated regular expression', code[pos:pos + 20])
+
+
+def tokenize(code):
+	""" Return list of (kind, value, newline before) tokens, last token is eof """
+	tokens = []
+	pos, end, newline = 0, len(code), False
+	while pos < end:
+		m = _TOKEN_RE.match(code, pos)
+		if not m:
+			raise JSCompileError('Unexpected character', code[pos:pos + 20])
+		kind = m.lastgroup
+		value = m.group(kind)
+		if kind == 'space':
+			newline = newline or '\n' in value
+			pos = m.end()
+			continue
+		if kind == 'punct' and value in ('/', '/=') and _regex_allowed(tokens):
+			kind = 'regex'
+			value, pos = _scan_regex(code, pos)
+		else:
+			pos = m.end()
+		tokens.append((kind, value, newline))
+		newline = False
+	tokens.append(('eof', None, newline))
+	return tokens
+
+
+def _js_number(text):
+	if text[:2] in ('0x', '0X'):
+		return int(text, 16)
+	if text.isdigit():
+		return int(text)
+	return float(text)
+
+
+class _Parser(object):
+	"""
+	Recursive descent parser of function bodies to AST of tuples.
+	Expressions: ('const', value), ('name', name), ('array', items), ('object', [(key, value)]),
+	('func', name, params, body), ('member', obj, prop, nullish), ('call', callee, args),
+	('new', callee, args), ('unary', op, arg), ('update', op, prefix, target),
+	('binary', op, left, right), ('logical', op, left, right), ('cond', test, if_true, if_false),
+	('assign', op, target, value), ('seq', exprs).
+	Statements: ('expr', expr), ('var', [(name, init)]), ('function', func), ('return', arg),
+	('throw', arg), ('if', test, if_true, if_false), ('for', init, test, update, body),
+	('do', body, test), ('break', ), ('continue', ), ('block', stmts),
+	('try', block, name, catch, final), ('switch', disc, [(test, block)]), ('empty', ).
+	"""
+
+	def __init__(self, code):
+		self.tokens = tokenize(code)
+		self.pos = 0
+
+	def error(self, msg):
+		raise JSCompileError(msg, self.tokens[self.pos][1])
+
+	def peek(self):
+		return self.tokens[self.pos]
+
+	def next(self):
+		self.pos += 1
+		return self.tokens[self.pos - 1]
+
+	def at(self, value):
+		# String tokens keep their quotes, so they never equal punctuators or keywords
+		return self.tokens[self.pos][1] == value
+
+	def accept(self, value):
+		if self.tokens[self.pos][1] == value:
+			self.pos += 1
+			return True
+		return False
+
+	def expect(self, value):
+		if not self.accept(value):
+			self.error('Expected %s' % value)
+
+	def at_eof(self):
+		return self.tokens[self.pos][0] == 'eof'
+
+	def at_statement_end(self):
+		kind, value, newline = self.tokens[self.pos]
+		return kind == 'eof' or newline or value in (';', '}')
+
+	def semicolon(self):
+		if not self.accept(';') and not self.at_statement_end():
+			self.error('Expected ;')
+
+	def name(self):
+		kind, value = self.next()[:2]
+		if kind != 'name' or value in _RESERVED:
+			self.pos -= 1
+			self.error('Expected name')
+		return value
+
+	def parse(self):
+		stmts = []
+		while not self.at_eof():
+			stmts.append(self.statement())
+		return stmts
+
+	def block(self):
+		self.expect('{')
+		stmts = []
+		while not self.accept('}'):
+			if self.at_eof():
+				self.error('Unterminated block')
+			stmts.append(self.statement())
+		return ('block', stmts)
+
+	def statement(self):
+		kind, value = self.peek()[:2]
+		if kind == 'punct':
+			if value == '{':
+				return self.block()
+			if value == ';':
+				self.pos += 1
+				return ('empty', )
+		elif kind == 'name' and value in _RESERVED:
+			self.pos += 1
+			if value in ('var', 'let', 'const'):
+				stmt = ('var', self.declarations())
+			elif value == 'if':
+				test = self.paren_expression()
+				if_true = self.statement()
+				return ('if', test, if_true, self.statement() if self.accept('else') else None)
+			elif value == 'for':
+				return self.for_statement()
+			elif value == 'while':
+				test = self.paren_expression()
+				return ('for', None, test, None, self.statement())
+			elif value == 'do':
+				body = self.statement()
+				self.expect('while')
+				test = self.paren_expression()
+				self.accept(';')
+				return ('do', body, test)
+			elif value == 'return':
+				stmt = ('return', None if self.at_statement_end() else self.expression())
+			elif value == 'throw':
+				stmt = ('throw', self.expression())
+			elif value in ('break', 'continue'):
+				if not self.at_statement_end():
+					self.error('Labels are not supported')
+				stmt = (value, )
+			elif value == 'try':
+				return self.try_statement()
+			elif value == 'switch':
+				return self.switch_statement()
+			elif value == 'function':
+				func = self.function()
+				if not func[1]:
+					self.error('Function declaration without name')
+				return ('function', func)
+			else:
+				self.pos -= 1
+				stmt = ('expr', self.expression())
+			self.semicolon()
+			return stmt
+		stmt = ('expr', self.expression())
+		self.semicolon()
+		return stmt
+
+	def declarations(self):
+		decls = []
+		while True:
+			name = self.name()
+			decls.append((name, self.assignment() if self.accept('=') else None))
+			if not self.accept(','):
+				return decls
+
+	def paren_expression(self):
+		self.expect('(')
+		expr = self.expression()
+		self.expect(')')
+		return expr
+
+	def for_statement(self):
+		self.expect('(')
+		init = None
+		if self.accept('var') or self.accept('let') or self.accept('const'):
+			init = ('var', self.declarations())
+		elif not self.at(';'):
+			init = ('expr', self.expression())
+		if self.at('in') or self.at('of'):
+			self.error('for in and for of loops are not supported')
+		self.expect(';')
+		test = None if self.at(';') else self.expression()
+		self.expect(';')
+		update = None if self.at(')') else self.expression()
+		self.expect(')')
+		return ('for', init, test, update, self.statement())
+
+	def try_statement(self):
+		block = self.block()
+		name = catch = final = None
+		if self.accept('catch'):
+			if self.accept('('):
+				name = self.name()
+				self.expect(')')
+			catch = self.block()
+		if self.accept('finally'):
+			final = self.block()
+		if not catch and not final:
+			self.error('Try without catch or finally')
+		return ('try', block, name, catch, final)
+
+	def switch_statement(self):
+		disc = self.paren_expression()
+		self.expect('{')
+		cases = []
+		while not self.accept('}'):
+			if self.accept('default'):
+				test = None
+			else:
+				self.expect('case')
+				test = self.expression()
+			self.expect(':')
+			stmts = []
+			while not (self.at('case') or self.at('default') or self.at('}')):
+				if self.at_eof():
+					self.error('Unterminated switch')
+				stmts.append(self.statement())
+			cases.append((test, ('block', stmts)))
+		return ('switch', disc, cases)
+
+	def function(self):
+		name = None
+		if self.peek()[0] == 'name':
+			name = self.name()
+		self.expect('(')
+		params = []
+		while not self.accept(')'):
+			params.append(self.name())
+			if not self.accept(','):
+				self.expect(')')
+				break
+		return ('func', name, params, self.block()[1])
+
+	def expression(self):
+		expr = self.assignment()
+		if not self.at(','):
+			return expr
+		exprs = [expr]
+		while self.accept(','):
+			exprs.append(self.assignment())
+		return ('seq', exprs)
+
+	def assignment(self):
+		target = self.conditional()
+		kind, value = self.peek()[:2]
+		if kind == 'punct' and value in _ASSIGN_OPERATORS:
+			if target[0] not in ('name', 'member'):
+				self.error('Invalid assignment target')
+			self.pos += 1
+			return ('assign', _ASSIGN_OPERATORS[value], target, self.assignment())
+		return target
+
+	def conditional(self):
+		test = self.binary(0)
+		if not self.accept('?'):
+			return test
+		if_true = self.assignment()
+		self.expect(':')
+		return ('cond', test, if_true, self.assignment())
+
+	def binary(self, min_precedence):
+		""" Precedence climbing, every loop binds the operators at least as tight as min_precedence """
+		left = self.unary()
+		while True:
+			kind, op = self.peek()[:2]
+			precedence = _BINARY_PRECEDENCE.get(op) if kind == 'punct' else None
+			if precedence is None or precedence < min_precedence:
+				return left
+			self.pos += 1
+			right = self.binary(precedence if op == '**' else precedence + 1)
+			left = ('logical' if op in ('&&', '||', '??') else 'binary', op, left, right)
+
+	def unary(self):
+		kind, op = self.peek()[:2]
+		if (kind == 'punct' and op in ('!', '-', '+', '~')) or (kind == 'name' and op in ('typeof', 'void')):
+			self.pos += 1
+			arg = self.unary()
+			# Negative integer literal stays integer like in the interpreter, e.g. for slice() and shifts
+			if op == '-' and arg[0] == 'const' and isinstance(arg[1], compat_integer_types) and not isinstance(arg[1], bool):
+				return ('const', -arg[1])
+			return ('unary', op, arg)
+		if kind == 'punct' and op in ('++', '--'):
+			self.pos += 1
+			return ('update', op, True, self.target(self.unary()))
+		expr = self.call_member()
+		kind, op, newline = self.peek()
+		if kind == 'punct' and op in ('++', '--') and not newline:
+			self.pos += 1
+			return ('update', op, False, self.target(expr))
+		return expr
+
+	def target(self, expr):
+		if expr[0] not in ('name', 'member'):
+			self.error('Invalid update target')
+		return expr
+
+	def property_name(self):
+		kind, value = self.next()[:2]
+		if kind != 'name':
+			self.pos -= 1
+			self.error('Expected property name')
+		return value
+
+	def arguments(self):
+		self.expect('(')
+		args = []
+		while not self.accept(')'):
+			args.append(self.assignment())
+			if not self.accept(','):
+				self.expect(')')
+				break
+		return args
+
+	def call_member(self):
+		if self.accept('new'):
+			expr = self.primary()
+			while self.accept('.'):
+				expr = ('member', expr, ('const', self.property_name()), False)
+			expr = ('new', expr, self.arguments() if self.at('(') else [])
+		else:
+			expr = self.primary()
+		while True:
+			if self.accept('.'):
+				expr = ('member', expr, ('const', self.property_name()), False)
+			elif self.accept('?.'):
+				if self.accept('['):
+					prop = self.expression()
+					self.expect(']')
+				elif self.at('('):
+					self.error('Optional call is not supported')
+				else:
+					prop = ('const', self.property_name())
+				expr = ('member', expr, prop, True)
+			elif self.accept('['):
+				prop = self.expression()
+				self.expect(']')
+				expr = ('member', expr, prop, False)
+			elif self.at('('):
+				expr = ('call', expr, self.arguments())
+			else:
+				return expr
+
+	def primary(self):
+		kind, value = self.next()[:2]
+		if kind == 'num':
+			return ('const', _js_number(value))
+		if kind == 'str':
+			return ('const', loads(js_to_json(value)))
+		if kind == 'regex':
+			# Flags are ignored, like in the interpreter
+			return ('const', re.compile(value[0].replace('[[', r'[\[')))
+		if kind == 'name':
+			if value in _CONSTANTS:
+				return ('const', _CONSTANTS[value])
+			if value == 'function':
+				return self.function()
+			if value not in _RESERVED:
+				return ('name', value)
+		elif value == '(':
+			expr = self.expression()
+			self.expect(')')
+			return expr
+		elif value == '[':
+			items = []
+			while not self.accept(']'):
+				items.append(self.assignment())
+				if not self.accept(','):
+					self.expect(']')
+					break
+			return ('array', items)
+		elif value == '{':
+			items = []
+			while not self.accept('}'):
+				kind, key = self.next()[:2]
+				if kind == 'str':
+					key = loads(js_to_json(key))
+				elif kind == 'num':
+					key = _js_number(key)
+				elif kind != 'name':
+					self.pos -= 1
+					self.error('Unsupported object key')
+				self.expect(':')
+				items.append((key, self.assignment()))
+				if not self.accept(','):
+					self.expect('}')
+					break
+			return ('object', items)
+		self.pos -= 1
+		self.error('Unexpected token')
+
+
+def _declarations(stmts):
+	""" Yield var and function statements, they are hoisted to the function scope """
+	for stmt in stmts:
+		kind = stmt[0]
+		if kind in ('var', 'function'):
+			yield stmt
+			continue
+		if kind == 'block':
+			nested = stmt[1]
+		elif kind == 'if':
+			nested = [s for s in stmt[2:] if s]
+		elif kind == 'for':
+			nested = [s for s in (stmt[1], stmt[4]) if s]
+		elif kind == 'do':
+			nested = [stmt[1]]
+		elif kind == 'try':
+			nested = [s for s in (stmt[1], stmt[3], stmt[4]) if s]
+		elif kind == 'switch':
+			nested = [block for _, block in stmt[2]]
+		else:
+			continue
+		for decl in _declarations(nested):
+			yield decl
+
+
+def _is_primitive(value):
+	return value is None or value is JSUndefined or isinstance(value, (compat_basestring, bool, float) + compat_integer_types)
+
+
+def _completes(stmt):
+	""" True if statement always leaves its block """
+	if stmt[0] == 'block':
+		return bool(stmt[1]) and _completes(stmt[1][-1])
+	return stmt[0] in _ABRUPT_STATEMENTS
+
+
+def _block_of(stmts):
+	stmts = [stmt for stmt in stmts if stmt[0] != 'empty']
+	if not stmts:
+		return ('empty', )
+	# Function declaration stays nested, it would be hoisted in the function body
+	if len(stmts) == 1 and stmts[0][0] != 'function':
+		return stmts[0]
+	return ('block', stmts)
+
+
+class _Optimizer(object):
+	"""
+	Fold constant expressions of a parsed function and drop the statements which never run.
+	Global constants are inlined where the function reads them by index or typeof,
+	only if the function does not declare, assign, call or pass them on.
+	"""
+
+	def __init__(self, index, constants):
+		self.index = index
+		self.constants = constants
+		self.known = {}
+		self.unsafe = set()
+
+	def function(self, params, body):
+		""" Return optimized function body """
+		known = dict((name, value) for name, value in self.constants.items() if value is not None and value is not JSUndefined)
+		while True:
+			self.known, self.unsafe = known, set(params)
+			optimized = self._stmts(body, True)
+			if not self.unsafe.intersection(known):
+				return optimized
+			# Optimize again without the constants which the function uses otherwise
+			known = dict((name, value) for name, value in known.items() if name not in self.unsafe)
+
+	def _stmts(self, stmts, function_body=False):
+		optimized = []
+		for idx, stmt in enumerate(stmts):
+			stmt = self._stmt(stmt)
+			if stmt[0] != 'empty':
+				optimized.append(stmt)
+			if _completes(stmt):
+				rest = stmts[idx + 1:]
+				if function_body:
+					# Function declarations of the function body are hoisted and still bound
+					optimized.extend(self._stmt(s) for s in rest if s[0] == 'function')
+					rest = [s for s in rest if s[0] != 'function']
+				optimized.extend(self._dead(rest))
+				break
+		return optimized
+
+	def _dead(self, stmts):
+		""" Return declaration of the names which the statements that never run declare """
+		names = []
+		for stmt in _declarations(stmts):
+			names.extend([name for name, _ in stmt[1]] if stmt[0] == 'var' else [stmt[1][1]])
+		self.unsafe.update(names)
+		return [('var', [(name, None) for name in names])] if names else []
+
+	def _stmt(self, node):
+		return getattr(self, '_stmt_' + node[0])(*node[1:])
+
+	def _stmt_block(self, stmts):
+		return ('block', self._stmts(stmts))
+
+	def _stmt_empty(self):
+		return ('empty', )
+
+	def _stmt_expr(self, expr):
+		expr = self._expr(expr)
+		return ('empty', ) if expr[0] == 'const' else ('expr', expr)
+
+	def _stmt_var(self, decls):
+		self.unsafe.update(name for name, _ in decls)
+		return ('var', [(name, init and self._expr(init)) for name, init in decls])
+
+	def _stmt_function(self, func):
+		return ('function', self._expr_func(*func[1:]))
+
+	def _stmt_return(self, arg):
+		return ('return', arg and self._expr(arg))
+
+	def _stmt_throw(self, arg):
+		return ('throw', self._expr(arg))
+
+	def _stmt_break(self):
+		return ('break', )
+
+	def _stmt_continue(self):
+		return ('continue', )
+
+	def _stmt_if(self, test, if_true, if_false):
+		test = self._expr(test)
+		if test[0] != 'const':
+			return ('if', test, self._stmt(if_true), if_false and self._stmt(if_false))
+		if not _js_ternary(test[1]):
+			if_true, if_false = if_false, if_true
+		return _block_of(([self._stmt(if_true)] if if_true else []) + self._dead([if_false] if if_false else []))
+
+	def _stmt_for(self, init, test, update, body):
+		init, test = init and self._stmt(init), test and self._expr(test)
+		if test and test[0] == 'const' and not _js_ternary(test[1]):
+			return _block_of(([init] if init else []) + self._dead([body]))
+		return ('for', init, test, update and self._expr(update), self._stmt(body))
+
+	def _stmt_do(self, body, test):
+		return ('do', self._stmt(body), self._expr(test))
+
+	def _stmt_try(self, block, name, catch, final):
+		if name:
+			self.unsafe.add(name)
+		return ('try', self._stmt(block), name, catch and self._stmt(catch), final and self._stmt(final))
+
+	def _stmt_switch(self, disc, cases):
+		return ('switch', self._expr(disc), [(test and self._expr(test), self._stmt(block)) for test, block in cases])
+
+	def _expr(self, node):
+		return getattr(self, '_expr_' + node[0])(*node[1:])
+
+	def _expr_const(self, value):
+		return ('const', value)
+
+	def _expr_name(self, name):
+		# Name used other than by index or typeof
+		self.unsafe.add(name)
+		return ('name', name)
+
+	def _expr_member(self, obj, prop, nullish):
+		prop = self._expr(prop)
+		if obj[0] == 'name' and obj[1] in self.known:
+			values = (self.known[obj[1]], )
+		else:
+			obj = self._expr(obj)
+			values = (obj[1], ) if obj[0] == 'const' and isinstance(obj[1], compat_basestring) else ()
+		if values and prop[0] == 'const':
+			try:
+				value = self.index(values[0], prop[1])
+			except Exception:
+				pass
+			else:
+				if _is_primitive(value):
+					return ('const', value)
+		return ('member', obj, prop, nullish)
+
+	def _expr_call(self, callee, args):
+		if callee[0] == 'member':
+			# Method call stays a method call, the method can change its object
+			callee = ('member', self._expr(callee[1]), self._expr(callee[2]), callee[3])
+		else:
+			callee = self._expr(callee)
+		return ('call', callee, [self._expr(arg) for arg in args])
+
+	def _expr_new(self, callee, args):
+		return ('new', callee, [self._expr(arg) for arg in args])
+
+	def _expr_unary(self, op, arg):
+		if op == 'typeof' and arg[0] == 'name' and arg[1] in self.known:
+			return ('const', _js_typeof(self.known[arg[1]]))
+		arg = self._expr(arg)
+		if arg[0] == 'const' and _is_primitive(arg[1]):
+			try:
+				return ('const', _UNARY_OPERATORS[op](arg[1]))
+			except Exception:
+				pass
+		return ('unary', op, arg)
+
+	def _expr_binary(self, op, left, right):
+		left, right = self._expr(left), self._expr(right)
+		if left[0] == right[0] == 'const' and _is_primitive(left[1]) and _is_primitive(right[1]):
+			try:
+				value = _BINARY_OPERATORS[op](left[1], right[1])
+			except Exception:
+				pass
+			else:
+				if _is_primitive(value):
+					return ('const', value)
+		return ('binary', op, left, right)
+
+	def _expr_logical(self, op, left, right):
+		left, right = self._expr(left), self._expr(right)
+		if left[0] != 'const':
+			return ('logical', op, left, right)
+		value = left[1]
+		if op == '??':
+			return right if value is None or value is JSUndefined else left
+		return left if (op == '&&') ^ _js_ternary(value) else right
+
+	def _expr_cond(self, test, if_true, if_false):
+		test = self._expr(test)
+		if test[0] == 'const':
+			return self._expr(if_true if _js_ternary(test[1]) else if_false)
+		return ('cond', test, self._expr(if_true), self._expr(if_false))
+
+	def _target(self, target):
+		if target[0] == 'name':
+			self.unsafe.add(target[1])
+			return target
+		return ('member', self._expr(target[1]), self._expr(target[2]), target[3])
+
+	def _expr_assign(self, op, target, value):
+		return ('assign', op, self._target(target), self._expr(value))
+
+	def _expr_update(self, op, prefix, target):
+		return ('update', op, prefix, self._target(target))
+
+	def _expr_seq(self, exprs):
+		exprs = [self._expr(expr) for expr in exprs]
+		# Constants have no effect, only the last expression gives the value
+		exprs = [expr for expr in exprs[:-1] if expr[0] != 'const'] + exprs[-1:]
+		return exprs[0] if len(exprs) == 1 else ('seq', exprs)
+
+	def _expr_array(self, items):
+		return ('array', [self._expr(item) for item in items])
+
+	def _expr_object(self, items):
+		return ('object', [(key, self._expr(value)) for key, value in items])
+
+	def _expr_func(self, name, params, body):
+		self.unsafe.update(params)
+		if name:
+			self.unsafe.add(name)
+		return ('func', name, params, self._stmts(body, True))
+
+
+class _Scope(object):
+	""" Names declared in one JavaScript function, resolved at compile time to slots of the runtime frame """
+
+	def __init__(self, parent, name, params, body):
+		self.parent = parent
+		self.slots = {}
+		self.size = _FRAME_SLOTS
+		self.name_slot = name and self.declare(name)
+		self.params = [self.declare(param) for param in params]
+		self.declare('this')
+		self._declare(body)
+
+	def declare(self, name):
+		slot = self.slots.get(name)
+		if slot is None:
+			slot = self.slots[name] = self.size
+			self.size += 1
+		return slot
+
+	def _declare(self, stmts):
+		for stmt in _declarations(stmts):
+			if stmt[0] == 'var':
+				for name, _ in stmt[1]:
+					self.declare(name)
+			else:
+				self.declare(stmt[1][1])
+
+	def push(self, name):
+		""" Bind name to a new slot, return slot and the shadowed slot for pop() """
+		shadowed = self.slots.get(name)
+		self.slots[name] = self.size
+		self.size += 1
+		return self.slots[name], shadowed
+
+	def pop(self, name, shadowed):
+		if shadowed is None:
+			del self.slots[name]
+		else:
+			self.slots[name] = shadowed
+
+	def resolve(self, name):
+		""" Return depth and slot of local name, None for global names """
+		scope, depth = self, 0
+		while scope:
+			slot = scope.slots.get(name)
+			if slot is not None:
+				return depth, slot
+			scope, depth = scope.parent, depth + 1
+
+
+class JSCompiler(JSInterpreter):
+	"""
+	JSInterpreter which parses every function body once and compiles it to Python closures.
+	Code which the compiler does not support is run by the interpreter.
+	"""
+	_ast_cache = {}
+
+	def __init__(self, code, objects=None, symbols=None, constants=None):
+		"""
+		Functions are optimized if constants is given, a dict of the global variables which
+		the functions are called with and which the player does not change.
+		"""
+		super(JSCompiler, self).__init__(code, objects, symbols)
+		self._constants = constants
+		self._compiled = {}
+		# Scope of the function being compiled
+		self._scope = None
+		self._compile_lock = Lock()
+		# Set to 0 to count the executed statements of the functions compiled after that
+		self.executed = None
+
+	@classmethod
+	def parse(cls, code):
+		""" Return AST of function body, parsed bodies are cached for all instances """
+		ast = cls._ast_cache.get(code)
+		if ast is None:
+			if len(cls._ast_cache) >= AST_CACHE_SIZE:
+				cls._ast_cache.clear()
+			try:
+				ast = _Parser(code).parse()
+			except JSCompileError as e:
+				ast = e
+			cls._ast_cache[code] = ast
+		if isinstance(ast, JSCompileError):
+			raise ast
+		return ast
+
+	def optimize(self, argnames, body, with_constants=True):
+		""" Return optimized function body, the same body if the instance has no constants """
+		if self._constants is None:
+			return body
+		return _Optimizer(self._index, self._constants if with_constants else {}).function(argnames, body)
+
+	def _compile_body(self, argnames, code, with_constants=False):
+		""" Return scope and compiled body, the slots of the scope depend on argument names """
+		key = (tuple(argnames), code, with_constants)
+		compiled = self._compiled.get(key)
+		if compiled is None:
+			ast = self.optimize(argnames, self.parse(code), with_constants)
+			with self._compile_lock:
+				compiled = self._compiled[key] = self._compile_function(None, argnames, ast)
+		return compiled
+
+	def _compile_function(self, name, params, body):
+		scope = self._scope = _Scope(self._scope, name, params, body)
+		try:
+			return scope, self._body(body)
+		finally:
+			self._scope = scope.parent
+
+	def extract_function_from_code(self, argnames, code, *global_stack):
+		try:
+			# Functions of the code are called without the global variables
+			scope, body = self._compile_body(argnames, code, bool(global_stack))
+		except JSCompileError:
+			return super(JSCompiler, self).extract_function_from_code(argnames, code, *global_stack)
+		return self._budgeted(self._fallback(self._function(scope, body, LocalNameSpace({}, *global_stack)),
+			argnames, code, global_stack))
+
+	def build_function(self, argnames, code, *global_stack):
+		try:
+			scope, body = self._compile_body(argnames, code)
+		except JSCompileError:
+			return super(JSCompiler, self).build_function(argnames, code, *global_stack)
+		return self._budgeted(self._function(scope, body, LocalNameSpace(*global_stack or ({}, ))))
+
+	def _fallback(self, func, argnames, code, global_stack):
+		""" Return func which runs the code with the interpreter after the compiled code failed """
+		funcs = [func]
+
+		def fallback(args, kwargs=None, allow_recursion=100):
+			try:
+				return funcs[0](args, kwargs, allow_recursion)
+			except JSBudgetExceeded:
+				raise
+			except Exception as e:
+				if funcs[0] is not func:
+					raise
+				print('[JSCompiler] Compiled function failed, use the interpreter', e)
+				# Functions called by the code must not be compiled either
+				jsi = JSInterpreter(self.code, symbols=self._symbols)
+				jsi.step_budget, jsi.time_budget, jsi._budget, jsi.profiler = (
+					self.step_budget, self.time_budget, self._budget, self.profiler)
+				funcs[0] = jsi.extract_function_from_code(argnames, code, *global_stack)
+				return funcs[0](args, kwargs, allow_recursion)
+		return fallback
+
+	@staticmethod
+	def _function(scope, body, namespace, parent=None):
+		""" Return function which runs compiled body in a new frame, names which are not local are looked up in namespace """
+		size, slots, params, name_slot = scope.size, scope.slots, scope.params, scope.name_slot
+
+		def resf(args, kwargs=None, allow_recursion=100):
+			if allow_recursion < 0:
+				raise RuntimeError('Recursion limit reached')
+			frame = [namespace, parent] + [JSUndefined] * (size - _FRAME_SLOTS)
+			if name_slot:
+				frame[name_slot] = resf
+			for slot, arg in zip(params, args):
+				frame[slot] = arg
+			if kwargs:
+				for key, value in kwargs.items():
+					if key in slots:
+						frame[slots[key]] = value
+			ret = body(frame)
+			if ret is not None:
+				return ret[0]
+		return resf
+
+	def _index(self, obj, idx):
+		if isinstance(obj, compat_basestring):
+			if idx == 'length':
+				return len(obj)
+			try:
+				return obj[int(idx)]
+			except (TypeError, ValueError, IndexError) as e:
+				raise RuntimeError('Cannot get index', idx, e)
+		return super(JSCompiler, self)._index(obj, idx)
+
+	def _global_object(self, name):
+		obj = _BUILTIN_TYPES.get(name)
+		if obj is None:
+			if name not in self._objects:
+				self._objects[name] = self.extract_object(name)
+			obj = self._objects[name]
+		return obj
+
+	def _global_function(self, name):
+		if name not in self._functions:
+			self._functions[name] = self.extract_function_from_code(*self.extract_function_code(name))
+		return self._functions[name]
+
+	# Compiled statements return None, or (value, ) for return
+
+	def _body(self, stmts):
+		""" Compile function body, function declarations are hoisted """
+		return self._stmt_block(
+			[stmt for stmt in stmts if stmt[0] == 'function'] + [stmt for stmt in stmts if stmt[0] != 'function'])
+
+	def _stmt(self, node):
+		stmt = getattr(self, '_stmt_' + node[0])(*node[1:])
+		if self.executed is None or node[0] in ('block', 'empty'):
+			return stmt
+
+		def counted(frame):
+			self.executed += 1
+			return stmt(frame)
+		return counted
+
+	def _stmt_block(self, stmts):
+		compiled = [self._stmt(stmt) for stmt in stmts if stmt[0] != 'empty']
+		if len(compiled) == 1:
+			return compiled[0]
+
+		def block(frame):
+			for stmt in compiled:
+				ret = stmt(frame)
+				if ret is not None:
+					return ret
+		return block
+
+	def _stmt_empty(self):
+		return lambda frame: None
+
+	def _stmt_expr(self, expr):
+		expr = self._expr(expr)
+
+		def stmt(frame):
+			expr(frame)
+		return stmt
+
+	def _stmt_var(self, decls):
+		# Declared names are hoisted to slots, declarations without value do nothing
+		decls = [(self._setter(name), self._expr(init)) for name, init in decls if init]
+
+		def var(frame):
+			for setter, init in decls:
+				setter(frame, init(frame))
+		return var
+
+	def _stmt_function(self, func):
+		# Declared function is bound in the enclosing function only
+		setter, func = self._setter(func[1]), self._expr_func(None, *func[2:])
+
+		def declaration(frame):
+			setter(frame, func(frame))
+		return declaration
+
+	def _stmt_return(self, arg):
+		arg = arg and self._expr(arg)
+		return lambda frame: (arg(frame) if arg else None, )
+
+	def _stmt_throw(self, arg):
+		arg = self._expr(arg)
+
+		def throw(frame):
+			raise JSThrow(arg(frame))
+		return throw
+
+	def _stmt_break(self):
+		def brk(frame):
+			raise JSBreak()
+		return brk
+
+	def _stmt_continue(self):
+		def cont(frame):
+			raise JSContinue()
+		return cont
+
+	def _stmt_if(self, test, if_true, if_false):
+		test, if_true = self._expr(test), self._stmt(if_true)
+		if_false = if_false and self._stmt(if_false)
+
+		def stmt_if(frame):
+			if _js_ternary(test(frame)):
+				return if_true(frame)
+			elif if_false:
+				return if_false(frame)
+		return stmt_if
+
+	def _stmt_for(self, init, test, update, body):
+		init, body = init and self._stmt(init), self._stmt(body)
+		test, update = test and self._expr(test), update and self._expr(update)
+		spend = self._spend
+
+		def stmt_for(frame):
+			if init:
+				init(frame)
+			while not test or _js_ternary(test(frame)):
+				spend()
+				try:
+					ret = body(frame)
+					if ret is not None:
+						return ret
+				except JSBreak:
+					break
+				except JSContinue:
+					pass
+				if update:
+					update(frame)
+		return stmt_for
+
+	def _stmt_do(self, body, test):
+		body, test = self._stmt(body), self._expr(test)
+		spend = self._spend
+
+		def stmt_do(frame):
+			while True:
+				spend()
+				try:
+					ret = body(frame)
+					if ret is not None:
+						return ret
+				except JSBreak:
+					break
+				except JSContinue:
+					pass
+				if not _js_ternary(test(frame)):
+					break
+		return stmt_do
+
+	def _stmt_try(self, block, name, catch, final):
+		block, final = self._stmt(block), final and self._stmt(final)
+		slot = None
+		if catch and name:
+			# Catch parameter is only visible in the catch block
+			slot, shadowed = self._scope.push(name)
+			catch = self._stmt(catch)
+			self._scope.pop(name, shadowed)
+		elif catch:
+			catch = self._stmt(catch)
+
+		def try_catch(frame):
+			try:
+				return block(frame)
+			except (JSBreak, JSContinue, JSBudgetExceeded):
+				raise
+			except Exception as e:
+				if not catch:
+					raise
+				if isinstance(e, JSThrow) and e.args:
+					e = e.args[0]
+				if slot:
+					frame[slot] = e
+				return catch(frame)
+
+		if not final:
+			return try_catch
+
+		def try_finally(frame):
+			try:
+				ret = try_catch(frame)
+			except Exception:
+				final_ret = final(frame)
+				if final_ret is not None:
+					return final_ret
+				raise
+			return final(frame) or ret
+		return try_finally
+
+	def _stmt_switch(self, disc, cases):
+		disc = self._expr(disc)
+		cases = [(test and self._expr(test), self._stmt(block)) for test, block in cases]
+		default = next((idx for idx, (test, _) in enumerate(cases) if not test), None)
+
+		def switch(frame):
+			value = disc(frame)
+			start = next((idx for idx, (test, _) in enumerate(cases) if test and test(frame) == value), default)
+			if start is None:
+				return
+			try:
+				for _, block in cases[start:]:
+					ret = block(frame)
+					if ret is not None:
+						return ret
+			except JSBreak:
+				pass
+		return switch
+
+	# Compiled expressions return the value
+
+	def _expr(self, node):
+		return getattr(self, '_expr_' + node[0])(*node[1:])
+
+	def _expr_const(self, value):
+		return lambda frame: value
+
+	def _expr_name(self, name):
+		return self._getter(name)
+
+	def _getter(self, name):
+		""" Return function which reads name from the frame, local names are read from resolved slot """
+		local = self._scope.resolve(name)
+		if local is None:
+			return lambda frame: frame[_FRAME_GLOBALS][name]
+		depth, slot = local
+		if depth == 0:
+			return lambda frame: frame[slot]
+
+		def getter(frame):
+			for _ in range(depth):
+				frame = frame[_FRAME_PARENT]
+			return frame[slot]
+		return getter
+
+	def _setter(self, name):
+		""" Return function which assigns name in the frame """
+		local = self._scope.resolve(name)
+		if local is None:
+			def setter(frame, value):
+				frame[_FRAME_GLOBALS][name] = value
+			return setter
+		depth, slot = local
+
+		def setter(frame, value):
+			for _ in range(depth):
+				frame = frame[_FRAME_PARENT]
+			frame[slot] = value
+
+		def local_setter(frame, value):
+			frame[slot] = value
+		return local_setter if depth == 0 else setter
+
+	def _object(self, node, nullish=False):
+		""" Compile expression used as object, undefined names are searched from builtins and the code """
+		if node[0] != 'name':
+			return self._expr(node)
+		name, getter = node[1], self._getter(node[1])
+
+		def obj(frame):
+			value = getter(frame)
+			if value is JSUndefined or value is None:
+				try:
+					value = self._global_object(name)
+				except Exception:
+					if not nullish:
+						raise
+			return value
+		return obj
+
+	def _expr_member(self, obj, prop, nullish):
+		obj, prop = self._object(obj, nullish), self._expr(prop)
+
+		def member(frame):
+			value = obj(frame)
+			if nullish and (value is JSUndefined or value is None):
+				return JSUndefined
+			return self._index(value, prop(frame))
+		return member
+
+	def _expr_call(self, callee, args):
+		args = [self._expr(arg) for arg in args]
+		if callee[0] == 'name':
+			name = callee[1]
+			if self._scope.resolve(name):
+				getter = self._getter(name)
+				return lambda frame: getter(frame)([arg(frame) for arg in args], allow_recursion=100)
+
+			def call_name(frame):
+				argvals = [arg(frame) for arg in args]
+				namespace = frame[_FRAME_GLOBALS]
+				func = namespace[name] if name in namespace else self._global_function(name)
+				return func(argvals, allow_recursion=100)
+			return call_name
+
+		if callee[0] != 'member':
+			callee = self._expr(callee)
+			return lambda frame: callee(frame)([arg(frame) for arg in args], allow_recursion=100)
+
+		obj, prop, nullish = callee[1:]
+		if (obj, prop) == (('name', 'console'), ('const', 'debug')):
+			return lambda frame: None
+		# Type.prototype.method.call(...) and .apply(...) are handled by the interpreter method call
+		if (prop[0] == 'const' and prop[1] in ('call', 'apply') and obj[0] == 'member' and
+				obj[2][0] == 'const' and obj[1][0] == 'member' and obj[1][2] == ('const', 'prototype')):
+			obj, prop = obj[1][1], ('const', 'prototype.%s.%s' % (obj[2][1], prop[1]))
+		obj, prop = self._object(obj, nullish), self._expr(prop)
+
+		def call_method(frame):
+			value = obj(frame)
+			if nullish and (value is JSUndefined or value is None):
+				return JSUndefined
+			member = prop(frame)
+			return self._call_method(value, member, [arg(frame) for arg in args], 100)
+		return call_method
+
+	def _expr_new(self, callee, args):
+		if callee != ('name', 'Date') or len(args) != 1:
+			raise JSCompileError('Unsupported object', callee)
+		arg = self._expr(args[0])
+
+		def new_date(frame):
+			date = unified_timestamp(arg(frame))
+			if date is None:
+				raise RuntimeError('Failed to parse date')
+			return int(date * 1000)
+		return new_date
+
+	def _expr_unary(self, op, arg):
+		arg = self._expr(arg)
+		if op == '!':
+			return lambda frame: not _js_ternary(arg(frame))
+		if op == '-':
+			return lambda frame: _js_neg(0, arg(frame))
+		if op == '+':
+			return lambda frame: _js_pos(0, arg(frame))
+		if op == '~':
+			return lambda frame: _js_inv(arg(frame), 0)
+		if op == 'typeof':
+			return lambda frame: _js_typeof(arg(frame))
+
+		def void(frame):
+			arg(frame)
+			return JSUndefined
+		return void
+
+	def _expr_binary(self, op, left, right):
+		opfunc, left, right = _BINARY_OPERATORS[op], self._expr(left), self._expr(right)
+		return lambda frame: opfunc(left(frame), right(frame))
+
+	def _expr_logical(self, op, left, right):
+		left, right = self._expr(left), self._expr(right)
+		if op == '??':
+			def logical(frame):
+				value = left(frame)
+				return right(frame) if value is None or value is JSUndefined else value
+		else:
+			is_and = op == '&&'
+
+			def logical(frame):
+				value = left(frame)
+				return value if is_and ^ _js_ternary(value) else right(frame)
+		return logical
+
+	def _expr_cond(self, test, if_true, if_false):
+		test, if_true, if_false = self._expr(test), self._expr(if_true), self._expr(if_false)
+		return lambda frame: (if_true if _js_ternary(test(frame)) else if_false)(frame)
+
+	def _reference(self, target):
+		""" Return reference, getter and setter functions of assignment target """
+		if target[0] == 'name':
+			return None, self._getter(target[1]), self._setter(target[1])
+
+		obj, prop = self._object(target[1]), self._expr(target[2])
+
+		def ref(frame):
+			idx = prop(frame)
+			return obj(frame), int(idx) if isinstance(idx, float) else idx
+		return ref, self._index, operator.setitem
+
+	def _expr_assign(self, op, target, value):
+		opfunc, value = op and _BINARY_OPERATORS[op], self._expr(value)
+		ref, getter, setter = self._reference(target)
+
+		def assign(frame):
+			target = ref(frame) if ref else (frame, )
+			if opfunc:
+				result = opfunc(getter(*target), value(frame))
+			else:
+				result = value(frame)
+			setter(*target + (result, ))
+			return result
+		return assign
+
+	def _expr_update(self, op, prefix, target):
+		delta = 1 if op == '++' else -1
+		ref, getter, setter = self._reference(target)
+
+		def update(frame):
+			target = ref(frame) if ref else (frame, )
+			old = getter(*target)
+			new = _js_add(old, delta)
+			setter(*target + (new, ))
+			return new if prefix else old
+		return update
+
+	def _expr_seq(self, exprs):
+		exprs = [self._expr(expr) for expr in exprs]
+
+		def seq(frame):
+			for expr in exprs:
+				value = expr(frame)
+			return value
+		return seq
+
+	def _expr_array(self, items):
+		items = [self._expr(item) for item in items]
+		return lambda frame: [item(frame) for item in items]
+
+	def _expr_object(self, items):
+		items = [(key, self._expr(value)) for key, value in items]
+		return lambda frame: dict((key, value(frame)) for key, value in items)
+
+	def _expr_func(self, name, params, body):
+		scope, body = self._compile_function(name, params, body)
+		return lambda frame: self._function(scope, body, frame[_FRAME_GLOBALS], frame)
@@ -8,9 +8,12 @@ from calendar import timegm
 from datetime import timedelta
 from datetime import datetime
 from email import utils
+from io import open
 from itertools import chain
 from json import dumps
 from json import loads
+from threading import local
+from time import time
 
 from .compat import compat_basestring
 from .compat import compat_chain_map
@@ -439,10 +442,87 @@ _UNARY_OPERATORS_X = (
 
 _OPERATOR_RE = '|'.join(compat_map(lambda x: re.escape(x[0]), _OPERATORS + _LOG_OPERATORS))
 
+# Functions of binary operators
+_OPERATOR_FUNCS = dict(_OPERATORS + _LOG_OPERATORS + _COMP_OPERATORS)
+
+# Functions of prefix operators, called with (None, operand)
+_PREFIX_FUNCS = dict(_UNARY_OPERATORS_X + (
+	('-', _js_arith_op(operator.sub)),
+	('+', _js_arith_op(operator.add)),
+	('!', _js_unary_op(lambda a: not _js_ternary(a))),
+))
+
+# Binding power of binary operators, : only ends the conditional expression
+# Ref: https://developer.mozilla.org/en-US/docs/Web/JavaScript/Reference/Operators/Operator_Precedence
+_OPERATOR_PRECEDENCE = {
+	':': 0,
+	'?': 1,
+	'??': 2, '||': 2,
+	'&&': 3,
+	'|': 4,
+	'^': 5,
+	'&': 6,
+	'==': 7, '!=': 7, '===': 7, '!==': 7,
+	'<': 8, '>': 8, '<=': 8, '>=': 8,
+	'<<': 9, '>>': 9,
+	'+': 10, '-': 10,
+	'*': 11, '/': 11, '%': 11,
+	'**': 12,
+}
+
+_EXPR_TOKEN_RE = re.compile(r'''(?sx)
+	(?P<space>\s+)|
+	(?P<comment>/\*.*?\*/)|
+	(?P<word>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|[\w$]+)|
+	(?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`(?:[^`\\]|\\.)*`)|
+	(?P<op>\?\?|\?\.|\|\||&&|===|!==|==|!=|<=|>=|<<|>>|\*\*|\+\+|--|=>|[-+*/%&|^!~?:<>=.,;])|
+	(?P<open>[(\[{])|
+	(?P<close>[)\]}])
+''')
+_REGEX_LITERAL_RE = re.compile(r'/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[a-z]*')
+_PREFIX_RE = re.compile(r'(?:void|typeof)\s+|[-+!](?![-+])')
+
 _NAME_RE = r'[a-zA-Z_$][\w$]*'
+
+# Definitions in the forms extract_function_code(), extract_variable_code() and extract_object() look for,
+# objects are only the ones starting with a function member
+_SYMBOL_RE = re.compile(r'''(?x)
+	(?:
+		function\s+(?P<func>{n})|
+		[{{;,]\s*(?P<assign_func>{n})\s*=\s*function|
+		(?:var|const|let)\s+(?P<var_func>{n})\s*=\s*function
+	)\s*\((?P<args>[^)]*)\)\s*(?={{)|
+	(?:\b(?:var|let|const)\s+|,\s*)(?P<var>{n})\s*=(?!=)(?P<var_object>(?={o}))?|
+	(?<![\w$.])(?P<object>{n})\s*=(?={o})
+'''.format(n=_NAME_RE, o=r'''\s*\{{\s*(?:{n}|"{n}"|'{n}')\s*:\s*function\b'''.format(n=_NAME_RE)))
+
+# Anonymous function expressions, replaced by named objects in extract_function_from_code()
+_FUNCTION_EXPR_RE = re.compile(r'function\((?P<args>[^)]*)\)\s*{')
+
 _MATCHING_PARENS = dict(zip(*zip('()', '{}', '[]')))
 _QUOTES = '\'"/'
 
+SCAN_CACHE_SIZE = 4096
+# Longer expressions, like the rest of the player code, are scanned without caching
+SCAN_CACHE_MAX_LENGTH = 65536
+
+# Tokens of JSInterpreter._scan(), an unterminated quote extends to the end
+_SCAN_TOKEN_RE = re.compile(r'''(?sx)
+	(?P<comment>/\*.*?\*/)|
+	(?P<quote>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+	(?P<unterminated>["'].*)|
+	(?P<open>[(\[{])|
+	(?P<close>[)\]}])|
+	(?P<slash>/)|
+	(?P<text>[^'"/()\[\]{}]+)
+''')
+_SCAN_REGEX_RE = re.compile(r'(?s)/(?:[^/\\\[]|\\.|\[(?:[^\]\\]|\\.)*\])*/')
+
+# Steps and seconds which one call of an extracted function may take, None for no limit.
+# Steps are interpreted statements and loop iterations of compiled code.
+STEP_BUDGET = 1000000
+TIME_BUDGET = 10.0
+
 
 class JSBreak(Exception):
 	pass
@@ -456,6 +536,18 @@ class JSThrow(Exception):
 	pass
 
 
+class JSBudgetExceeded(RuntimeError):
+	""" Evaluation took more steps or time than its budget, JavaScript catch does not stop it """
+	pass
+
+
+class _Budget(local):
+	""" Steps and deadline of the evaluation running in the thread """
+	active = False
+	steps = 0
+	deadline = None
+
+
 class LocalNameSpace(compat_chain_map):
 	def __getitem__(self, key):
 		try:
@@ -474,14 +566,67 @@ class LocalNameSpace(compat_chain_map):
 		return 'LocalNameSpace%s' % (self.maps, )
 
 
+class JSProfiler(object):
+	"""
+	Statements, regex calls and seconds of interpreted code by stack of constructs,
+	the constructs are function and method calls, if, try, switch and loops.
+	One profiler is used in one thread at a time.
+	"""
+	METRICS = ('statements', 'regex', 'time')
+
+	def __init__(self):
+		# Semicolon separated stack of constructs: [statements, regex calls, seconds]
+		self.stats = {}
+		self._stack = []
+
+	def _stat(self, key):
+		stat = self.stats.get(key)
+		if stat is None:
+			stat = self.stats[key] = [0, 0, 0.0]
+		return stat
+
+	def run(self, name, func, *args):
+		""" Return func(*args), the time it takes without nested constructs is the time of construct name """
+		stack = self._stack
+		frame = ['%s;%s' % (stack[-1][0], name) if stack else name, time(), 0.0]
+		stack.append(frame)
+		try:
+			return func(*args)
+		finally:
+			stack.pop()
+			elapsed = time() - frame[1]
+			self._stat(frame[0])[2] += elapsed - frame[2]
+			if stack:
+				stack[-1][2] += elapsed
+
+	def count(self, metric):
+		""" Count statement or regex call of the running construct """
+		self._stat(self._stack[-1][0] if self._stack else 'js')[self.METRICS.index(metric)] += 1
+
+	def write(self, filename, metric='time'):
+		""" Write collapsed stacks of metric for flamegraph.pl, time is in microseconds """
+		idx = self.METRICS.index(metric)
+		with open(filename, 'w', encoding='utf-8') as f:
+			for key, stat in sorted(self.stats.items()):
+				value = int(stat[idx] * 1000000) if metric == 'time' else stat[idx]
+				if value:
+					f.write('%s %d\n' % (key, value))
+
+
 class JSInterpreter(object):
 	__named_object_counter = 0
 
 	OP_CHARS = None
+	_scan_cache = {}
 
-	def __init__(self, code, objects=None):
+	def __init__(self, code, objects=None, symbols=None):
 		self.code, self._functions = code, {}
 		self._objects = {} if objects is None else objects
+		self._symbols = symbols
+		self.step_budget, self.time_budget = STEP_BUDGET, TIME_BUDGET
+		self._budget = _Budget()
+		# Set to JSProfiler() to profile the functions extracted after that
+		self.profiler = None
 		if type(self).OP_CHARS is None:
 			type(self).OP_CHARS = self.OP_CHARS = self.__op_chars()
 
@@ -500,74 +645,110 @@ class JSInterpreter(object):
 		namespace[name] = obj
 		return name
 
+	@classmethod
+	def _tokens(cls, expr, pos=0):
+		"""
+		Yield kind and text of tokens from pos on, and offset in the token from which it is
+		at the top level, not nested in brackets, quotes or comments started after pos.
+		"""
+		counters = dict.fromkeys(_MATCHING_PARENS.values(), 0)
+		top, after_op = True, True
+		while pos < len(expr):
+			m = _SCAN_TOKEN_RE.match(expr, pos)
+			kind, token = m.lastgroup, m.group()
+			if kind == 'slash' and after_op:
+				m = _SCAN_REGEX_RE.match(expr, pos)
+				kind, token = ('quote', m.group()) if m else ('unterminated', expr[pos:])
+			pos += len(token)
+			visible = len(token)
+			if kind == 'text' or kind == 'slash':
+				stripped = token.rstrip()
+				if stripped:
+					after_op = stripped[-1] in cls.OP_CHARS
+				if top:
+					visible = 0
+			elif kind == 'quote' or kind == 'close':
+				if kind == 'close':
+					counters[token] -= 1
+					top = not any(counters.values())
+				after_op = token[-1] in cls.OP_CHARS
+				if top:
+					# only the closing quote or bracket can be a delimiter
+					visible = len(token) - 1
+			elif kind == 'open':
+				counters[_MATCHING_PARENS[token]] += 1
+				top = not any(counters.values())
+				after_op = True
+			yield kind, token, visible
+
+	@classmethod
+	def _scan(cls, expr):
+		"""
+		Tokenize expression once, memoized per string.
+		Return expression with every character nested in brackets, quotes or comments
+		replaced by NUL, so that top level delimiters are found by str.find(), and comment spans.
+		"""
+		scanned = cls._scan_cache.get(expr)
+		if scanned is not None:
+			return scanned
+		masked, comments = [], []
+		pos = 0
+		for kind, token, visible in cls._tokens(expr):
+			if kind == 'comment':
+				comments.append((pos, pos + len(token)))
+			masked.append('\0' * visible + token[visible:])
+			pos += len(token)
+		scanned = ''.join(masked), comments
+		if len(expr) <= SCAN_CACHE_MAX_LENGTH:
+			if len(cls._scan_cache) >= SCAN_CACHE_SIZE:
+				cls._scan_cache.clear()
+			cls._scan_cache[expr] = scanned
+		return scanned
+
+	@classmethod
+	def _find_top(cls, code, delim, pos=0):
+		""" Return index of the first delimiter character at the top level from pos on, -1 if there is none """
+		for _, token, visible in cls._tokens(code, pos):
+			idx = token.find(delim, visible)
+			if idx >= 0:
+				return pos + idx
+			pos += len(token)
+		return -1
+
 	@classmethod
 	def _separate(cls, expr, delim=',', max_split=None, skip_delims=None):
 		if not expr:
 			return
-		# collections.Counter() is ~10% slower in both 2.7 and 3.9
-		counters = {k: 0 for k in _MATCHING_PARENS.values()}
-		start, splits, pos, delim_len = 0, 0, 0, len(delim) - 1
-		in_quote, escaping, after_op, in_regex_char_group = None, False, True, False
-		skipping = 0
+		masked, comments = cls._scan(expr)
+
+		def piece(start, end):
+			# comments are left out of the separated parts
+			parts = []
+			for c_start, c_end in comments:
+				if start <= c_start and c_end <= end:
+					parts.append(expr[start:c_start])
+					start = c_end
+			parts.append(expr[start:end])
+			return ''.join(parts)
+
 		if skip_delims and not isinstance(skip_delims, tuple):
 			skip_delims = (skip_delims,)
-		skip_txt = None
-		for idx, char in enumerate(expr):
-			if skip_txt and idx <= skip_txt[1]:
-				continue
-			paren_delta = 0
-			if not in_quote:
-				if char == '/' and expr[idx:idx + 2] == '/*':
-					# skip a comment
-					skip_txt = expr[idx:].find('*/', 2)
-					skip_txt = [idx, idx + skip_txt + 1] if skip_txt >= 2 else None
-					if skip_txt:
-						continue
-				if char in _MATCHING_PARENS:
-					counters[_MATCHING_PARENS[char]] += 1
-					paren_delta = 1
-				elif char in counters:
-					counters[char] -= 1
-					paren_delta = -1
-			if not escaping:
-				if char in _QUOTES and in_quote in (char, None):
-					if in_quote or after_op or char != '/':
-						in_quote = None if in_quote and not in_regex_char_group else char
-				elif in_quote == '/' and char in '[]':
-					in_regex_char_group = char == '['
-			escaping = not escaping and in_quote and char == '\\'
-			after_op = not in_quote and (char in cls.OP_CHARS or paren_delta > 0 or (after_op and char.isspace()))
-
-			if char != delim[pos] or any(counters.values()) or in_quote:
-				pos = skipping = 0
-				continue
-			elif skipping > 0:
-				skipping -= 1
-				continue
-			elif pos == 0 and skip_delims:
-				here = expr[idx:]
-				for s in skip_delims:
-					if here.startswith(s) and s:
-						skipping = len(s) - 1
-						break
-				if skipping > 0:
-					continue
-			if pos < delim_len:
-				pos += 1
+		start = pos = splits = 0
+		while True:
+			idx = masked.find(delim, pos)
+			if idx < 0:
+				break
+			pos = idx + len(delim)
+			skip = next((s for s in skip_delims or () if s and expr.startswith(s, idx)), None)
+			if skip:
+				pos = idx + len(skip)
 				continue
-			if skip_txt and skip_txt[0] >= start and skip_txt[1] <= idx - delim_len:
-				yield expr[start:skip_txt[0]] + expr[skip_txt[1] + 1: idx - delim_len]
-			else:
-				yield expr[start: idx - delim_len]
-			skip_txt = None
-			start, pos = idx + 1, 0
+			yield piece(start, idx)
+			start = pos
 			splits += 1
 			if max_split and splits >= max_split:
 				break
-		if skip_txt and skip_txt[0] >= start:
-			yield expr[start:skip_txt[0]] + expr[skip_txt[1] + 1:]
-		else:
-			yield expr[start:]
+		yield piece(start, len(expr))
 
 	@classmethod
 	def _separate_at_paren(cls, expr, delim=None):
@@ -598,12 +779,14 @@ class JSInterpreter(object):
 			right_expr = _js_ternary(left_val, *self._separate(right_expr, ':', 1))
 
 		right_val = self.interpret_expression(right_expr, local_vars, allow_recursion)
-		opfunc = op and next((v for k, v in self._all_operators() if k == op), None)
-		if not opfunc:
+		if op not in _OPERATOR_FUNCS:
 			return right_val
+		return self._binary_operator(op, left_val, right_val)
 
+	@staticmethod
+	def _binary_operator(op, left_val, right_val):
 		try:
-			return opfunc(left_val, right_val)
+			return _OPERATOR_FUNCS[op](left_val, right_val)
 		except Exception as e:
 			raise RuntimeError('Failed to evaluate', left_val, op, right_val, e)
 
@@ -635,56 +818,115 @@ class JSInterpreter(object):
 	_FINALLY_RE = re.compile(r'finally\s*\{')
 	_SWITCH_RE = re.compile(r'switch\s*\(')
 
-	def handle_operators(self, expr, local_vars, allow_recursion):
-
-		for op, _ in self._all_operators():
-			# hackety: </> have higher priority than <</>>, but don't confuse them
-			skip_delim = (op + op) if op in '<>*?' else None
+	@staticmethod
+	def _split_operators(expr):
+		"""
+		Split expression in one pass at binary operators outside of brackets.
+		Return [operand, op, operand, ...] or None if expression is not an operator expression.
+		"""
+		items, pieces = [], []
+		start = pos = depth = conditionals = 0
+		expect_operand = True
+		while pos < len(expr):
+			m = _EXPR_TOKEN_RE.match(expr, pos)
+			if m and expect_operand and m.group() == '/':
+				m = _REGEX_LITERAL_RE.match(expr, pos)
+			if not m:
+				return None
+			kind, value, pos = m.lastgroup, m.group(), m.end()
+			if kind == 'space':
+				continue
+			if kind == 'comment':
+				pieces.append(expr[start:m.start()])
+				start = pos
+			elif kind == 'open':
+				depth += 1
+				expect_operand = True
+			elif kind == 'close':
+				depth -= 1
+				if depth < 0:
+					return None
+				expect_operand = False
+			elif kind != 'op':
+				# void and typeof are prefix operators, regular expression literal is matched without group
+				expect_operand = value in ('void', 'typeof')
+			elif value in ('.', '?.'):
+				expect_operand = True
+			elif value in ('++', '--'):
+				continue
+			elif depth:
+				expect_operand = True
+			elif expect_operand:
+				if value not in ('-', '+', '!', '~'):
+					return None
+			elif value not in _OPERATOR_PRECEDENCE or (value == ':' and not conditionals):
+				return None
+			else:
+				conditionals += {'?': 1, ':': -1}.get(value, 0)
+				items.append((''.join(pieces) + expr[start:m.start()]).strip())
+				items.append(value)
+				pieces, start = [], pos
+				expect_operand = True
+		if depth or conditionals:
+			return None
+		items.append((''.join(pieces) + expr[start:]).strip())
+		if not all(items):
+			return None
+		return items
+
+	def _evaluate_operators(self, items, pos, min_precedence, local_vars, allow_recursion, skip=False):
+		""" Precedence climbing over split expression, skipped operands are not evaluated """
+		value = None if skip else self.interpret_expression(items[pos], local_vars, allow_recursion)
+		pos += 1
+		while pos < len(items):
+			op = items[pos]
+			precedence = _OPERATOR_PRECEDENCE[op]
+			if precedence < min_precedence:
+				break
 			if op == '?':
-				skip_delim = (skip_delim, '?.')
-			separated = list(self._separate(expr, op, skip_delims=skip_delim))
-			if len(separated) < 2:
+				cndn = _js_ternary(value)
+				if_true, pos = self._evaluate_operators(
+					items, pos + 1, precedence, local_vars, allow_recursion, skip or not cndn)
+				if_false, pos = self._evaluate_operators(
+					items, pos + 1, precedence, local_vars, allow_recursion, skip or cndn)
+				value = if_true if cndn else if_false
 				continue
+			if op in ('||', '&&', '??'):
+				if op == '??':
+					short = value not in (None, JSUndefined)
+				else:
+					short = (op == '&&') ^ _js_ternary(value)
+				right, pos = self._evaluate_operators(
+					items, pos + 1, precedence + 1, local_vars, allow_recursion, skip or short)
+				if not short:
+					value = right
+				continue
+			# ** is right associative
+			right, pos = self._evaluate_operators(
+				items, pos + 1, precedence + (op != '**'), local_vars, allow_recursion, skip)
+			if not skip:
+				value = self._binary_operator(op, value, right)
+		return value, pos
 
-			right_expr = separated.pop()
-			# handle operators that are both unary and binary, minimal BODMAS
-			if op in ('+', '-'):
-				# simplify/adjust consecutive instances of these operators
-				undone = 0
-				separated = [s.strip() for s in separated]
-				while len(separated) > 1 and not separated[-1]:
-					undone += 1
-					separated.pop()
-				if op == '-' and undone % 2 != 0:
-					right_expr = op + right_expr
-				elif op == '+':
-					while len(separated) > 1 and set(separated[-1]) <= self.OP_CHARS:
-						right_expr = separated.pop() + right_expr
-					if separated[-1][-1:] in self.OP_CHARS:
-						right_expr = separated.pop() + right_expr
-				# hanging op at end of left => unary + (strip) or - (push right)
-				left_val = separated[-1] if separated else ''
-				for dm_op in ('*', '%', '/', '**'):
-					bodmas = tuple(self._separate(left_val, dm_op, skip_delims=skip_delim))
-					if len(bodmas) > 1 and not bodmas[-1].strip():
-						expr = op.join(separated) + op + right_expr
-						if len(separated) > 1:
-							separated.pop()
-							right_expr = op.join((left_val, right_expr))
-						else:
-							separated = [op.join((left_val, right_expr))]
-							right_expr = None
-						break
-				if right_expr is None:
-					continue
-
-			left_val = self.interpret_expression(op.join(separated), local_vars, allow_recursion)
-			return self._operator(op, left_val, right_expr, local_vars, allow_recursion), True
+	def handle_operators(self, expr, local_vars, allow_recursion):
+		items = self._split_operators(expr)
+		if not items:
+			return None
+		if len(items) == 1:
+			m = _PREFIX_RE.match(expr)
+			if not m:
+				return None
+			operand = self.interpret_expression(expr[m.end():], local_vars, allow_recursion)
+			return _PREFIX_FUNCS[m.group().strip()](None, operand), True
+		return self._evaluate_operators(items, 0, 1, local_vars, allow_recursion)[0], True
 
 	def interpret_statement(self, stmt, local_vars, allow_recursion=100):
 		if allow_recursion < 0:
 			raise RuntimeError('Recursion limit reached')
 		allow_recursion -= 1
+		self._spend()
+		if self.profiler:
+			self.profiler.count('statements')
 
 		should_return = False
 		# fails on (eg) if (...) stmt1; else stmt2;
@@ -695,7 +937,7 @@ class JSInterpreter(object):
 			if should_return:
 				return ret, should_return
 
-		m = self._VAR_RET_THROW_RE.match(stmt)
+		m = self._regex(self._VAR_RET_THROW_RE.match, stmt)
 		if m:
 			expr = stmt[len(m.group(0)):].strip()
 			if m.group('throw'):
@@ -709,7 +951,7 @@ class JSInterpreter(object):
 			if expr[0] == '/':
 				inner = re.compile(inner[1:].replace('[[', r'[\['))
 			else:
-				inner = loads(js_to_json(inner + expr[0]))
+				inner = loads(self._regex(js_to_json, inner + expr[0]))
 			if not outer:
 				return inner, should_return
 			expr = self._named_object(local_vars, inner) + outer
@@ -743,7 +985,7 @@ class JSInterpreter(object):
 			if all(len(sub_expr) == 2 for sub_expr in sub_expressions):
 				def dict_item(key, val):
 					val = self.interpret_expression(val, local_vars, allow_recursion)
-					if re.match(_NAME_RE, key):
+					if self._regex(re.match, _NAME_RE, key):
 						return key, val
 					return self.interpret_expression(key, local_vars, allow_recursion), val
 
@@ -756,7 +998,7 @@ class JSInterpreter(object):
 				expr = self._dump(inner, local_vars) + outer
 
 		if expr.startswith('('):
-			m = re.match(r'\((?P<d>[a-z])%(?P<e>[a-z])\.length\+(?P=e)\.length\)%(?P=e)\.length', expr)
+			m = self._regex(re.match, r'\((?P<d>[a-z])%(?P<e>[a-z])\.length\+(?P=e)\.length\)%(?P=e)\.length', expr)
 			if m:
 				# short-cut eval of frequently used `(d%e.length+e.length)%e.length`, worth ~6% on `pytest -k test_nsig`
 				outer = None
@@ -776,131 +1018,15 @@ class JSInterpreter(object):
 				for item in self._separate(inner)])
 			expr = name + outer
 
-		m = self._COMPOUND_RE.match(expr)
-		md = m.groupdict() if m else {}
-		if md.get('if'):
-			cndn, expr = self._separate_at_paren(expr[m.end() - 1:])
-			if expr.startswith('{'):
-				if_expr, expr = self._separate_at_paren(expr)
+		m = self._regex(self._COMPOUND_RE.match, expr)
+		if m:
+			if self.profiler:
+				ret, should_abort, expr = self.profiler.run(
+					m.lastgroup, self._interpret_compound, m, expr, local_vars, allow_recursion)
 			else:
-				# may lose ... else ... because of ll.368-374
-				if_expr, expr = self._separate_at_paren(' %s;' % (expr,), delim=';')
-			else_expr = None
-			m = re.match(r'else\s*(?P<block>\{)?', expr)
-			if m:
-				if m.group('block'):
-					else_expr, expr = self._separate_at_paren(expr[m.end() - 1:])
-				else:
-					# handle subset ... else if (...) {...} else ...
-					exprs = list(self._separate(expr[m.end():], delim='}', max_split=2))
-					if len(exprs) > 1:
-						if re.match(r'\s*if\s*\(', exprs[0]) and re.match(r'\s*else\b', exprs[1]):
-							else_expr = exprs[0] + '}' + exprs[1]
-							expr = (exprs[2] + '}') if len(exprs) == 3 else None
-						else:
-							else_expr = exprs[0]
-							exprs.append('')
-							expr = '}'.join(exprs[1:])
-					else:
-						else_expr = exprs[0]
-						expr = None
-					else_expr = else_expr.lstrip() + '}'
-			cndn = _js_ternary(self.interpret_expression(cndn, local_vars, allow_recursion))
-			ret, should_abort = self.interpret_statement(
-				if_expr if cndn else else_expr, local_vars, allow_recursion)
-			if should_abort:
-				return ret, True
-
-		elif md.get('try'):
-			try_expr, expr = self._separate_at_paren(expr[m.end() - 1:])
-			err = None
-			try:
-				ret, should_abort = self.interpret_statement(try_expr, local_vars, allow_recursion)
-				if should_abort:
-					return ret, True
-			except Exception as e:
-				# This works for now, but makes debugging future issues very hard
-				err = e
-
-			pending = (None, False)
-			m = re.match(r'catch\s*(?P<err>\(\s*{_NAME_RE}\s*\))?\{{'.format(**globals()), expr)
-			if m:
-				sub_expr, expr = self._separate_at_paren(expr[m.end() - 1:])
-				if err:
-					catch_vars = {}
-					if m.group('err'):
-						catch_vars[m.group('err')] = err
-					catch_vars = local_vars.new_child(m=catch_vars)
-					err, pending = None, self.interpret_statement(sub_expr, catch_vars, allow_recursion)
-
-			m = self._FINALLY_RE.match(expr)
-			if m:
-				sub_expr, expr = self._separate_at_paren(expr[m.end() - 1:])
-				ret, should_abort = self.interpret_statement(sub_expr, local_vars, allow_recursion)
-				if should_abort:
-					return ret, True
-
-			ret, should_abort = pending
+				ret, should_abort, expr = self._interpret_compound(m, expr, local_vars, allow_recursion)
 			if should_abort:
 				return ret, True
-
-			if err:
-				raise err
-
-		elif md.get('for') or md.get('while'):
-			init_or_cond, remaining = self._separate_at_paren(expr[m.end() - 1:])
-			if remaining.startswith('{'):
-				body, expr = self._separate_at_paren(remaining)
-			else:
-				switch_m = self._SWITCH_RE.match(remaining)
-				if switch_m:
-					switch_val, remaining = self._separate_at_paren(remaining[switch_m.end() - 1:])
-					body, expr = self._separate_at_paren(remaining, '}')
-					body = 'switch(%s){%s}' % (switch_val, body)
-				else:
-					body, expr = remaining, ''
-			if md.get('for'):
-				start, cndn, increment = self._separate(init_or_cond, ';')
-				self.interpret_expression(start, local_vars, allow_recursion)
-			else:
-				cndn, increment = init_or_cond, None
-			while _js_ternary(self.interpret_expression(cndn, local_vars, allow_recursion)):
-				try:
-					ret, should_abort = self.interpret_statement(body, local_vars, allow_recursion)
-					if should_abort:
-						return ret, True
-				except JSBreak:
-					break
-				except JSContinue:
-					pass
-				if increment:
-					self.interpret_expression(increment, local_vars, allow_recursion)
-
-		elif md.get('switch'):
-			switch_val, remaining = self._separate_at_paren(expr[m.end() - 1:])
-			switch_val = self.interpret_expression(switch_val, local_vars, allow_recursion)
-			body, expr = self._separate_at_paren(remaining, '}')
-			items = body.replace('default:', 'case default:').split('case ')[1:]
-			for default in (False, True):
-				matched = False
-				for item in items:
-					case, stmt = (i.strip() for i in self._separate(item, ':', 1))
-					if default:
-						matched = matched or case == 'default'
-					elif not matched:
-						matched = (case != 'default' and switch_val == self.interpret_expression(case, local_vars, allow_recursion))
-					if not matched:
-						continue
-					try:
-						ret, should_abort = self.interpret_statement(stmt, local_vars, allow_recursion)
-						if should_abort:
-							return ret
-					except JSBreak:
-						break
-				if matched:
-					break
-
-		if md:
 			ret, should_abort = self.interpret_statement(expr, local_vars, allow_recursion)
 			return ret, should_abort or should_return
 
@@ -913,7 +1039,7 @@ class JSInterpreter(object):
 					return ret, True
 			return ret, False
 
-		for m in re.finditer(r'''(?x)
+		for m in self._regex(re.finditer, r'''(?x)
 				(?P<pre_sign>\+\+|--)(?P<var1>{_NAME_RE})|
 				(?P<var2>{_NAME_RE})(?P<post_sign>\+\+|--)'''.format(**globals()), expr):
 			var = m.group('var1') or m.group('var2')
@@ -928,7 +1054,7 @@ class JSInterpreter(object):
 		if not expr:
 			return None, should_return
 
-		m = re.match(r'''(?x)
+		m = self._regex(re.match, r'''(?x)
 			(?P<assign>
 				(?P<out>{_NAME_RE})(?:\[(?P<out_idx>(?:.+?\]\s*\[)*.+?)\])?\s*
 				(?P<op>{_OPERATOR_RE})?
@@ -984,7 +1110,7 @@ class JSInterpreter(object):
 			return local_vars[m.group('name')], should_return
 
 		try:
-			ret = loads(js_to_json(expr))
+			ret = loads(self._regex(js_to_json, expr))
 			if not md.get('attribute'):
 				return ret, should_return
 		except ValueError:
@@ -1011,22 +1137,10 @@ class JSInterpreter(object):
 			else:
 				arg_str, remaining = None, arg_str
 
-			def assertion(cndn, msg):
-				""" assert, but without risk of getting optimized out """
-				if not cndn:
-					raise RuntimeError('{0} {1}'.format(member, msg))
-
 			def eval_method(variable, member):
 				if (variable, member) == ('console', 'debug'):
 					return
 
-				ARG_MSG = 'takes one or more arguments'
-				ARG_TWO_MSG = 'takes two arguments'
-				ARG_NOT_MSG = 'does not take any arguments'
-				ARG_2_MSG = 'takes at most 2 arguments'
-				LIST_MSG = 'must be applied on a list'
-				STR_MSG = 'must be applied on a string'
-
 				types = {
 					'String': compat_str,
 					'Math': float,
@@ -1056,144 +1170,322 @@ class JSInterpreter(object):
 				argvals = [
 					self.interpret_expression(v, local_vars, allow_recursion)
 					for v in self._separate(arg_str)]
+				return self._call_method(obj, member, argvals, allow_recursion)
 
-				# Fixup prototype call
-				if isinstance(obj, type):
-					new_member, rest = member.partition('.')[0::2]
-					if new_member == 'prototype':
-						new_member, func_prototype = rest.partition('.')[0::2]
-						assertion(argvals, ARG_MSG)
-						assertion(isinstance(argvals[0], obj), 'must bind to type {0}'.format(obj))
-						if func_prototype == 'call':
-							obj = argvals.pop(0)
-						elif func_prototype == 'apply':
-							assertion(len(argvals) == 2, ARG_TWO_MSG)
-							obj, argvals = argvals
-							assertion(isinstance(argvals, list), 'second argument must be a list')
-						else:
-							raise RuntimeError('Unsupported Function method', func_prototype)
-						member = new_member
-
-				if obj is compat_str:
-					if member == 'fromCharCode':
-						assertion(argvals, ARG_MSG)
-						return ''.join(compat_chr(int(n)) for n in argvals)
-					raise RuntimeError('Unsupported string method', member)
-				elif obj is float:
-					if member == 'pow':
-						assertion(len(argvals) == 2, ARG_TWO_MSG)
-						return argvals[0] ** argvals[1]
-					raise RuntimeError('Unsupported Math method', member)
-
-				if member == 'split':
-					assertion(len(argvals) <= 2, 'takes at most two arguments')
-					return obj.split(argvals[0]) if argvals[0] else list(obj)
-				elif member == 'join':
-					assertion(isinstance(obj, list), LIST_MSG)
-					assertion(len(argvals) <= 1, 'takes at most one argument')
-					return (',' if len(argvals) == 0 else argvals[0]).join(
-						('' if x in (None, JSUndefined) else _js_to_string(x))
-						for x in obj)
-				elif member == 'reverse':
-					assertion(not argvals, ARG_NOT_MSG)
-					obj.reverse()
-					return obj
-				elif member == 'slice':
-					assertion(isinstance(obj, (list, str, compat_str)), 'must be applied on a list or string')
-					# From [1]:
-					# .slice() - like [:]
-					# .slice(n) - like [n:] (not [slice(n)]
-					# .slice(m, n) - like [m:n] or [slice(m, n)]
-					# [1] https://developer.mozilla.org/en-US/docs/Web/JavaScript/Reference/Global_Objects/Array/slice
-					assertion(len(argvals) <= 2, 'takes between 0 and 2 arguments')
-					if len(argvals) < 2:
-						argvals += (None,)
-					return obj[slice(*argvals)]
-				elif member == 'splice':
-					assertion(isinstance(obj, list), LIST_MSG)
-					assertion(argvals, ARG_MSG)
-					index, how_many = compat_map(int, (argvals + [len(obj)])[:2])
-					if index < 0:
-						index += len(obj)
-					res = [obj.pop(index) for _ in range(index, min(index + how_many, len(obj)))]
-					obj[index:index] = argvals[2:]
-					return res
-				elif member in ('shift', 'pop'):
-					assertion(isinstance(obj, list), LIST_MSG)
-					assertion(not argvals, ARG_NOT_MSG)
-					if len(obj) > 0:
-						return obj.pop(0 if member == 'shift' else -1)
-					return JSUndefined
-				elif member == 'unshift':
-					assertion(isinstance(obj, list), LIST_MSG)
-					# not enforced: assertion(argvals, ARG_MSG)
-					obj[0:0] = argvals
-					return len(obj)
-				elif member == 'push':
-					# not enforced: assertion(argvals, ARG_MSG)
-					obj.extend(argvals)
-					return len(obj)
-				elif member == 'forEach':
-					assertion(argvals, ARG_MSG)
-					assertion(len(argvals) <= 2, ARG_2_MSG)
-					f, this = (argvals + [''])[:2]
-					return [f((item, idx, obj), {'this': this}, allow_recursion) for idx, item in enumerate(obj)]
-				elif member == 'indexOf':
-					assertion(argvals, ARG_MSG)
-					assertion(len(argvals) <= 2, ARG_2_MSG)
-					idx, start = (argvals + [0])[:2]
-					try:
-						return obj.index(idx, start)
-					except ValueError:
-						return -1
-				elif member == 'charCodeAt':
-					assertion(isinstance(obj, (str, compat_str)), STR_MSG)
-					# assertion(len(argvals) == 1, 'takes exactly one argument') # but not enforced
-					idx = argvals[0] if len(argvals) > 0 and isinstance(argvals[0], int) else 0
-					if idx >= len(obj):
-						return None
-					return ord(obj[idx])
-
-				idx = int(member) if isinstance(obj, list) else member
-				return obj[idx](argvals, allow_recursion=allow_recursion)
-
+			if self.profiler and arg_str is not None:
+				ret = self.profiler.run('%s.%s()' % (variable, member), eval_method, variable, member)
+			else:
+				ret = eval_method(variable, member)
 			if remaining:
 				ret, should_abort = self.interpret_statement(
-					self._named_object(local_vars, eval_method(variable, member)) + remaining,
+					self._named_object(local_vars, ret) + remaining,
 					local_vars, allow_recursion)
 				return ret, should_return or should_abort
 			else:
-				return eval_method(variable, member), should_return
+				return ret, should_return
 
 		elif md.get('function'):
 			fname = m.group('fname')
 			argvals = [self.interpret_expression(v, local_vars, allow_recursion) for v in self._separate(m.group('args'))]
 			if fname in local_vars:
-				return local_vars[fname](argvals, allow_recursion=allow_recursion), should_return
-			elif fname not in self._functions:
-				self._functions[fname] = self.extract_function_from_code(*self.extract_function_code(fname))
-			return self._functions[fname](argvals, allow_recursion=allow_recursion), should_return
+				func = local_vars[fname]
+			else:
+				if fname not in self._functions:
+					self._functions[fname] = self.extract_function_from_code(*self.extract_function_code(fname))
+				func = self._functions[fname]
+			if self.profiler:
+				return self.profiler.run(fname + '()', func, argvals, None, allow_recursion), should_return
+			return func(argvals, allow_recursion=allow_recursion), should_return
 
 		raise RuntimeError('Unsupported JS expression', expr[:40])
 
+	def _interpret_compound(self, m, expr, local_vars, allow_recursion):
+		""" Run if, try, loop or switch statement matched by _COMPOUND_RE, return (value, should_abort, rest of expr) """
+		md = m.groupdict()
+		if md.get('if'):
+			cndn, expr = self._separate_at_paren(expr[m.end() - 1:])
+			if expr.startswith('{'):
+				if_expr, expr = self._separate_at_paren(expr)
+			else:
+				# may lose ... else ... because of ll.368-374
+				if_expr, expr = self._separate_at_paren(' %s;' % (expr,), delim=';')
+			else_expr = None
+			m = self._regex(re.match, r'else\s*(?P<block>\{)?', expr)
+			if m:
+				if m.group('block'):
+					else_expr, expr = self._separate_at_paren(expr[m.end() - 1:])
+				else:
+					# handle subset ... else if (...) {...} else ...
+					exprs = list(self._separate(expr[m.end():], delim='}', max_split=2))
+					if len(exprs) > 1:
+						if self._regex(re.match, r'\s*if\s*\(', exprs[0]) and self._regex(re.match, r'\s*else\b', exprs[1]):
+							else_expr = exprs[0] + '}' + exprs[1]
+							expr = (exprs[2] + '}') if len(exprs) == 3 else None
+						else:
+							else_expr = exprs[0]
+							exprs.append('')
+							expr = '}'.join(exprs[1:])
+					else:
+						else_expr = exprs[0]
+						expr = None
+					else_expr = else_expr.lstrip() + '}'
+			cndn = _js_ternary(self.interpret_expression(cndn, local_vars, allow_recursion))
+			ret, should_abort = self.interpret_statement(
+				if_expr if cndn else else_expr, local_vars, allow_recursion)
+			if should_abort:
+				return ret, True, None
+
+		elif md.get('try'):
+			try_expr, expr = self._separate_at_paren(expr[m.end() - 1:])
+			err = None
+			try:
+				ret, should_abort = self.interpret_statement(try_expr, local_vars, allow_recursion)
+				if should_abort:
+					return ret, True, None
+			except JSBudgetExceeded:
+				raise
+			except Exception as e:
+				# This works for now, but makes debugging future issues very hard
+				err = e
+
+			pending = (None, False)
+			m = self._regex(re.match, r'catch\s*(?P<err>\(\s*{_NAME_RE}\s*\))?\{{'.format(**globals()), expr)
+			if m:
+				sub_expr, expr = self._separate_at_paren(expr[m.end() - 1:])
+				if err:
+					catch_vars = {}
+					if m.group('err'):
+						catch_vars[m.group('err')] = err
+					catch_vars = local_vars.new_child(m=catch_vars)
+					err, pending = None, self.interpret_statement(sub_expr, catch_vars, allow_recursion)
+
+			m = self._regex(self._FINALLY_RE.match, expr)
+			if m:
+				sub_expr, expr = self._separate_at_paren(expr[m.end() - 1:])
+				ret, should_abort = self.interpret_statement(sub_expr, local_vars, allow_recursion)
+				if should_abort:
+					return ret, True, None
+
+			ret, should_abort = pending
+			if should_abort:
+				return ret, True, None
+
+			if err:
+				raise err
+
+		elif md.get('for') or md.get('while'):
+			init_or_cond, remaining = self._separate_at_paren(expr[m.end() - 1:])
+			if remaining.startswith('{'):
+				body, expr = self._separate_at_paren(remaining)
+			else:
+				switch_m = self._regex(self._SWITCH_RE.match, remaining)
+				if switch_m:
+					switch_val, remaining = self._separate_at_paren(remaining[switch_m.end() - 1:])
+					body, expr = self._separate_at_paren(remaining, '}')
+					body = 'switch(%s){%s}' % (switch_val, body)
+				else:
+					body, expr = remaining, ''
+			if md.get('for'):
+				start, cndn, increment = self._separate(init_or_cond, ';')
+				self.interpret_expression(start, local_vars, allow_recursion)
+			else:
+				cndn, increment = init_or_cond, None
+			while _js_ternary(self.interpret_expression(cndn, local_vars, allow_recursion)):
+				try:
+					ret, should_abort = self.interpret_statement(body, local_vars, allow_recursion)
+					if should_abort:
+						return ret, True, None
+				except JSBreak:
+					break
+				except JSContinue:
+					pass
+				if increment:
+					self.interpret_expression(increment, local_vars, allow_recursion)
+
+		elif md.get('switch'):
+			switch_val, remaining = self._separate_at_paren(expr[m.end() - 1:])
+			switch_val = self.interpret_expression(switch_val, local_vars, allow_recursion)
+			body, expr = self._separate_at_paren(remaining, '}')
+			items = body.replace('default:', 'case default:').split('case ')[1:]
+			for default in (False, True):
+				matched = False
+				for item in items:
+					case, stmt = (i.strip() for i in self._separate(item, ':', 1))
+					if default:
+						matched = matched or case == 'default'
+					elif not matched:
+						matched = (case != 'default' and switch_val == self.interpret_expression(case, local_vars, allow_recursion))
+					if not matched:
+						continue
+					try:
+						ret, should_abort = self.interpret_statement(stmt, local_vars, allow_recursion)
+						if should_abort:
+							return ret, True, None
+					except JSBreak:
+						break
+				if matched:
+					break
+
+		return None, False, expr
+
+	def _call_method(self, obj, member, argvals, allow_recursion):
+		""" Call builtin method or function member of obj with evaluated arguments """
+		ARG_MSG = 'takes one or more arguments'
+		ARG_TWO_MSG = 'takes two arguments'
+		ARG_NOT_MSG = 'does not take any arguments'
+		ARG_2_MSG = 'takes at most 2 arguments'
+		LIST_MSG = 'must be applied on a list'
+		STR_MSG = 'must be applied on a string'
+
+		def assertion(cndn, msg):
+			""" assert, but without risk of getting optimized out """
+			if not cndn:
+				raise RuntimeError('{0} {1}'.format(member, msg))
+
+		# Fixup prototype call
+		if isinstance(obj, type):
+			new_member, rest = member.partition('.')[0::2]
+			if new_member == 'prototype':
+				new_member, func_prototype = rest.partition('.')[0::2]
+				assertion(argvals, ARG_MSG)
+				assertion(isinstance(argvals[0], obj), 'must bind to type {0}'.format(obj))
+				if func_prototype == 'call':
+					obj = argvals.pop(0)
+				elif func_prototype == 'apply':
+					assertion(len(argvals) == 2, ARG_TWO_MSG)
+					obj, argvals = argvals
+					assertion(isinstance(argvals, list), 'second argument must be a list')
+				else:
+					raise RuntimeError('Unsupported Function method', func_prototype)
+				member = new_member
+
+		if obj is compat_str:
+			if member == 'fromCharCode':
+				assertion(argvals, ARG_MSG)
+				return ''.join(compat_chr(int(n)) for n in argvals)
+			raise RuntimeError('Unsupported string method', member)
+		elif obj is float:
+			if member == 'pow':
+				assertion(len(argvals) == 2, ARG_TWO_MSG)
+				return argvals[0] ** argvals[1]
+			raise RuntimeError('Unsupported Math method', member)
+
+		if member == 'split':
+			assertion(len(argvals) <= 2, 'takes at most two arguments')
+			return obj.split(argvals[0]) if argvals[0] else list(obj)
+		elif member == 'join':
+			assertion(isinstance(obj, list), LIST_MSG)
+			assertion(len(argvals) <= 1, 'takes at most one argument')
+			return (',' if len(argvals) == 0 else argvals[0]).join(
+				('' if x in (None, JSUndefined) else _js_to_string(x))
+				for x in obj)
+		elif member == 'reverse':
+			assertion(not argvals, ARG_NOT_MSG)
+			obj.reverse()
+			return obj
+		elif member == 'slice':
+			assertion(isinstance(obj, (list, str, compat_str)), 'must be applied on a list or string')
+			# From [1]:
+			# .slice() - like [:]
+			# .slice(n) - like [n:] (not [slice(n)]
+			# .slice(m, n) - like [m:n] or [slice(m, n)]
+			# [1] https://developer.mozilla.org/en-US/docs/Web/JavaScript/Reference/Global_Objects/Array/slice
+			assertion(len(argvals) <= 2, 'takes between 0 and 2 arguments')
+			if len(argvals) < 2:
+				argvals += (None,)
+			return obj[slice(*argvals)]
+		elif member == 'splice':
+			assertion(isinstance(obj, list), LIST_MSG)
+			assertion(argvals, ARG_MSG)
+			index, how_many = compat_map(int, (argvals + [len(obj)])[:2])
+			if index < 0:
+				index += len(obj)
+			res = [obj.pop(index) for _ in range(index, min(index + how_many, len(obj)))]
+			obj[index:index] = argvals[2:]
+			return res
+		elif member in ('shift', 'pop'):
+			assertion(isinstance(obj, list), LIST_MSG)
+			assertion(not argvals, ARG_NOT_MSG)
+			if len(obj) > 0:
+				return obj.pop(0 if member == 'shift' else -1)
+			return JSUndefined
+		elif member == 'unshift':
+			assertion(isinstance(obj, list), LIST_MSG)
+			# not enforced: assertion(argvals, ARG_MSG)
+			obj[0:0] = argvals
+			return len(obj)
+		elif member == 'push':
+			# not enforced: assertion(argvals, ARG_MSG)
+			obj.extend(argvals)
+			return len(obj)
+		elif member == 'forEach':
+			assertion(argvals, ARG_MSG)
+			assertion(len(argvals) <= 2, ARG_2_MSG)
+			f, this = (argvals + [''])[:2]
+			return [f((item, idx, obj), {'this': this}, allow_recursion) for idx, item in enumerate(obj)]
+		elif member == 'indexOf':
+			assertion(argvals, ARG_MSG)
+			assertion(len(argvals) <= 2, ARG_2_MSG)
+			idx, start = (argvals + [0])[:2]
+			try:
+				return obj.index(idx, start)
+			except ValueError:
+				return -1
+		elif member == 'charCodeAt':
+			assertion(isinstance(obj, (str, compat_str)), STR_MSG)
+			# assertion(len(argvals) == 1, 'takes exactly one argument') # but not enforced
+			idx = argvals[0] if len(argvals) > 0 and isinstance(argvals[0], int) else 0
+			if idx >= len(obj):
+				return None
+			return ord(obj[idx])
+
+		idx = int(member) if isinstance(obj, list) else member
+		return obj[idx](argvals, allow_recursion=allow_recursion)
+
 	def interpret_expression(self, expr, local_vars, allow_recursion):
 		ret, should_return = self.interpret_statement(expr, local_vars, allow_recursion)
 		if should_return:
 			raise RuntimeError('Cannot return from an expression')
 		return ret
 
+	@staticmethod
+	def build_symbol_index(code):
+		""" Return positions of function, variable and object definitions, the code is searched in one pass """
+		functions, variables, objects = {}, {}, {}
+		for m in _SYMBOL_RE.finditer(code):
+			name = m.group('func') or m.group('assign_func') or m.group('var_func')
+			if name:
+				functions.setdefault(name, m.start())
+				continue
+			name = m.group('var')
+			if name:
+				variables.setdefault(name, m.start())
+				if m.group('var_object') is None:
+					continue
+				start = m.start('var')
+			else:
+				name, start = m.group('object'), m.start()
+			objects.setdefault(name, []).append(start)
+		return {'functions': functions, 'variables': variables, 'objects': objects}
+
+	def symbol_index(self):
+		if self._symbols is None:
+			self._symbols = self.build_symbol_index(self.code)
+		return self._symbols
+
 	def extract_object(self, objname):
 		_FUNC_NAME_RE = r'''(?:{n}|"{n}"|'{n}')'''.format(n=_NAME_RE)
 		obj = {}
-		fields = None
-		for obj_m in re.finditer(
+		obj_re = re.compile(
 			r'''(?xs)
-				{0}\s*\.\s*{1}|{1}\s*=\s*\{{\s*
-				(?P<fields>({2}\s*:\s*function\s*\(.*?\)\s*\{{.*?}}(?:,\s*)?)*)
+				{0}\s*=\s*\{{\s*
+				(?P<fields>({1}\s*:\s*function\s*\(.*?\)\s*\{{.*?}}(?:,\s*)?)*)
 				}}\s*;
-			'''.format(_NAME_RE, re.escape(objname), _FUNC_NAME_RE),
-			self.code):
-			fields = obj_m.group('fields')
+			'''.format(re.escape(objname), _FUNC_NAME_RE))
+		for start in self.symbol_index()['objects'].get(objname, ()):
+			end = self._find_top(self.code, ';', start)
+			obj_m = obj_re.match(self.code, start, len(self.code) if end < 0 else end + 1)
+			fields = obj_m and obj_m.group('fields')
 			if fields:
 				break
 		else:
@@ -1222,33 +1514,44 @@ class JSInterpreter(object):
 
 	def extract_function_code(self, funcname):
 		""" @returns argnames, code """
-		func_m = re.search(
-			r'''(?xs)
-				(?:
-					function\s+%(name)s|
-					[{;,]\s*%(name)s\s*=\s*function|
-					(?:var|const|let)\s+%(name)s\s*=\s*function
-				)\s*
-				\((?P<args>[^)]*)\)\s*
-				(?P<code>{.+})''' % {'name': re.escape(funcname)},
-			self.code)
-		if func_m is None:
+		start = self.symbol_index()['functions'].get(funcname)
+		func_m = None if start is None else _SYMBOL_RE.match(self.code, start)
+		end = -1 if func_m is None else self._find_top(self.code, '}', func_m.end())
+		if end < 0:
 			raise RuntimeError('Could not find JS function', funcname)
-		code, _ = self._separate_at_paren(func_m.group('code'))  # refine the match
+		code, _ = self._separate_at_paren(self.code[func_m.end():end + 1])
 		return self.build_arglist(func_m.group('args')), code
 
+	def extract_variable_code(self, varname):
+		""" @returns code of the value assigned in the variable definition """
+		start = self.symbol_index()['variables'].get(varname)
+		if start is None:
+			raise RuntimeError('Could not find JS variable', varname)
+		start = self.code.index('=', _SYMBOL_RE.match(self.code, start).end('var')) + 1
+		end = self._find_top(self.code, ';', start)
+		return next(self._separate(self.code[start:None if end < 0 else end], ',', 1), '').strip()
+
 	def extract_function_from_code(self, argnames, code, *global_stack):
+		""" Inline functions are replaced by named objects in one pass over the code """
 		local_vars = {}
+		parts, pos = [], 0
 		while True:
-			mobj = re.search(r'function\((?P<args>[^)]*)\)\s*{', code)
+			mobj = _FUNCTION_EXPR_RE.search(code, pos)
 			if mobj is None:
 				break
 			start, body_start = mobj.span()
-			body, remaining = self._separate_at_paren(code[body_start - 1:])
-			name = self._named_object(local_vars, self.extract_function_from_code(
+			end = self._find_top(code, '}', body_start - 1)
+			if end < 0:
+				raise RuntimeError('No terminating paren } in %s' % code[body_start - 1:])
+			body, _ = self._separate_at_paren(code[body_start - 1:end + 1])
+			parts.append(code[pos:start])
+			parts.append(self._named_object(local_vars, self.extract_function_from_code(
 				[x.strip() for x in mobj.group('args').split(',')],
-				body, local_vars, *global_stack))
-			code = code[:start] + name + remaining
+				body, local_vars, *global_stack)))
+			pos = end + 1
+		if parts:
+			parts.append(code[pos:])
+			code = ''.join(parts)
 		return self.build_function(argnames, code, local_vars, *global_stack)
 
 	@classmethod
@@ -1276,4 +1579,39 @@ class JSInterpreter(object):
 			ret, should_abort = self.interpret_statement(code.replace('\n', ' '), var_stack, allow_recursion - 1)
 			if should_abort:
 				return ret
-		return resf
+		return self._budgeted(resf)
+
+	def _budgeted(self, func):
+		""" Return func which raises JSBudgetExceeded if it runs too long, nested calls share the budget of the outermost call """
+		budget = self._budget
+
+		def budgeted(args, kwargs=None, allow_recursion=100):
+			if budget.active:
+				return func(args, kwargs, allow_recursion)
+			budget.active, budget.steps = True, 0
+			budget.deadline = self.time_budget and time() + self.time_budget
+			try:
+				if self.profiler:
+					return self.profiler.run('js', func, args, kwargs, allow_recursion)
+				return func(args, kwargs, allow_recursion)
+			finally:
+				budget.active = False
+		return budgeted
+
+	def _spend(self):
+		""" Count one step of the running evaluation, raise if it exceeds the budget """
+		budget = self._budget
+		if not budget.active:
+			return
+		budget.steps += 1
+		if self.step_budget and budget.steps > self.step_budget:
+			raise JSBudgetExceeded('Evaluation exceeded %d steps' % self.step_budget)
+		# Clock is read once in 256 steps
+		if budget.deadline and not budget.steps & 0xff and time() > budget.deadline:
+			raise JSBudgetExceeded('Evaluation exceeded %s seconds' % self.time_budget)
+
+	def _regex(self, func, *args):
+		""" Return func(*args) of regular expression, counted by the profiler """
+		if self.profiler:
+			self.profiler.count('regex')
+		return func(*args)
@@ -0,0 +1,768 @@
+# coding: utf-8
+from __future__ import unicode_literals
+
+from .compat import compat_basestring
+from .compat import compat_integer_types
+from .jscompile import _BINARY_OPERATORS
+from .jscompile import _js_inv
+from .jscompile import _js_neg
+from .jscompile import _js_pos
+from .jscompile import JSCompileError
+from .jscompile import JSCompiler
+from .jsinterp import _Infinity
+from .jsinterp import _js_add
+from .jsinterp import _js_ternary
+from .jsinterp import _js_typeof
+from .jsinterp import _NaN
+from .jsinterp import JSBudgetExceeded
+from .jsinterp import JSThrow
+from .jsinterp import JSUndefined
+from .jsinterp import LocalNameSpace
+from .jsinterp import unified_timestamp
+
+
+# How many compiled Python sources are kept, the cache is emptied when it is full
+CODE_CACHE_SIZE = 64
+
+# Runtime names of binary operators in generated source
+_OP_NAMES = {
+	'+': '_js_add', '-': '_js_sub', '*': '_js_mul', '/': '_js_div', '%': '_js_mod', '**': '_js_exp',
+	'|': '_js_bor', '^': '_js_bxor', '&': '_js_band', '<<': '_js_lsh', '>>': '_js_rsh',
+	'==': '_js_eq', '!=': '_js_ne', '===': '_js_id', '!==': '_js_nid',
+	'<': '_js_lt', '<=': '_js_le', '>': '_js_gt', '>=': '_js_ge'
+}
+
+# Operators which return bool, their result is used in conditions without conversion
+_BOOL_OPERATORS = frozenset(('==', '!=', '===', '!==', '<', '<=', '>', '>='))
+
+
+def _args(args, count):
+	args = list(args[:count])
+	return args + [JSUndefined] * (count - len(args))
+
+
+def _this(kwargs):
+	return kwargs.get('this', JSUndefined) if kwargs else JSUndefined
+
+
+def _caught(e):
+	return e.args[0] if isinstance(e, JSThrow) and e.args else e
+
+
+def _and(value, right):
+	return right() if _js_ternary(value) else value
+
+
+def _or(value, right):
+	return value if _js_ternary(value) else right()
+
+
+def _nullish(value, right):
+	return right() if value is None or value is JSUndefined else value
+
+
+def _set(namespace, name, value):
+	namespace[name] = value
+	return value
+
+
+def _setitem(obj, idx, value):
+	obj[int(idx) if isinstance(idx, float) else idx] = value
+	return value
+
+
+def _update(namespace, name, delta, prefix):
+	old = namespace[name]
+	namespace[name] = new = _js_add(old, delta)
+	return new if prefix else old
+
+
+def _date(value):
+	date = unified_timestamp(value)
+	if date is None:
+		raise RuntimeError('Failed to parse date')
+	return int(date * 1000)
+
+
+def _literal(value):
+	""" Return Python source of string, the same in Python 2 and 3 """
+	chars = []
+	for char in value:
+		code = ord(char)
+		if 32 <= code < 127 and char not in '"\\':
+			chars.append(char)
+		elif code < 0x10000:
+			chars.append('\\u%04x' % code)
+		else:
+			chars.append('\\U%08x' % code)
+	return 'u"%s"' % ''.join(chars)
+
+
+def _is_function(stmt):
+	return stmt[0] == 'function'
+
+
+class _Scope(object):
+	""" Names declared in one JavaScript function, boxed names are kept in dict so nested code can change them """
+
+	def __init__(self, parent, number, params, body, name):
+		self.parent = parent
+		self.number = number
+		self.params = list(params)
+		self.body = body
+		self.name = name
+		self.names = set(self.params)
+		self.boxed = set()
+		self.functions = []
+		self.uses_this = False
+		if name:
+			self.names.add(name)
+		self._declare(body)
+
+	def _declare(self, stmts):
+		for stmt in stmts:
+			kind = stmt[0]
+			if kind == 'var':
+				self.names.update(name for name, _ in stmt[1])
+			elif kind == 'function':
+				self.names.add(stmt[1][1])
+			elif kind == 'block':
+				self._declare(stmt[1])
+			elif kind == 'if':
+				self._declare([s for s in stmt[2:] if s])
+			elif kind == 'for':
+				self._declare([s for s in (stmt[1], stmt[4]) if s])
+			elif kind == 'do':
+				self._declare([stmt[1]])
+			elif kind == 'try':
+				if stmt[2]:
+					self.names.add(stmt[2])
+				self._declare([s for s in (stmt[1], stmt[3], stmt[4]) if s])
+			elif kind == 'switch':
+				self._declare([block for _, block in stmt[2]])
+
+	def resolve(self, name):
+		""" Return scope which declares name, None for global names """
+		scope = self
+		while scope and name not in scope.names:
+			scope = scope.parent
+		return scope
+
+
+def _continues(stmt):
+	""" Return True if statement has continue of the loop it is in """
+	kind = stmt[0]
+	if kind == 'continue':
+		return True
+	if kind == 'block':
+		return any(_continues(s) for s in stmt[1])
+	if kind == 'if':
+		return any(_continues(s) for s in stmt[2:] if s)
+	if kind == 'try':
+		return any(_continues(s) for s in stmt[1::2] if s)
+	if kind == 'switch':
+		return any(_continues(block) for _, block in stmt[2])
+	return False
+
+
+class _Writer(object):
+	def __init__(self):
+		self.lines = []
+		self.level = 0
+
+	def line(self, text):
+		self.lines.append('\t' * self.level + text)
+
+	def open(self, text):
+		self.line(text)
+		self.level += 1
+		return len(self.lines)
+
+	def close(self, start):
+		if len(self.lines) == start:
+			self.line('pass')
+		self.level -= 1
+
+
+class JSTranspiler(JSCompiler):
+	"""
+	JSCompiler which can also translate a function to Python source.
+	Generated source uses the helpers of this module and the methods of the instance which loads it.
+	"""
+	_code_cache = {}
+
+	def transpile(self, argnames, code):
+		""" Return Python source which defines the function as decode(args), called with the constants of the instance """
+		return _Transpiler().function_source(argnames, self.optimize(argnames, self.parse(code)))
+
+	def load(self, source, *global_stack):
+		""" Compile source, once for all instances, and return the function it defines """
+		code = self._code_cache.get(source)
+		if code is None:
+			if len(self._code_cache) >= CODE_CACHE_SIZE:
+				self._code_cache.clear()
+			code = self._code_cache[source] = compile(source, '<player>', 'exec')
+		namespace = self._runtime(LocalNameSpace(*global_stack or ({}, )))
+		exec(code, namespace)
+		return self._budgeted(namespace['decode'])
+
+	def _runtime(self, global_vars):
+		def global_object(name, nullish=False):
+			value = global_vars[name]
+			if value is JSUndefined or value is None:
+				try:
+					value = self._global_object(name)
+				except Exception:
+					if not nullish:
+						raise
+			return value
+
+		def global_function(name):
+			return global_vars[name] if name in global_vars else self._global_function(name)
+
+		def nullish_get(obj, idx):
+			if obj is JSUndefined or obj is None:
+				return JSUndefined
+			return self._index(obj, idx)
+
+		def nullish_call(obj, member, argvals):
+			if obj is JSUndefined or obj is None:
+				return JSUndefined
+			return self._call_method(obj, member, argvals(), 100)
+
+		def update_item(obj, idx, delta, prefix):
+			idx = int(idx) if isinstance(idx, float) else idx
+			old = self._index(obj, idx)
+			obj[idx] = new = _js_add(old, delta)
+			return new if prefix else old
+
+		def assign_item(obj, idx, op, value):
+			idx = int(idx) if isinstance(idx, float) else idx
+			obj[idx] = result = op(self._index(obj, idx), value())
+			return result
+
+		runtime = dict((name, _BINARY_OPERATORS[op]) for op, name in _OP_NAMES.items())
+		runtime.update({
+			'G': global_vars,
+			'_U': JSUndefined,
+			'_NaN': _NaN,
+			'_Inf': _Infinity,
+			'_JSThrow': JSThrow,
+			'_Exceeded': JSBudgetExceeded,
+			'_spend': self._spend,
+			'_t': _js_ternary,
+			'_neg': _js_neg,
+			'_pos': _js_pos,
+			'_inv': _js_inv,
+			'_typeof': _js_typeof,
+			'_args': _args,
+			'_this': _this,
+			'_caught': _caught,
+			'_and': _and,
+			'_or': _or,
+			'_nullish': _nullish,
+			'_set': _set,
+			'_setitem': _setitem,
+			'_update': _update,
+			'_date': _date,
+			'_gobj': global_object,
+			'_gfunc': global_function,
+			'_get': self._index,
+			'_nget': nullish_get,
+			'_call': self._call_method,
+			'_ncall': nullish_call,
+			'_update_item': update_item,
+			'_assign_item': assign_item
+		})
+		return runtime
+
+
+class _Transpiler(object):
+	"""
+	Translate AST of JSCompiler to Python source.
+	Every JavaScript function is Python function with the calling convention of the interpreter.
+	Local names are Python variables v_name, names which nested functions use or which are assigned
+	inside of expression are items of the scope dict sN, other names are items of global dict G.
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self.scopes = {}
+
+	def function_source(self, params, body):
+		scope = self._analyze(None, params, body, None)
+		writer = _Writer()
+		self._function(writer, 'decode', scope)
+		return '\n'.join(writer.lines) + '\n'
+
+	# Analysis finds declared names and the names which must be boxed
+
+	def _analyze(self, parent, params, body, name):
+		self.count += 1
+		scope = _Scope(parent, self.count, params, body, name)
+		for stmt in body:
+			self._analyze_stmt(stmt, scope)
+		return scope
+
+	def _analyze_stmt(self, stmt, scope):
+		kind = stmt[0]
+		if kind == 'expr':
+			self._analyze_effect(stmt[1], scope)
+		elif kind == 'var':
+			for _, init in stmt[1]:
+				if init:
+					self._analyze_expr(init, scope)
+		elif kind == 'function':
+			# Name of function declaration is declared in the scope around it
+			self._analyze_function(stmt[1], scope, None)
+		elif kind in ('return', 'throw'):
+			if stmt[1]:
+				self._analyze_expr(stmt[1], scope)
+		elif kind == 'if':
+			self._analyze_expr(stmt[1], scope)
+			for s in stmt[2:]:
+				if s:
+					self._analyze_stmt(s, scope)
+		elif kind == 'for':
+			if stmt[1]:
+				self._analyze_stmt(stmt[1], scope)
+			if stmt[2]:
+				self._analyze_expr(stmt[2], scope)
+			if stmt[3]:
+				self._analyze_effect(stmt[3], scope)
+			self._analyze_stmt(stmt[4], scope)
+		elif kind == 'do':
+			self._analyze_stmt(stmt[1], scope)
+			self._analyze_expr(stmt[2], scope)
+		elif kind == 'block':
+			for s in stmt[1]:
+				self._analyze_stmt(s, scope)
+		elif kind == 'try':
+			for s in stmt[1::2]:
+				if s:
+					self._analyze_stmt(s, scope)
+		elif kind == 'switch':
+			self._analyze_expr(stmt[1], scope)
+			for test, block in stmt[2]:
+				if test:
+					self._analyze_expr(test, scope)
+				self._analyze_stmt(block, scope)
+
+	def _analyze_effect(self, expr, scope):
+		""" Analyze expression which value is not used, it is translated to statements """
+		kind = expr[0]
+		if kind == 'seq':
+			for item in expr[1]:
+				self._analyze_effect(item, scope)
+		elif kind in ('assign', 'update'):
+			target = expr[2] if kind == 'assign' else expr[3]
+			if target[0] == 'member':
+				self._analyze_expr(target[1], scope)
+				self._analyze_expr(target[2], scope)
+			else:
+				self._use(target[1], scope)
+			if kind == 'assign':
+				self._analyze_expr(expr[3], scope)
+		elif kind == 'logical' and expr[1] != '??':
+			self._analyze_expr(expr[2], scope)
+			self._analyze_effect(expr[3], scope)
+		elif kind == 'cond':
+			self._analyze_expr(expr[1], scope)
+			self._analyze_effect(expr[2], scope)
+			self._analyze_effect(expr[3], scope)
+		else:
+			self._analyze_expr(expr, scope)
+
+	def _analyze_expr(self, expr, scope):
+		kind = expr[0]
+		if kind == 'name':
+			self._use(expr[1], scope)
+		elif kind == 'func':
+			self._analyze_function(expr, scope, expr[1])
+		elif kind in ('assign', 'update'):
+			target = expr[2] if kind == 'assign' else expr[3]
+			if target[0] == 'name':
+				declared = scope.resolve(target[1])
+				if declared:
+					declared.boxed.add(target[1])
+			else:
+				self._analyze_expr(target, scope)
+			if kind == 'assign':
+				self._analyze_expr(expr[3], scope)
+		elif kind in ('member', 'binary', 'logical', 'cond', 'unary'):
+			for item in expr[1:]:
+				if isinstance(item, tuple):
+					self._analyze_expr(item, scope)
+		elif kind in ('call', 'new'):
+			self._analyze_expr(expr[1], scope)
+			for arg in expr[2]:
+				self._analyze_expr(arg, scope)
+		elif kind in ('seq', 'array'):
+			for item in expr[1]:
+				self._analyze_expr(item, scope)
+		elif kind == 'object':
+			for _, value in expr[1]:
+				self._analyze_expr(value, scope)
+
+	def _analyze_function(self, func, scope, name):
+		self.scopes[id(func)] = child = self._analyze(scope, func[2], func[3], name)
+		scope.functions.append(child)
+
+	def _use(self, name, scope):
+		if name == 'this':
+			scope.uses_this = True
+			return
+		declared = scope.resolve(name)
+		if declared and declared is not scope:
+			declared.boxed.add(name)
+
+	# Source generation
+
+	def _temp(self, prefix):
+		self.count += 1
+		return '_%s%d' % (prefix, self.count)
+
+	@staticmethod
+	def _dict(scope):
+		return 's%d' % scope.number
+
+	def _ref(self, name, scope):
+		""" Return Python source of name which can be read and assigned """
+		if name == 'this':
+			return 'v_this'
+		declared = scope.resolve(name)
+		if not declared:
+			return 'G[%s]' % _literal(name)
+		if name in declared.boxed:
+			return '%s[%s]' % (self._dict(declared), _literal(name))
+		return 'v_' + name.replace('$', '_S')
+
+	def _namespace(self, name, scope):
+		""" Return dict and key of name which is assigned inside of expression """
+		declared = scope.resolve(name)
+		return self._dict(declared) if declared else 'G', _literal(name)
+
+	def _function(self, writer, pyname, scope):
+		start = writer.open('def %s(args, kwargs=None, allow_recursion=100):' % pyname)
+		if scope.boxed:
+			writer.line('%s = {}' % self._dict(scope))
+		if scope.params:
+			writer.line('%s, = _args(args, %d)' % (
+				', '.join(self._ref(name, scope) for name in scope.params), len(scope.params)))
+		if scope.uses_this:
+			writer.line('v_this = _this(kwargs)')
+		for name in sorted(scope.names - set(scope.params) - set((scope.name, ))):
+			writer.line('%s = _U' % self._ref(name, scope))
+		# Functions are defined before the code, JavaScript function declarations are hoisted
+		for child in scope.functions:
+			self._function(writer, 'f%d' % child.number, child)
+		if scope.name:
+			writer.line('%s = f%d' % (self._ref(scope.name, scope), scope.number))
+		loops = []
+		for stmt in scope.body:
+			if _is_function(stmt):
+				self._stmt(writer, stmt, scope, loops)
+		for stmt in scope.body:
+			if not _is_function(stmt):
+				self._stmt(writer, stmt, scope, loops)
+		writer.close(start)
+
+	def _stmt(self, writer, stmt, scope, loops):
+		getattr(self, '_stmt_' + stmt[0])(writer, scope, loops, *stmt[1:])
+
+	def _block(self, writer, header, stmt, scope, loops):
+		start = writer.open(header)
+		self._stmt(writer, stmt, scope, loops)
+		writer.close(start)
+
+	def _stmt_empty(self, writer, scope, loops):
+		pass
+
+	def _stmt_block(self, writer, scope, loops, stmts):
+		for stmt in stmts:
+			self._stmt(writer, stmt, scope, loops)
+
+	def _stmt_expr(self, writer, scope, loops, expr):
+		self._effect(writer, expr, scope)
+
+	def _stmt_var(self, writer, scope, loops, decls):
+		for name, init in decls:
+			if init:
+				writer.line('%s = %s' % (self._ref(name, scope), self._expr(init, scope)))
+
+	def _stmt_function(self, writer, scope, loops, func):
+		writer.line('%s = f%d' % (self._ref(func[1], scope), self.scopes[id(func)].number))
+
+	def _stmt_return(self, writer, scope, loops, arg):
+		writer.line('return %s' % (self._expr(arg, scope) if arg else 'None'))
+
+	def _stmt_throw(self, writer, scope, loops, arg):
+		writer.line('raise _JSThrow(%s)' % self._expr(arg, scope))
+
+	def _stmt_break(self, writer, scope, loops):
+		writer.line('break')
+
+	def _stmt_continue(self, writer, scope, loops):
+		if not loops:
+			raise JSCompileError('Continue outside of loop')
+		if loops[-1] == 'finally':
+			raise JSCompileError('Continue in finally block')
+		if loops[-1] == 'loop':
+			writer.line('continue')
+			return
+		# Continue inside of switch breaks the switch loop and continues after it
+		loops[-1][1] = True
+		writer.line('%s = True' % loops[-1][0])
+		writer.line('break')
+
+	def _stmt_if(self, writer, scope, loops, test, if_true, if_false):
+		self._block(writer, 'if %s:' % self._test(test, scope), if_true, scope, loops)
+		if if_false:
+			self._block(writer, 'else:', if_false, scope, loops)
+
+	def _stmt_for(self, writer, scope, loops, init, test, update, body):
+		if init:
+			self._stmt(writer, init, scope, loops)
+		test = self._test(test, scope) if test else 'True'
+		if update and _continues(body):
+			# Continue must run the update, so it is run at start of every loop except the first
+			first = self._temp('first')
+			writer.line('%s = True' % first)
+			start = writer.open('while True:')
+			writer.line('_spend()')
+			writer.open('if %s:' % first)
+			writer.line('%s = False' % first)
+			writer.level -= 1
+			writer.open('else:')
+			self._effect(writer, update, scope)
+			writer.level -= 1
+			if test != 'True':
+				writer.open('if not (%s):' % test)
+				writer.line('break')
+				writer.level -= 1
+			self._stmt(writer, body, scope, loops + ['loop'])
+			writer.close(start)
+			return
+		start = writer.open('while %s:' % test)
+		writer.line('_spend()')
+		self._stmt(writer, body, scope, loops + ['loop'])
+		if update:
+			self._effect(writer, update, scope)
+		writer.close(start)
+
+	def _stmt_do(self, writer, scope, loops, body, test):
+		first = self._temp('first')
+		writer.line('%s = True' % first)
+		start = writer.open('while %s or %s:' % (first, self._test(test, scope)))
+		writer.line('_spend()')
+		writer.line('%s = False' % first)
+		self._stmt(writer, body, scope, loops + ['loop'])
+		writer.close(start)
+
+	def _stmt_try(self, writer, scope, loops, block, name, catch, final):
+		start = writer.open('try:')
+		self._stmt(writer, block, scope, loops)
+		writer.close(start)
+		if catch:
+			# Exceeded budget is not caught by JavaScript
+			start = writer.open('except _Exceeded:')
+			writer.line('raise')
+			writer.close(start)
+			error = self._temp('e')
+			start = writer.open('except Exception as %s:' % error)
+			if name:
+				writer.line('%s = _caught(%s)' % (self._ref(name, scope), error))
+			self._stmt(writer, catch, scope, loops)
+			writer.close(start)
+		if final:
+			start = writer.open('finally:')
+			self._stmt(writer, final, scope, loops + ['finally'])
+			writer.close(start)
+
+	def _stmt_switch(self, writer, scope, loops, disc, cases):
+		value, index = self._temp('value'), self._temp('case')
+		writer.line('%s = %s' % (value, self._expr(disc, scope)))
+		default = next((idx for idx, (test, _) in enumerate(cases) if not test), len(cases))
+		keyword = 'if'
+		for idx, (test, _) in enumerate(cases):
+			if test:
+				writer.open('%s %s == %s:' % (keyword, self._expr(test, scope), value))
+				writer.line('%s = %d' % (index, idx))
+				writer.level -= 1
+				keyword = 'elif'
+		if keyword == 'if':
+			writer.line('%s = %d' % (index, default))
+		else:
+			writer.open('else:')
+			writer.line('%s = %d' % (index, default))
+			writer.level -= 1
+		# Loop which runs once, so break of the switch works
+		context = [self._temp('continue'), False]
+		switch_at = len(writer.lines)
+		start = writer.open('while True:')
+		for idx, (_, block) in enumerate(cases):
+			case_start = writer.open('if %s <= %d:' % (index, idx))
+			self._stmt(writer, block, scope, loops + [context])
+			writer.close(case_start)
+		writer.line('break')
+		writer.close(start)
+		if context[1]:
+			writer.lines.insert(switch_at, '\t' * writer.level + '%s = False' % context[0])
+			start = writer.open('if %s:' % context[0])
+			self._stmt_continue(writer, scope, loops)
+			writer.close(start)
+
+	def _effect(self, writer, expr, scope):
+		""" Write statements of expression which value is not used """
+		kind = expr[0]
+		if kind == 'seq':
+			for item in expr[1]:
+				self._effect(writer, item, scope)
+		elif kind == 'assign' and (expr[2][0] == 'name' or not expr[1]):
+			op, target, value = expr[1:]
+			if target[0] == 'name':
+				ref = self._ref(target[1], scope)
+				if op:
+					value = '%s(%s, %s)' % (_OP_NAMES[op], ref, self._expr(value, scope))
+				else:
+					value = self._expr(value, scope)
+				writer.line('%s = %s' % (ref, value))
+			else:
+				writer.line('_setitem(%s, %s, %s)' % (
+					self._object(target[1], scope), self._expr(target[2], scope), self._expr(value, scope)))
+		elif kind == 'update' and expr[3][0] == 'name':
+			ref = self._ref(expr[3][1], scope)
+			writer.line('%s = _js_add(%s, %d)' % (ref, ref, 1 if expr[1] == '++' else -1))
+		elif kind == 'logical' and expr[1] != '??':
+			test = self._test(expr[2], scope)
+			start = writer.open(('if %s:' if expr[1] == '&&' else 'if not (%s):') % test)
+			self._effect(writer, expr[3], scope)
+			writer.close(start)
+		elif kind == 'cond':
+			start = writer.open('if %s:' % self._test(expr[1], scope))
+			self._effect(writer, expr[2], scope)
+			writer.close(start)
+			start = writer.open('else:')
+			self._effect(writer, expr[3], scope)
+			writer.close(start)
+		else:
+			writer.line(self._expr(expr, scope))
+
+	def _test(self, expr, scope):
+		""" Return Python condition of expression """
+		if expr[0] == 'binary' and expr[1] in _BOOL_OPERATORS:
+			return self._expr(expr, scope)
+		if expr[0] == 'unary' and expr[1] == '!':
+			return 'not %s' % self._test(expr[2], scope)
+		return '_t(%s)' % self._expr(expr, scope)
+
+	def _expr(self, expr, scope):
+		if expr[0] == 'func':
+			return 'f%d' % self.scopes[id(expr)].number
+		return getattr(self, '_expr_' + expr[0])(scope, *expr[1:])
+
+	def _expr_const(self, scope, value):
+		if value is JSUndefined:
+			return '_U'
+		if value is None or isinstance(value, bool):
+			return repr(value)
+		if isinstance(value, compat_basestring):
+			return _literal(value)
+		if isinstance(value, compat_integer_types):
+			return '%d' % value
+		if isinstance(value, float):
+			if value != value:
+				return '_NaN'
+			if value in (_Infinity, -_Infinity):
+				return '_Inf' if value > 0 else '(-_Inf)'
+			return repr(value)
+		raise JSCompileError('Unsupported constant', value)
+
+	def _expr_name(self, scope, name):
+		return self._ref(name, scope)
+
+	def _object(self, expr, scope, nullish=False):
+		""" Return source of expression used as object, undefined global names are searched from builtins and the code """
+		if expr[0] == 'name' and expr[1] != 'this' and not scope.resolve(expr[1]):
+			return '_gobj(%s%s)' % (_literal(expr[1]), ', True' if nullish else '')
+		return self._expr(expr, scope)
+
+	def _expr_member(self, scope, obj, prop, nullish):
+		return '%s(%s, %s)' % ('_nget' if nullish else '_get', self._object(obj, scope, nullish), self._expr(prop, scope))
+
+	def _expr_call(self, scope, callee, args):
+		args = '[%s]' % ', '.join(self._expr(arg, scope) for arg in args)
+		if callee[0] == 'name' and callee[1] != 'this' and not scope.resolve(callee[1]):
+			return '_gfunc(%s)(%s)' % (_literal(callee[1]), args)
+		if callee[0] != 'member':
+			return '%s(%s)' % (self._expr(callee, scope), args)
+		obj, prop, nullish = callee[1:]
+		if (obj, prop) == (('name', 'console'), ('const', 'debug')):
+			return 'None'
+		# Type.prototype.method.call(...) and .apply(...) are handled by the interpreter method call
+		if (prop[0] == 'const' and prop[1] in ('call', 'apply') and obj[0] == 'member' and
+				obj[2][0] == 'const' and obj[1][0] == 'member' and obj[1][2] == ('const', 'prototype')):
+			obj, prop = obj[1][1], ('const', 'prototype.%s.%s' % (obj[2][1], prop[1]))
+		obj, prop = self._object(obj, scope, nullish), self._expr(prop, scope)
+		if nullish:
+			return '_ncall(%s, %s, lambda: %s)' % (obj, prop, args)
+		return '_call(%s, %s, %s, 100)' % (obj, prop, args)
+
+	def _expr_new(self, scope, callee, args):
+		if callee != ('name', 'Date') or len(args) != 1:
+			raise JSCompileError('Unsupported object', callee)
+		return '_date(%s)' % self._expr(args[0], scope)
+
+	def _expr_unary(self, scope, op, arg):
+		if op == '!':
+			return '(not %s)' % self._test(arg, scope)
+		arg = self._expr(arg, scope)
+		if op == '-':
+			return '_neg(0, %s)' % arg
+		if op == '+':
+			return '_pos(0, %s)' % arg
+		if op == '~':
+			return '_inv(%s, 0)' % arg
+		if op == 'typeof':
+			return '_typeof(%s)' % arg
+		return '(%s, _U)[1]' % arg
+
+	def _expr_binary(self, scope, op, left, right):
+		return '%s(%s, %s)' % (_OP_NAMES[op], self._expr(left, scope), self._expr(right, scope))
+
+	def _expr_logical(self, scope, op, left, right):
+		func = {'&&': '_and', '||': '_or', '??': '_nullish'}[op]
+		return '%s(%s, lambda: %s)' % (func, self._expr(left, scope), self._expr(right, scope))
+
+	def _expr_cond(self, scope, test, if_true, if_false):
+		return '(%s if %s else %s)' % (self._expr(if_true, scope), self._test(test, scope), self._expr(if_false, scope))
+
+	def _expr_assign(self, scope, op, target, value):
+		value = self._expr(value, scope)
+		if target[0] == 'name':
+			namespace, key = self._namespace(target[1], scope)
+			if op:
+				value = '%s(%s[%s], %s)' % (_OP_NAMES[op], namespace, key, value)
+			return '_set(%s, %s, %s)' % (namespace, key, value)
+		obj, idx = self._object(target[1], scope), self._expr(target[2], scope)
+		if op:
+			return '_assign_item(%s, %s, %s, lambda: %s)' % (obj, idx, _OP_NAMES[op], value)
+		return '_setitem(%s, %s, %s)' % (obj, idx, value)
+
+	def _expr_update(self, scope, op, prefix, target):
+		delta = 1 if op == '++' else -1
+		if target[0] == 'name':
+			namespace, key = self._namespace(target[1], scope)
+			return '_update(%s, %s, %d, %s)' % (namespace, key, delta, prefix)
+		return '_update_item(%s, %s, %d, %s)' % (
+			self._object(target[1], scope), self._expr(target[2], scope), delta, prefix)
+
+	def _expr_seq(self, scope, exprs):
+		return '(%s)[-1]' % ', '.join(self._expr(expr, scope) for expr in exprs)
+
+	def _expr_array(self, scope, items):
+		return '[%s]' % ', '.join(self._expr(item, scope) for item in items)
+
+	def _expr_object(self, scope, items):
+		return '{%s}' % ', '.join('%s: %s' % (
+			self._expr_const(scope, key), self._expr(value, scope)) for key, value in items)
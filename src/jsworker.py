@@ -0,0 +1,220 @@
+# -*- coding: UTF-8 -*-
+# Decode signatures of the player in a helper process, so that JS decoding uses
+# another CPU core and a hung or crashed decode does not affect enigma2
+
+from __future__ import print_function
+
+import os
+import sys
+
+from collections import OrderedDict
+from json import dumps
+from json import loads
+from re import sub
+from select import select
+from subprocess import PIPE
+from subprocess import Popen
+from threading import Lock
+from time import time
+
+from .jscompile import JSCompiler
+from .jsinterp import JSInterpreter
+from .jsinterp import LocalNameSpace
+from .jstranspile import JSTranspiler
+
+
+WORKER_TIMEOUT = 15.0  # Longer than the JS time budget, the first decode also compiles the function
+WORKER_PLAYERS = 4  # Player profiles kept by the helper process
+WORKER_FAILURES = 3  # Helper process is not used after this many failed requests in a row
+
+# Plugin modules are imported as a package without its __init__, which needs enigma2
+_BOOTSTRAP = '''import sys, types
+package = types.ModuleType('youtube_jsworker')
+package.__path__ = [sys.argv[1]]
+sys.modules[package.__name__] = package
+from youtube_jsworker.jsworker import serve
+serve()
+'''
+
+
+class JSDecodeError(RuntimeError):
+	""" Decode function failed in the helper process, which itself works """
+	pass
+
+
+def fixup_n_function_code(argnames, code):
+	return argnames, sub(
+		r';\s*if\s*\(\s*typeof\s+[a-zA-Z0-9_$]+\s*===?\s*(["\'])undefined\1\s*\)\s*return\s+%s;' % argnames[0],
+		';', code)
+
+
+def player_globals(profile):
+	""" Return values of the player global variables, they are the constants of the compiled functions """
+	jsi = JSInterpreter(profile['code'], symbols=profile['symbols'])
+	global_vars = {}
+	for name, expr in profile['globals']:
+		try:
+			global_vars[name] = jsi.interpret_expression(expr, LocalNameSpace(global_vars), 100)
+		except Exception as ex:
+			print('[JSWorker] Cannot evaluate player variable', name, ex)
+	return global_vars
+
+
+class PlayerDecoder():
+	""" Decode functions of one player profile, they are built on first use """
+
+	def __init__(self, profile):
+		self.profile = profile
+		# Built decode functions by (key, transpile)
+		self.functions = {}
+		self._globals = None
+
+	def function(self, key, transpile=False):
+		""" Return decode function, translated Python code is used if the player analysis made it """
+		transpile = bool(transpile and key in self.profile.get('python', {}))
+		func = self.functions.get((key, transpile))
+		if func is None:
+			func = self.functions[key, transpile] = self._function(key, transpile)
+		return func
+
+	def decode(self, key, value, transpile=False):
+		return self.function(key, transpile)([value])
+
+	def _function(self, key, transpile):
+		profile = self.profile
+		if self._globals is None:
+			self._globals = player_globals(profile)
+		if transpile:
+			return JSTranspiler(profile['code'], symbols=profile['symbols']).load(profile['python'][key], self._globals)
+		if not profile[key]:
+			raise RuntimeError('Decode function not found in player', key)
+		jsi = JSCompiler(profile['code'], symbols=profile['symbols'], constants=self._globals)
+		return jsi.extract_function_from_code(
+			*fixup_n_function_code(*jsi.extract_function_code(profile[key])) + (self._globals, ))
+
+
+def _answer(players, request):
+	player_id = request['player']
+	if 'profile' in request:
+		players[player_id] = PlayerDecoder(request['profile'])
+		while len(players) > WORKER_PLAYERS:
+			players.popitem(last=False)
+	elif player_id not in players:
+		return {'missing': True}
+	try:
+		return {'result': players[player_id].decode(request['key'], request['value'], request['transpile'])}
+	except Exception as ex:
+		return {'error': '%s: %s' % (type(ex).__name__, ex)}
+
+
+def serve():
+	""" Answer decode requests, one JSON line each, until the input is closed """
+	stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+	stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+	# Prints must not mix with the responses, they go to the enigma2 log
+	sys.stdout = sys.stderr
+	players = OrderedDict()
+	for line in iter(stdin.readline, b''):
+		response = _answer(players, loads(line.decode('utf-8')))
+		stdout.write((dumps(response) + '\n').encode('utf-8'))
+		stdout.flush()
+
+
+def _python():
+	""" Return the interpreter for the helper process, enigma2 embeds Python so sys.executable can be enigma2 """
+	if os.path.basename(sys.executable or '').startswith('python'):
+		return sys.executable
+	for name in ('python%d.%d' % sys.version_info[:2], 'python%d' % sys.version_info[0]):
+		for path in os.environ.get('PATH', '/usr/bin').split(os.pathsep):
+			if os.access(os.path.join(path, name), os.X_OK):
+				return os.path.join(path, name)
+	raise RuntimeError('Python interpreter for the JS worker not found')
+
+
+class JSWorker():
+	""" Decode signatures in a helper process which keeps the player functions between requests.
+	The process is started on first use and again after it crashed or did not answer in time """
+
+	def __init__(self, timeout=WORKER_TIMEOUT):
+		self.timeout = timeout
+		self.available = True
+		self._failures = 0
+		self._process = None
+		self._players = set()
+		self._buffer = b''
+		self._lock = Lock()
+
+	def decode(self, player_id, profile, key, value, transpile=False):
+		with self._lock:
+			try:
+				response = self._decode(player_id, profile, key, value, transpile)
+			except RuntimeError:
+				self._failures += 1
+				if self._failures >= WORKER_FAILURES:
+					print('[JSWorker] Helper process failed %d times, do not use it' % self._failures)
+					self.available = False
+					self.close()
+				raise
+			self._failures = 0
+		# Decode function failed, not the helper process
+		if 'error' in response:
+			raise JSDecodeError('JS worker', response['error'])
+		return response['result']
+
+	def _decode(self, player_id, profile, key, value, transpile):
+		for _ in range(3):
+			self._start()
+			request = {'player': player_id, 'key': key, 'value': value, 'transpile': transpile}
+			if player_id not in self._players:
+				request['profile'] = profile
+			response = self._request(request)
+			if response is None:
+				print('[JSWorker] Helper process ended with', self._process.poll())
+				self.close()
+			elif response.get('missing'):
+				self._players.discard(player_id)
+			else:
+				self._players.add(player_id)
+				return response
+		raise RuntimeError('JS worker failed')
+
+	def close(self):
+		if self._process:
+			if self._process.poll() is None:
+				self._process.kill()
+			self._process.wait()
+			self._process = None
+
+	def _start(self):
+		if self._process:
+			return
+		try:
+			self._process = Popen([_python(), '-c', _BOOTSTRAP, os.path.dirname(os.path.abspath(__file__))],
+					stdin=PIPE, stdout=PIPE, close_fds=True)
+		except (OSError, RuntimeError) as ex:
+			print('[JSWorker] Cannot start helper process', ex)
+			self.available = False
+			raise RuntimeError('Cannot start JS worker', ex)
+		self._players = set()
+		self._buffer = b''
+
+	def _request(self, request):
+		""" Send request and return response, None if the helper process ended """
+		try:
+			self._process.stdin.write((dumps(request) + '\n').encode('utf-8'))
+			self._process.stdin.flush()
+		except (IOError, OSError):
+			return None
+		deadline = time() + self.timeout
+		while b'\n' not in self._buffer:
+			remaining = deadline - time()
+			if remaining <= 0 or not select([self._process.stdout], [], [], remaining)[0]:
+				# Answer to this request must not come as answer to the next one
+				self.close()
+				raise RuntimeError('JS worker did not answer in %s s' % self.timeout)
+			chunk = os.read(self._process.stdout.fileno(), 65536)
+			if not chunk:
+				return None
+			self._buffer += chunk
+		line, self._buffer = self._buffer.split(b'\n', 1)
+		return loads(line.decode('utf-8'))
@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+from __future__ import print_function
+
+from time import time
+
+from .cache import Cache
+from .compat import compat_urlopen
+
+
+# Weight of the latest sample in the throughput moving average
+SAMPLE_WEIGHT = 0.3
+
+# Smaller transfers measure mostly the latency, not the throughput
+MIN_SAMPLE_SIZE = 262144
+MIN_SAMPLE_TIME = 0.2
+
+# Estimate older than this many seconds is refreshed with a probe
+MAX_AGE = 3600
+
+# Part of the estimated throughput which video stream may use
+SAFETY_FACTOR = 0.7
+
+# How much buffering during playback lowers the estimate
+BUFFERING_FACTOR = 0.7
+
+# Probe reads at most this many bytes or seconds from the stream start
+PROBE_SIZE = 1048576
+PROBE_TIME = 3
+
+
+class Throughput():
+	""" Rolling estimate of the download throughput in bits per second """
+
+	def __init__(self):
+		self.cache = Cache()
+		self._estimate = self.cache.load('network', 'throughput', {})
+		self._transfers = 0
+		self._transfer_start = 0
+		self._transfer_size = 0
+
+	def _update(self, bps, weight=SAMPLE_WEIGHT):
+		if self._estimate.get('bps'):
+			bps = self._estimate['bps'] + weight * (bps - self._estimate['bps'])
+		self._estimate = {'bps': int(bps), 'time': int(time())}
+		print('[Throughput] Estimated throughput %d kbit/s' % (bps / 1000))
+		self.cache.store('network', 'throughput', self._estimate)
+
+	def add_sample(self, size, duration):
+		""" Add finished transfer of size bytes in duration seconds """
+		if size >= MIN_SAMPLE_SIZE and duration >= MIN_SAMPLE_TIME:
+			self._update(size * 8 / float(duration))
+
+	def start_transfer(self):
+		""" Transfer started, transfers which run at the same time share the link and are measured together """
+		if not self._transfers:
+			self._transfer_start = time()
+			self._transfer_size = 0
+		self._transfers += 1
+
+	def end_transfer(self, size):
+		""" Transfer ended after size bytes, sample is added when no other transfer is running """
+		self._transfers -= 1
+		self._transfer_size += size
+		if not self._transfers:
+			self.add_sample(self._transfer_size, time() - self._transfer_start)
+
+	def buffering(self):
+		""" Playback stalled, so the stream bitrate was too high for the connection """
+		if self._estimate.get('bps'):
+			self._update(self._estimate['bps'] * BUFFERING_FACTOR, 1)
+
+	def stale(self):
+		return self._estimate.get('time', 0) < time() - MAX_AGE
+
+	def max_bitrate(self):
+		""" Return the highest video bitrate which should play without buffering, or None if not known """
+		if self._estimate.get('bps'):
+			return int(self._estimate['bps'] * SAFETY_FACTOR)
+
+	def probe(self, url):
+		""" Measure throughput by reading the start of the stream """
+		size = 0
+		start = time()
+		try:
+			urlh = compat_urlopen('%s&range=0-%d' % (url, PROBE_SIZE - 1), timeout=5)
+			while size < PROBE_SIZE and time() - start < PROBE_TIME:
+				chunk = urlh.read(65536)
+				if not chunk:
+					break
+				size += len(chunk)
+			urlh.close()
+		except Exception as e:
+			print('[Throughput] Probe failed', e)
+		else:
+			# On slow connection the probe time limit is reached before the size limit
+			if size and time() - start >= MIN_SAMPLE_TIME:
+				self._update(size * 8 / (time() - start))
+
+
+throughput = Throughput()
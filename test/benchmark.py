@@ -0,0 +1,331 @@
+"""Offline benchmark of video url extraction with stubbed network
+
+Run it in the same prepared tree as the tests, for example:
+	python test/benchmark.py -n 10 -o bench.json
+Recorded player responses (*.json) and base.js players (*.js) can be added
+with --fixtures DIR, every response is extracted with every player.
+Output is JSON with median seconds for every extraction stage.
+With --scaling the time to prepare nsig functions of growing size is measured
+too, seconds per kilobyte should stay about the same when the work is linear.
+With --statements the statements which the compiled decode functions execute
+for the test values are counted, with and without optimization.
+With --profile PREFIX the nsig function of every player is decoded by the
+interpreter and its time by construct is written to PREFIX-<player>.folded,
+the input of flamegraph.pl.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from glob import glob
+from io import BytesIO
+
+try:
+	from time import perf_counter as timer
+except ImportError:  # Python 2
+	from time import time as timer
+
+try:
+	import tracemalloc
+except ImportError:  # Python 2
+	tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.cache import Cache  # noqa: E402
+from src.jscompile import JSCompiler  # noqa: E402
+from src.jsinterp import JSInterpreter  # noqa: E402
+from src.jsinterp import JSProfiler  # noqa: E402
+from src.jsworker import fixup_n_function_code  # noqa: E402
+from src.jsworker import player_globals  # noqa: E402
+from src.YouTubeVideoUrl import PLAYER_TESTS  # noqa: E402
+from src.YouTubeVideoUrl import YouTubeVideoUrl  # noqa: E402
+
+
+VIDEO_ID = 'YQHsXMglC9A'
+
+PLAYER_JS = r'''var Wq={aB:function(a,b){a.splice(0,b)},cD:function(a){a.reverse()},eF:function(a,b){var c=a[0];a[0]=a[b%a.length];a[b%a.length]=c}};
+var sts={signatureTimestamp:20073};
+Xy=function(a){a=a.split("");Wq.aB(a,3);Wq.cD(a,2);Wq.eF(a,41);return a.join("")};
+Nf=function(a){var b=a.split(""),c=[function(d,e){e=(e%d.length+d.length)%d.length;d.splice(e,1)},function(d){d.reverse()},function(d,e){var f=d[0];d[0]=d[e%d.length];d[e%d.length]=f},-12,7,3];for(var i=0;i<40;i++){c[i%3](b,c[3+i%3])}return b.join("")};
+g.Cz=function(a){var b;a.get("n"))&&(b=Nf(b),a.set("n",b));return a};
+'''
+
+# Inline functions in synthetic nsig functions of --scaling
+SCALING_FUNCTIONS = (100, 200, 400, 800, 1600)
+
+SIGNATURE = 'A' * 20 + 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ' + 'B' * 20
+
+
+def synthetic_format(itag, mime_type, width=None, height=None, bitrate=1000000):
+	url = 'https://rr1.googlevideo.com/videoplayback?expire=%s&itag=%s&n=ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789&id=1' % (
+		2000000000, itag)
+	fmt = {
+		'itag': itag,
+		'mimeType': mime_type,
+		'bitrate': bitrate,
+		'signatureCipher': 's=%s&sp=sig&url=%s' % (SIGNATURE, url.replace('&', '%26').replace('=', '%3D').replace('?', '%3F'))
+	}
+	if height:
+		fmt.update({'width': width, 'height': height, 'fps': 30})
+	return fmt
+
+
+def synthetic_response():
+	return json.dumps({
+		'playabilityStatus': {'status': 'OK'},
+		'videoDetails': {'videoId': VIDEO_ID, 'isLive': False},
+		'responseContext': {'visitorData': 'Cgt2aXNpdG9y'},
+		'streamingData': {
+			'formats': [synthetic_format(18, 'video/mp4; codecs="avc1.42001E, mp4a.40.2"', 640, 360, 500000)],
+			'adaptiveFormats': [
+				synthetic_format(itag, 'video/mp4; codecs="avc1.4d401f"', width, height, bitrate)
+				for itag, width, height, bitrate in (
+					(137, 1920, 1080, 4000000), (136, 1280, 720, 2000000), (135, 854, 480, 1000000),
+					(134, 640, 360, 600000), (133, 426, 240, 300000), (160, 256, 144, 100000))
+			] + [
+				synthetic_format(itag, 'video/webm; codecs="vp9"', width, height, bitrate)
+				for itag, width, height, bitrate in ((248, 1920, 1080, 3000000), (247, 1280, 720, 1500000))
+			] + [
+				synthetic_format(140, 'audio/mp4; codecs="mp4a.40.2"', bitrate=130000),
+				synthetic_format(251, 'audio/webm; codecs="opus"', bitrate=140000)
+			]
+		}
+	})
+
+
+def load_fixtures(fixtures):
+	players = {'synthetic': PLAYER_JS}
+	responses = {'synthetic': synthetic_response()}
+	if fixtures:
+		for fn in sorted(glob(os.path.join(fixtures, '*.js'))):
+			with open(fn) as f:
+				players[os.path.basename(fn)[:-3]] = f.read()
+		for fn in sorted(glob(os.path.join(fixtures, '*.json'))):
+			with open(fn) as f:
+				responses[os.path.basename(fn)[:-5]] = f.read()
+	return players, responses
+
+
+def timed(stats, stage, func):
+	def wrapper(*args, **kwargs):
+		start = timer()
+		try:
+			return func(*args, **kwargs)
+		finally:
+			stats[stage] = stats.get(stage, 0) + timer() - start
+	return wrapper
+
+
+def create_extractor(player_js, response, cache_dir):
+	""" Return extractor with network replaced by fixtures and empty caches """
+	ytdl = YouTubeVideoUrl(Cache(cache_dir))
+	ytdl._scores = {'count': 1}
+
+	response_bytes = response.encode('utf-8')
+
+	def download_webpage(url, data=None, headers={}, decode=True):
+		if url.endswith('/iframe_api'):
+			return 'var scriptUrl = \'https:\\/\\/www.youtube.com\\/s\\/player\\/0123abcd\\/www-widgetapi.vflset\\/www-widgetapi.js\';'
+		if url.endswith('/base.js'):
+			return player_js
+		return response if decode else response_bytes
+
+	def open_url(url, data=None, headers={}):
+		page = b'<script>ytcfg.set({"INNERTUBE_CONTEXT": {"client": {"visitorData": "Cgt2aXNpdG9y"}}});</script>'
+		return BytesIO(page)
+
+	ytdl._download_webpage = download_webpage
+	ytdl._open_url = open_url
+	# Client 3 gives no player id, so use client which needs signature and nsig decoding
+	ytdl._try_clients = lambda video_id, yt_auth, lang: ytdl._extract_player_response(video_id, None, 7, lang)
+	return ytdl
+
+
+def instrument(ytdl, stats):
+	for stage, method in (
+			('player_response', '_extract_player_response'),
+			('load_player', '_load_player'),
+			('signature', '_decrypt_signature_url'),
+			('nsig', '_unthrottle_url'),
+			('format_sort', '_sort_formats')):
+		setattr(ytdl, method, timed(stats, stage, getattr(ytdl, method)))
+
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2] if values else None
+
+
+def run(player_js, response, iterations):
+	cold = []
+	warm = []
+	error = None
+	for _ in range(iterations):
+		# New cache directory, so cold run also analyzes the player
+		cache_dir = tempfile.mkdtemp()
+		try:
+			ytdl = create_extractor(player_js, response, cache_dir)
+			stats = {}
+			instrument(ytdl, stats)
+			# Warm run uses the same extractor, so player and decoded functions are cached
+			for results in (cold, warm):
+				stats.clear()
+				start = timer()
+				try:
+					ytdl._real_extract(VIDEO_ID, None)
+				except Exception as ex:
+					error = str(ex)
+				stats['total'] = timer() - start
+				results.append(dict(stats))
+		finally:
+			shutil.rmtree(cache_dir, ignore_errors=True)
+
+	# Memory is measured in separate run, because tracing slows down the extraction
+	peak_memory = None
+	if tracemalloc:
+		cache_dir = tempfile.mkdtemp()
+		try:
+			ytdl = create_extractor(player_js, response, cache_dir)
+			tracemalloc.start()
+			try:
+				ytdl._real_extract(VIDEO_ID, None)
+			except Exception:
+				pass
+			peak_memory = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+		finally:
+			shutil.rmtree(cache_dir, ignore_errors=True)
+
+	stages = sorted(set(stage for stats in cold + warm for stage in stats))
+	return {
+		'cold': {stage: median([stats.get(stage, 0) for stats in cold]) for stage in stages},
+		'warm': {stage: median([stats.get(stage, 0) for stats in warm]) for stage in stages},
+		'peak_memory': peak_memory,
+		'error': error
+	}
+
+
+def synthetic_nsig(functions):
+	""" Return nsig function code with many inline functions, like in the real players """
+	return 'var Nf=function(a){var b=a.split(""),c=[%s];try{%s}catch(d){return"enhanced_except_"+a}return b.join("")};' % (
+		','.join('function(d,e){e=(e%%d.length+d.length)%%d.length;var f=d[0];d[0]=d[e];d[e]=f+%d}' % i for i in range(functions)),
+		','.join('c[%d](b,%d)' % (i, i) for i in range(functions)))
+
+
+def time_nsig(player_js, name, iterations):
+	""" Return median seconds to prepare the nsig function for the interpreter """
+	times = []
+	for _ in range(iterations):
+		jsi = JSInterpreter(player_js)
+		code = jsi.extract_function_code(name)
+		start = timer()
+		jsi.extract_function_from_code(*code)
+		times.append(timer() - start)
+	return median(times)
+
+
+def scaling(players, iterations):
+	cases = [('synthetic %d' % functions, synthetic_nsig(functions), 'Nf') for functions in SCALING_FUNCTIONS]
+	for player_name, player_js in sorted(players.items()):
+		if player_name == 'synthetic':
+			continue
+		try:
+			cases.append((player_name, player_js, YouTubeVideoUrl()._extract_n_function_name(player_js)))
+		except Exception as ex:
+			print('Cannot find nsig function in', player_name, ex)
+	results = []
+	for player_name, player_js, name in cases:
+		size = len(JSInterpreter(player_js).extract_function_code(name)[1])
+		seconds = time_nsig(player_js, name, iterations)
+		results.append({'player': player_name, 'size': size, 'seconds': seconds, 'seconds_per_kb': seconds * 1024 / size})
+	return results
+
+
+def profile_nsig(players, prefix):
+	""" Write collapsed stacks of interpreter time for the nsig function of every player """
+	for player_name, player_js in sorted(players.items()):
+		jsi = JSInterpreter(player_js)
+		jsi.profiler = JSProfiler()
+		try:
+			name = YouTubeVideoUrl()._extract_n_function_name(player_js)
+			jsi.extract_function_from_code(*jsi.extract_function_code(name))(['ABCDEFGHIJKLMNOPQRSTUVWXYZabcdef0123456789'])
+		except Exception as ex:
+			print('Cannot profile nsig function of', player_name, ex)
+			continue
+		jsi.profiler.write('%s-%s.folded' % (prefix, player_name))
+
+
+def statements(players):
+	""" Return how many statements the decode functions of every player execute, with and without optimization """
+	results = []
+	for player_name, player_js in sorted(players.items()):
+		profile = YouTubeVideoUrl()._analyze_player(player_js)
+		global_vars = player_globals(profile)
+		for key, test in PLAYER_TESTS:
+			if not profile[key]:
+				continue
+			counts = []
+			for constants in (global_vars, None):
+				jsi = JSCompiler(profile['code'], symbols=profile['symbols'], constants=constants)
+				jsi.executed = 0
+				try:
+					jsi.extract_function_from_code(
+						*fixup_n_function_code(*jsi.extract_function_code(profile[key])) + (global_vars, ))([test])
+				except Exception as ex:
+					print('Cannot count statements of', player_name, key, ex)
+					break
+				counts.append(jsi.executed)
+			else:
+				results.append({'player': player_name, 'function': key, 'optimized': counts[0], 'plain': counts[1]})
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Offline video url extraction benchmark')
+	parser.add_argument('-n', '--iterations', type=int, default=5)
+	parser.add_argument('-f', '--fixtures', help='directory with recorded *.json responses and *.js players')
+	parser.add_argument('-o', '--output', help='write JSON to file instead of stdout')
+	parser.add_argument('-p', '--profile', metavar='PREFIX', help='write profiles of interpreted nsig functions')
+	parser.add_argument('-s', '--scaling', action='store_true', help='measure nsig function preparation by size')
+	parser.add_argument('-c', '--statements', action='store_true', help='count statements of compiled decode functions')
+	parser.add_argument('-v', '--verbose', action='store_true', help='show extraction log on stderr')
+	args = parser.parse_args()
+
+	stdout = sys.stdout
+	sys.stdout = sys.stderr if args.verbose else open(os.devnull, 'w')
+
+	players, responses = load_fixtures(args.fixtures)
+	results = {
+		'python': '.'.join(str(v) for v in sys.version_info[:3]),
+		'iterations': args.iterations,
+		'runs': []
+	}
+	for player_name, player_js in sorted(players.items()):
+		for response_name, response in sorted(responses.items()):
+			result = run(player_js, response, args.iterations)
+			result.update({'player': player_name, 'response': response_name})
+			results['runs'].append(result)
+	if args.scaling:
+		results['scaling'] = scaling(players, args.iterations)
+	if args.statements:
+		results['statements'] = statements(players)
+	if args.profile:
+		profile_nsig(players, args.profile)
+
+	sys.stdout = stdout
+	output = json.dumps(results, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(output)
+	else:
+		print(output)
+
+
+if __name__ == '__main__':
+	main()
@@ -5,15 +5,46 @@ import os
 import pytest
 import sys
 
+from time import time
+
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from src.cache import Cache  # noqa: E402
 from src.compat import compat_urlopen  # noqa: E402
+from src.jscompile import JSCompileError  # noqa: E402
+from src.jscompile import JSCompiler  # noqa: E402
+from src.jstranspile import JSTranspiler  # noqa: E402
+from src.jsinterp import JSBudgetExceeded  # noqa: E402
 from src.jsinterp import JSInterpreter  # noqa: E402
+from src.jsinterp import JSProfiler  # noqa: E402
 from src.jsinterp import JSUndefined  # noqa: E402
+from src.jsworker import JSDecodeError  # noqa: E402
+from src.jsworker import JSWorker  # noqa: E402
+from src.jsworker import PlayerDecoder  # noqa: E402
 from src.YouTubeApi import YouTubeApi  # noqa: E402
 from src.YouTubeVideoUrl import YouTubeVideoUrl  # noqa: E402
 
 
+@pytest.fixture
+def ytdl(tmpdir):
+	""" Extractor which starts with empty cache in tmpdir """
+	return YouTubeVideoUrl(Cache(str(tmpdir)))
+
+
+def stub_clients(ytdl, response):
+	""" Answer client requests of ytdl with response(video_id, client) without network,
+	return the list of requested clients """
+	clients = []
+
+	def player_response(video_id, yt_auth, client, lang, visitor_data=None):
+		clients.append(client)
+		return response(video_id, client), client
+
+	ytdl._extract_player_response = player_response
+	ytdl._scan_watch_page = lambda video_id: {}
+	return clients
+
+
 def get_video_id(q, event_type, order, s_type):
 	youtube = YouTubeApi('')
 
@@ -182,6 +213,13 @@ function_list = (
 	('function f(){return 0 ?? 42;}', (), 'bit operator', 0),
 	('function f() { if (0!=0) {return 1} else if (1==0) {return 2} else {return 10} }', (), 'else if', 10),
 	('function f() { var x = /* 1 + */ 2; var y = /* 30 * 40 */ 50; return x + y; }', (), 'comments', 52),
+	('function f(){return 1 + 2 * 3 - 4 / 2;}', (), 'precedence', 5),
+	('function f(){return 2 ** 3 ** 2}', (), 'precedence', 512),
+	('function f(a){return 7 - 2 - 1 + "x" + a + 2}', [1], 'precedence', '4x12'),
+	('function f(a){return a || 3 && 0 ? "y" : "n"}', [0], 'precedence', 'n'),
+	('function f(a){return a > 1 ? a < 3 ? "mid" : "big" : "small"}', [2], 'ternary', 'mid'),
+	('function f(a){var b=[];a && b.push(1);a || b.push(2);return b.length}', [0], 'short circuit', 1),
+	('function f(a){return -a + !a + typeof a}', [2], 'unary', '-2number'),
 )
 
 function_repr_list = [(x, function_list[x][2]) for x in range(len(function_list))]
@@ -193,6 +231,272 @@ def test_jsinterpreter(line, descr):
 	check_jsinterpreter(code=val[0], args=val[1], expected=val[3])
 
 
+def test_jsinterpreter_separate():
+	JSInterpreter('')
+	expr = 'a, "b,c" /* d, */, (e, [f, g])/2, /[,]/g, {h: 1, i: 2}'
+	assert list(JSInterpreter._separate(expr)) == ['a', ' "b,c" ', ' (e, [f, g])/2', ' /[,]/g', ' {h: 1, i: 2}']
+	assert list(JSInterpreter._separate(expr, ',', 2))[2] == ' (e, [f, g])/2, /[,]/g, {h: 1, i: 2}'
+	assert JSInterpreter._scan(expr) is JSInterpreter._scan(expr)
+	assert JSInterpreter._separate_at_paren('(a, (b)) + c') == ('a, (b)', '+ c')
+	assert JSInterpreter._separate_at_paren('"a;b"; c', ';') == ('a;b"', 'c')
+	assert list(JSInterpreter._separate('a / b, c')) == ['a / b', ' c']
+	with pytest.raises(RuntimeError):
+		JSInterpreter._separate_at_paren('(a, b')
+
+
+def test_jsinterpreter_symbols():
+	jsi = JSInterpreter('var a=1,Wq={aB:function(a,b){a.splice(0,b)},"cD":function(a){a.reverse()}};x.Wq={d:function(){}};'
+		'function f(a){return a};g=function(b,c){var Wq={};return {k:1}},h=[1,2];var f=function(){};')
+	symbols = jsi.symbol_index()
+	assert sorted(symbols['functions']) == ['f', 'g'] and sorted(symbols['variables']) == ['Wq', 'a', 'h']
+	assert len(symbols['objects']['Wq']) == 1
+	assert jsi.extract_function_code('f') == (['a'], 'return a')
+	assert jsi.extract_function_code('g') == (['b', 'c'], 'var Wq={};return {k:1}')
+	assert jsi.extract_variable_code('h') == '[1,2]'
+	assert sorted(jsi.extract_object('Wq')) == ['aB', 'cD']
+	# Index is reused, also when it is given to new interpreter
+	assert JSInterpreter(jsi.code, symbols=symbols).extract_function_code('f') == (['a'], 'return a')
+	with pytest.raises(RuntimeError):
+		jsi.extract_function_code('h')
+
+
+@pytest.mark.parametrize('line,descr', function_repr_list)
+def test_jscompiler(line, descr):
+	val = function_list[line]
+	jsi = JSCompiler(val[0])
+	func = jsi.extract_function_from_code(*jsi.extract_function_code('f'))
+	# Undefined variable of the length case fails in compiled code like in JavaScript, the interpreter runs it then
+	assert func(val[1]) == val[3]
+
+
+compiler_nsig = r'''function Nf(a){var b=a.split(""),c=[function(d,e){e=(e%d.length+d.length)%d.length;d.splice(e,1)},
+-1577405148,function(d){d.reverse()},function(d,e){d.push(e)},
+function(d,e){e=(e%d.length+d.length)%d.length;var f=d[0];d[0]=d[e];d[e]=f},
+"Qm4Zx9pLw2Rt7Yu1Io0PaSdF",b,null,
+function(d,e){for(e=(e%d.length+d.length)%d.length;e--;)d.unshift(d.pop())},
+function(d,e){var h="0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-_".split(""),f=h.length;d.forEach(function(l,m,n){this.push(n[m]=h[(h.indexOf(l)-h.indexOf(this[m])+m+f--)%h.length])},e.split(""))},
+function(d,e){d.splice(d.length,0,e)},1234,-77,913,"x7Kq",
+function(d,e){e=(e%d.length+d.length)%d.length;d.splice(0,1,d.splice(e,1,d[0])[0])},
+function(d,e){switch(e%3){case 0:d.reverse();break;case 1:d.push(d.shift());default:d.unshift(d.pop())}}
+];c[7]=c;
+try{c[2](c[6]),c[0](c[6],c[1]),c[8](c[6],c[11]),c[4](c[6],c[12]),c[9](c[6],c[5]),c[15](c[6],c[13]),c[2](c[6]),c[8](c[6],c[12]),
+c[0](c[6],c[11]),c[9](c[6],c[14]),c[4](c[6],c[1]),c[15](c[6],c[11]),c[16](c[6],c[12]),c[16](c[6],c[11]),c[8](c[6],c[13])}
+catch(d){return"enhanced_except_"+a}return b.join("")};'''
+
+
+def test_jscompiler_nsig(monkeypatch):
+	results = []
+	for cls in (JSInterpreter, JSCompiler):
+		jsi = cls(compiler_nsig)
+		results.append(jsi.extract_function_from_code(*jsi.extract_function_code('Nf'))(['ABCDEFGHabcdefgh0123']))
+	assert results[0] == results[1] == 'MYeKMCDTPOlTumotXF'
+	# Body is parsed once for all compiler instances
+	assert JSCompiler.parse(JSCompiler(compiler_nsig).extract_function_code('Nf')[1]) is \
+		JSCompiler.parse(JSCompiler(compiler_nsig).extract_function_code('Nf')[1])
+	# Unsupported code is run by the interpreter
+	with pytest.raises(JSCompileError):
+		JSCompiler.parse('for (x in y) {}')
+
+	def parse(code):
+		raise JSCompileError('Not supported')
+
+	monkeypatch.setattr(JSCompiler, 'parse', staticmethod(parse))
+	jsi = JSCompiler(compiler_nsig)
+	assert jsi.extract_function_from_code(*jsi.extract_function_code('Nf'))(['ABCDEFGHabcdefgh0123']) == results[0]
+
+
+def test_jscompiler_scopes():
+	# Every call has own frame of local variables, catch parameter shadows the variable only in catch block
+	jsi = JSCompiler('function f(n){var e=5,c=counter();function fact(k){var m=k;if(k<2)return 1;return fact(k-1)*m}'
+		'function counter(){var i=0;return function(){return ++i}}c();'
+		'try{throw 1}catch(e){e=2}total=fact(n)+e+c();return total}')
+	func = jsi.extract_function_from_code(*jsi.extract_function_code('f'))
+	assert func([5]) == 127
+	assert func([3]) == 13
+	# Undeclared names are global
+	assert jsi._compile_body(['n'], jsi.extract_function_code('f')[1])[0].resolve('total') is None
+
+
+@pytest.mark.parametrize('code,arg', (
+	('return a.slice(-2)', 'abcdef'),
+	('var b=-2;return a.slice(b)', 'abcdef'),
+	('return -2147483648>>1', 0),
+	('return -1>>28', 0),
+	('return -a<<3', 5),
+	('return -a', '7'),
+	('return a.split("").splice(-3,2).join("")', 'abcdef'),
+))
+def test_jscompiler_interpreter_parity(code, arg):
+	results = []
+	for cls in (JSInterpreter, JSCompiler):
+		jsi = cls('function f(a){%s}' % code)
+		results.append(jsi.extract_function_from_code(*jsi.extract_function_code('f'))([arg]))
+	assert results[0] == results[1] and type(results[0]) is type(results[1])
+
+
+def test_jscompiler_fallback(monkeypatch):
+	calls = []
+
+	def function(scope, body, namespace, parent=None):
+		def failing(args, kwargs=None, allow_recursion=100):
+			calls.append(args[0])
+			if args[0] == 'loop':
+				raise JSBudgetExceeded('Evaluation exceeded 1 steps')
+			raise TypeError('Compiled code failed')
+		return failing
+
+	monkeypatch.setattr(JSCompiler, '_function', staticmethod(function))
+	jsi = JSCompiler('function f(a){return a.slice(-2)}')
+	# Exceeded budget is not run again by the interpreter
+	with pytest.raises(JSBudgetExceeded):
+		jsi.extract_function_from_code(*jsi.extract_function_code('f'))(['loop'])
+	# Compiled function which fails at runtime is replaced by the interpreter
+	func = jsi.extract_function_from_code(*jsi.extract_function_code('f'))
+	assert func(['abcdef']) == 'ef'
+	assert func(['ghij']) == 'ij'
+	assert calls == ['loop', 'abcdef']
+
+
+def test_jscompiler_optimize():
+	# Global array is inlined and the guard for the missing global is dropped
+	code = compiler_nsig.replace('{var b=a.split("")', '{if(typeof G==="undefined")return a;var b=a[G[0]](G[1])').replace(
+		'.length', '[G[2]]')
+	constants = {'G': ['split', '', 'length']}
+	counts = []
+	for optimized in (None, constants):
+		jsi = JSCompiler(code, constants=optimized)
+		jsi.executed = 0
+		func = jsi.extract_function_from_code(*jsi.extract_function_code('Nf') + (constants, ))
+		assert func(['ABCDEFGHabcdefgh0123']) == 'MYeKMCDTPOlTumotXF'
+		counts.append(jsi.executed)
+	assert counts[1] < counts[0]
+	argnames, body = jsi.extract_function_code('Nf')
+	body = jsi.optimize(argnames, jsi.parse(body))
+	assert body[0][0] == 'var' and "('name', 'G')" not in repr(body)
+	jst = JSTranspiler(code, constants=constants)
+	assert jst.load(jst.transpile(argnames, jsi.extract_function_code('Nf')[1]), constants)(['ABCDEFGHabcdefgh0123']) == \
+		'MYeKMCDTPOlTumotXF'
+	# Global which the function changes is read at run time, constant expressions are folded
+	jsi = JSCompiler('function f(){G[0]=typeof G;return G[0]+(1+2);return 5}', constants={'G': ['x']})
+	body = jsi.optimize([], jsi.parse(jsi.extract_function_code('f')[1]))
+	assert body[1] == ('return', ('binary', '+', ('member', ('name', 'G'), ('const', 0), False), ('const', 3.0)))
+	assert len(body) == 2
+	assert jsi.extract_function_from_code(*jsi.extract_function_code('f') + ({'G': ['x']}, ))([]) == 'object3'
+
+
+@pytest.mark.parametrize('line,descr', function_repr_list)
+def test_jstranspiler(line, descr):
+	val = function_list[line]
+	jsi = JSTranspiler(val[0])
+	func = jsi.load(jsi.transpile(*jsi.extract_function_code('f')))
+	if descr == 'length':
+		with pytest.raises(RuntimeError):
+			func(val[1])
+	else:
+		assert func(val[1]) == val[3]
+
+
+def test_jstranspiler_nsig():
+	jsi = JSTranspiler(compiler_nsig)
+	source = jsi.transpile(*jsi.extract_function_code('Nf'))
+	assert jsi.load(source)(['ABCDEFGHabcdefgh0123']) == 'MYeKMCDTPOlTumotXF'
+	# Source is compiled once for all instances
+	assert JSTranspiler._code_cache[source] is JSTranspiler('')._code_cache[source]
+	code = (
+		'function f(a){var r=[],x=1;function g(){return x++}'
+		'for(var i=0;i<6;i++){switch(i){case 1:continue;case 2:r.push("two");break;default:r.push(g())}r.push("e")}'
+		'do{i--}while(i>3);return r.join(",")+i}')
+	jsi = JSTranspiler(code)
+	assert jsi.load(jsi.transpile(*jsi.extract_function_code('f')))([]) == '1,e,two,e,2,e,3,e,4,e3'
+
+
+def test_jsinterpreter_budget(tmpdir):
+	# Endless loop is stopped with an error which JavaScript catch does not stop
+	code = 'function f(a){try{while(a>=0){a++}}catch(e){return "caught"}return a}'
+	for cls in (JSInterpreter, JSCompiler, JSTranspiler):
+		jsi = cls(code)
+		jsi.step_budget = 1000
+		if cls is JSTranspiler:
+			func = jsi.load(jsi.transpile(*jsi.extract_function_code('f')))
+		else:
+			func = jsi.extract_function_from_code(*jsi.extract_function_code('f'))
+		with pytest.raises(JSBudgetExceeded, match='1000 steps'):
+			func([0])
+		assert func([-1]) == -1
+	jsi = JSCompiler(code)
+	jsi.step_budget, jsi.time_budget = None, 0.1
+	start = time()
+	with pytest.raises(JSBudgetExceeded, match='seconds'):
+		jsi.extract_function_from_code(*jsi.extract_function_code('f'))([0])
+	assert time() - start < 5
+	# Profile has stacks of the constructs the statements and regular expressions are used in
+	jsi = JSInterpreter(compiler_nsig)
+	jsi.profiler = JSProfiler()
+	assert jsi.extract_function_from_code(*jsi.extract_function_code('Nf'))(['ABCDEFGHabcdefgh0123']) == 'MYeKMCDTPOlTumotXF'
+	filename = str(tmpdir.join('nsig.folded'))
+	for metric in JSProfiler.METRICS:
+		jsi.profiler.write(filename, metric)
+		with open(filename) as f:
+			stacks = dict(line.rsplit(' ', 1) for line in f.read().splitlines())
+		assert stacks and all(stack.startswith('js') and int(value) > 0 for stack, value in stacks.items())
+	assert 'js;try;c.16();switch' in stacks
+
+
+def test_js_worker():
+	jst = JSTranspiler(compiler_nsig)
+	profile = {'code': compiler_nsig, 'symbols': JSInterpreter.build_symbol_index(compiler_nsig), 'globals': [],
+		'sig': None, 'nsig': 'Nf', 'python': {'nsig': jst.transpile(*jst.extract_function_code('Nf'))}}
+	worker = JSWorker()
+	try:
+		for transpile in (False, True):
+			assert worker.decode('p', profile, 'nsig', 'ABCDEFGHabcdefgh0123', transpile) == 'MYeKMCDTPOlTumotXF'
+		with pytest.raises(JSDecodeError, match='Decode function not found'):
+			worker.decode('p', profile, 'sig', 'ABCDEFGHabcdefgh0123')
+		# Failed decode function is not a helper failure and is not decoded again in this process
+		ytdl = YouTubeVideoUrl()
+		ytdl._worker = worker
+		ytdl._decoder_function = lambda player_id, profile, key, s_id: pytest.fail('Decoded in this process')
+		with pytest.raises(JSDecodeError):
+			ytdl._worker_function('p', profile, 'sig', 'sig_p_20')('ABCDEFGHabcdefgh0123')
+		assert worker._failures == 0 and worker.available
+		# Crashed helper process is started again and gets the profile again
+		process = worker._process
+		process.kill()
+		process.wait()
+		assert worker.decode('p', profile, 'nsig', 'ABCDEFGHabcdefgh0123') == 'MYeKMCDTPOlTumotXF'
+		assert worker._process is not process
+		# Helper process which does not answer in time is stopped
+		hung = dict(profile, code='function Nf(a){for(;;){}}', python={})
+		hung['symbols'] = JSInterpreter.build_symbol_index(hung['code'])
+		worker.timeout = 0.1
+		with pytest.raises(RuntimeError, match='did not answer'):
+			worker.decode('hung', hung, 'nsig', 'ABCDEFGHabcdefgh0123')
+		assert worker._process is None
+		worker.timeout = 10
+		assert worker.decode('p', profile, 'nsig', 'ABCDEFGHabcdefgh0123') == 'MYeKMCDTPOlTumotXF'
+	finally:
+		worker.close()
+
+
+def test_js_worker_failures(monkeypatch):
+	from src.jsworker import WORKER_FAILURES
+	profile = {'code': compiler_nsig, 'symbols': JSInterpreter.build_symbol_index(compiler_nsig), 'globals': [],
+		'sig': None, 'nsig': 'Nf', 'python': {}}
+	# Helper process which cannot import the plugin modules ends at once
+	monkeypatch.setattr('src.jsworker._BOOTSTRAP', 'import sys; sys.exit(1)')
+	ytdl = YouTubeVideoUrl()
+	decode = ytdl._worker_function('p', profile, 'nsig', 'nsig_p_20')
+	try:
+		# Every decode is done in this process and the helper is not used after some failures
+		for _ in range(WORKER_FAILURES):
+			assert ytdl._worker.available
+			assert decode('ABCDEFGHabcdefgh0123') == 'MYeKMCDTPOlTumotXF'
+		assert not ytdl._worker.available
+	finally:
+		ytdl.close()
+	assert ytdl._worker._process is None
+
+
 nsig_list = (
 	('7862ca1f', 'X_LCxVDjAavgE5t', 'yxJ1dM6iz5ogUg'),
 	('2f1832d2', 'YWt1qdbe8SAfkoPHW5d', 'RrRjWQOJmBiP'),
@@ -236,3 +540,376 @@ def test_function_exceptions():
 	ytdl._unthrottle_url('&n=a&', player_id)
 	ytdl._guess_encoding_from_content('', br'<meta charset=ascii>')
 	ytdl._guess_encoding_from_content('', b'\xff\xfe')
+
+
+def test_nsig_cache():
+	from src.YouTubeVideoUrl import NSIG_CACHE_SIZE
+	ytdl = YouTubeVideoUrl()
+	decoded = []
+
+	def extract_function(player_id, s_id):
+		def decode(n):
+			decoded.append(n)
+			return n[::-1] + player_id
+		return decode
+
+	ytdl._extract_function = extract_function
+	for n in list(range(NSIG_CACHE_SIZE + 1)) + [NSIG_CACHE_SIZE]:
+		n_param = 'n%03d' % n
+		assert ytdl._unthrottle_url('&n=%s&' % n_param, 'abcd1234') == '&n=%sabcd1234&' % n_param[::-1]
+	# Values are decoded again for another player
+	assert ytdl._unthrottle_url('&n=n000&', 'ef567890') == '&n=000nef567890&'
+	# Cache is limited and the oldest values are dropped first
+	assert len(ytdl._nsig_cache) == NSIG_CACHE_SIZE
+	assert ('abcd1234', 'n000') not in ytdl._nsig_cache
+	assert len(decoded) == NSIG_CACHE_SIZE + 2
+
+
+def test_url_cache(ytdl):
+	url = 'https://rr1.googlevideo.com/videoplayback?expire=%s&id=1' % int(time() + 7200)
+	ytdl._store_url('YQHsXMglC9A', '22_True_en', url)
+	assert ytdl._load_url('YQHsXMglC9A', '22_True_en') == url
+	assert ytdl._load_url('YQHsXMglC9A', '37_True_en') is None
+	ytdl._store_url('a9LDPn-MO4I', '22_True_en', url.replace(url[49:59], str(int(time() + 600))))
+	assert ytdl._load_url('a9LDPn-MO4I', '22_True_en') is None
+	ytdl.clear_url_cache('YQHsXMglC9A')
+	assert ytdl._load_url('YQHsXMglC9A', '22_True_en') is None
+
+
+def test_race_clients(ytdl):
+	stub_clients(ytdl, lambda video_id, client: {
+		'playabilityStatus': {'status': 'OK' if client == 56 else 'LOGIN_REQUIRED'},
+		'videoDetails': {'videoId': video_id},
+		'streamingData': {'formats': [{'itag': 18}]}
+	})
+	assert ytdl._race_clients('YQHsXMglC9A', None, 'en')[1] == 56
+	# Response for another video is not kept as fallback
+	stub_clients(ytdl, lambda video_id, client: {
+		'playabilityStatus': {'status': 'OK' if client == 3 else 'LOGIN_REQUIRED'},
+		'videoDetails': {'videoId': 'placeholder' if client == 3 else video_id},
+		'streamingData': {'formats': [{'itag': 18}]}
+	})
+	assert ytdl._race_clients('YQHsXMglC9A', None, 'en')[1] != 3
+
+
+def test_client_scores(ytdl):
+	ytdl._scores = {'count': 1}
+	clients = stub_clients(ytdl, lambda video_id, client: {
+		'playabilityStatus': {'status': 'OK'},
+		'videoDetails': {'videoId': video_id if client == 7 else 'wrong'},
+		'streamingData': {'formats': [{'itag': 18}]}
+	})
+	assert ytdl._try_clients('YQHsXMglC9A', None, 'en')[1] == 7
+	assert clients == [3, 7]
+	assert ytdl._try_clients('YQHsXMglC9A', None, 'en')[1] == 7
+	assert clients == [3, 7, 7]
+	assert ytdl.cache.load('clients', 'scores')['normal']['7']['tries'] == 2
+	assert 'normal client 3: success 0.00' in ytdl.client_scores()
+
+
+def test_wrong_video_response(ytdl):
+	ytdl._scores = {'count': 1}
+	url = 'https://rr1.googlevideo.com/videoplayback?expire=%s&itag=18' % int(time() + 7200)
+
+	def response(video_id, client):
+		if client != 3:
+			raise RuntimeError('Request failed')
+		return {
+			'playabilityStatus': {'status': 'OK'},
+			'videoDetails': {'videoId': 'placeholder'},
+			'streamingData': {'formats': [{'itag': 18, 'url': url, 'mimeType': 'video/mp4'}]}
+		}
+
+	clients = stub_clients(ytdl, response)
+	# Placeholder video must not be played and cached instead of the requested one
+	with pytest.raises(RuntimeError) as e:
+		ytdl.extract('YQHsXMglC9A')
+	assert str(e.value) == 'Player response not found!'
+	assert clients[0] == 3 and len(clients) > 1
+	assert ytdl.cache.load('urls', 'YQHsXMglC9A') is None
+
+
+def test_visitor_data(ytdl):
+	pages = []
+
+	def scan_watch_page(video_id):
+		pages.append(video_id)
+		return {'ytcfg': '{"INNERTUBE_CONTEXT": {"client": {"visitorData": "Cgt2aXNpdG9y"}}}'}
+
+	ytdl._scan_watch_page = scan_watch_page
+	get_webpage = ytdl._webpage_getter('YQHsXMglC9A')
+	assert ytdl._get_visitor_data(get_webpage) == 'Cgt2aXNpdG9y'
+	assert ytdl._get_visitor_data(ytdl._webpage_getter('a9LDPn-MO4I')) == 'Cgt2aXNpdG9y'
+	assert len(pages) == 1
+	assert ytdl.cache.load('clients', 'visitor')['data'] == 'Cgt2aXNpdG9y'
+
+
+def test_scan_watch_page():
+	from io import BytesIO
+	ytdl = YouTubeVideoUrl()
+	player_response = b'{"videoDetails": {"videoId": "YQHsXMglC9A", "title": "{\\"}"}, "x": [{}]}'
+	page = BytesIO(b''.join((
+		b'<script>ytcfg.set({"CSI": "}"});ytInitialPlayerResponse = ', player_response,
+		b';var meta', b' ' * 20000,
+		b'ytcfg.set({"INNERTUBE_CONTEXT": {"client": {"visitorData": "Cgt2aXNpdG9y"}}});',
+		b'</script>', b' ' * 100000)))
+	ytdl._open_url = lambda url: page
+	page.close = lambda: None
+	webpage = ytdl._scan_watch_page('YQHsXMglC9A')
+	assert webpage['player_response'] == player_response
+	assert ytdl._extract_visitor_id(webpage) == 'Cgt2aXNpdG9y'
+	assert page.tell() < len(page.getvalue())
+
+
+def test_download_webpage_bytes():
+	from io import BytesIO
+	ytdl = YouTubeVideoUrl()
+	body = u'{"title": "\u00dcn\u00efcode"}'.encode('utf-8')
+
+	def open_url(url, data=None, headers={}):
+		urlh = BytesIO(body)
+		urlh.headers = {'Content-Type': 'application/json; charset=UTF-8'}
+		return urlh
+
+	ytdl._open_url = open_url
+	assert ytdl._download_webpage('https://www.youtube.com/youtubei/v1/player', decode=False) is body
+	assert ytdl._download_webpage('https://www.youtube.com/youtubei/v1/player') == body.decode('utf-8')
+
+
+def test_format_policy():
+	from src.YouTubeVideoUrl import FormatPolicy
+	ytdl = YouTubeVideoUrl()
+	formats = [
+		{'itag': 18, 'mimeType': 'video/mp4; codecs="avc1.42001E, mp4a.40.2"', 'width': 640, 'height': 360},
+		{'itag': 137, 'mimeType': 'video/mp4; codecs="avc1.640028"', 'width': 1920, 'height': 1080},
+		{'itag': 136, 'mimeType': 'video/mp4; codecs="avc1.4d401f"', 'width': 1280, 'height': 720, 'fps': 30},
+		{'itag': 298, 'mimeType': 'video/mp4; codecs="avc1.4d4020"', 'width': 1280, 'height': 720, 'fps': 60},
+		{'itag': 999, 'mimeType': 'video/mp4; codecs="avc1.4d401f"', 'width': 720, 'height': 1280},
+		{'itag': 140, 'mimeType': 'audio/mp4; codecs="mp4a.40.2"'},
+		{'itag': 336, 'mimeType': 'video/webm; codecs="vp09.02.51.10"', 'height': 720, 'qualityLabel': '720p HDR'}
+	]
+	itags = [fmt['itag'] for fmt in ytdl._sort_formats(formats)]
+	assert itags == [136, 298, 999, 18]
+	ytdl.format_policy = FormatPolicy(max_fps=30)
+	assert [fmt['itag'] for fmt in ytdl._sort_formats(formats)] == [136, 999, 18]
+	ytdl.format_policy = FormatPolicy(codecs=('avc1.42',))
+	assert [fmt['itag'] for fmt in ytdl._sort_formats(formats)] == [18]
+	assert [fmt['itag'] for fmt in ytdl._sort_formats(formats, '')] == [140]
+	assert 'preference' not in formats[0]
+
+
+def test_throughput(tmpdir, monkeypatch):
+	from src.throughput import Throughput
+	estimator = Throughput()
+	estimator.cache.root = str(tmpdir)
+	estimator._estimate = {}
+	assert estimator.max_bitrate() is None and estimator.stale()
+	estimator.add_sample(1000, 1)  # Too small to measure throughput
+	assert estimator.max_bitrate() is None
+	estimator.add_sample(1250000, 1)
+	assert estimator.max_bitrate() == 7000000
+	estimator.buffering()
+	assert estimator.max_bitrate() == 4900000
+	assert not estimator.stale()
+
+	monkeypatch.setattr('src.YouTubeVideoUrl.throughput', estimator)
+	formats = [{'itag': 137, 'bitrate': 6000000}, {'itag': 136, 'bitrate': 3000000}, {'itag': 135, 'bitrate': 1500000}]
+	assert [fmt['itag'] for fmt in YouTubeVideoUrl()._fit_throughput(formats, None)] == [136, 135, 137]
+	# Transfers at the same time give one sample of their total size
+	monkeypatch.setattr('src.throughput.time', lambda: 100)
+	estimator._estimate = {}
+	estimator.start_transfer()
+	estimator.start_transfer()
+	monkeypatch.setattr('src.throughput.time', lambda: 101)
+	estimator.end_transfer(625000)
+	assert estimator.max_bitrate() is None
+	estimator.end_transfer(625000)
+	assert estimator.max_bitrate() == 7000000
+
+
+def test_m3u8():
+	ytdl = YouTubeVideoUrl()
+	manifest = '\n'.join((
+		'#EXTM3U',
+		'#EXT-X-STREAM-INF:BANDWIDTH=1500000,CODECS="avc1.4d401f,mp4a.40.2",RESOLUTION=854x480,FRAME-RATE=30,AUDIO="a"',
+		'https://manifest.googlevideo.com/api/manifest/hls_playlist/expire/%s/itag/94/file/index.m3u8',
+		'#EXT-X-STREAM-INF:BANDWIDTH=4500000,CODECS="avc1.4d401f,mp4a.40.2",RESOLUTION=1280x720,FRAME-RATE=30',
+		'https://manifest.googlevideo.com/api/manifest/hls_playlist/expire/%s/itag/95/file/index.m3u8',
+		'#EXT-X-STREAM-INF:BANDWIDTH=9000000,CODECS="avc1.64002a,mp4a.40.2",RESOLUTION=1920x1080,FRAME-RATE=60',
+		'https://manifest.googlevideo.com/api/manifest/hls_playlist/expire/%s/itag/301/file/index.m3u8',
+		'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="a",NAME="en",URI="https://manifest.googlevideo.com/audio.m3u8"'
+	))
+	manifests = []
+
+	def download_webpage(url):
+		manifests.append(url)
+		return manifest
+
+	ytdl._download_webpage = download_webpage
+	manifest_url = 'https://manifest.googlevideo.com/api/manifest/hls_variant/expire/%d/ei/%d/id/1'
+	# Every player response has own manifest url of the same video
+	for n in range(2):
+		variants = ytdl._extract_from_m3u8(manifest_url % (time() + 7200, n), 'YQHsXMglC9A', None)
+		assert [fmt['itag'] for fmt in variants] == ['95', '94']
+		assert variants[1]['url'].endswith('index.m3u8&suburi=https://manifest.googlevideo.com/audio.m3u8')
+	assert len(manifests) == 1
+	ytdl._extract_from_m3u8(manifest_url % (time() + 7200, 2), 'YQHsXMglC9A', 'Bearer token')
+	assert len(manifests) == 2
+	# Manifest which expires soon is downloaded again
+	ytdl.clear_url_cache('YQHsXMglC9A')
+	ytdl._extract_from_m3u8(manifest_url % (time(), 3), 'YQHsXMglC9A', None)
+	ytdl._extract_from_m3u8(manifest_url % (time() + 7200, 4), 'YQHsXMglC9A', None)
+	assert len(manifests) == 4
+
+
+def test_extract_many():
+	ytdl = YouTubeVideoUrl()
+
+	def extract(video_id, yt_auth, force=False):
+		if video_id == 'private':
+			raise RuntimeError('Video unavailable')
+		return 'https://rr1.googlevideo.com/videoplayback?id=%s' % video_id
+
+	ytdl._extract = extract
+	results = sorted(ytdl.extract_many(['YQHsXMglC9A', 'private', 'a9LDPn-MO4I', 'YQHsXMglC9A'], concurrency=2))
+	assert results == [
+		('YQHsXMglC9A', 'https://rr1.googlevideo.com/videoplayback?id=YQHsXMglC9A', None),
+		('a9LDPn-MO4I', 'https://rr1.googlevideo.com/videoplayback?id=a9LDPn-MO4I', None),
+		('private', None, 'Video unavailable')
+	]
+
+
+def test_prefetch_stuck(monkeypatch):
+	from threading import Event
+	monkeypatch.setattr('src.YouTubeVideoUrl.PREFETCH_WAIT', 0.1)
+	ytdl = YouTubeVideoUrl()
+	release = Event()
+	ytdl._prefetch_url = lambda video_id, yt_auth, cancel: release.wait(5)
+	ytdl._extract = lambda video_id, yt_auth, force=False: 'https://rr1.googlevideo.com/videoplayback?id=%s' % video_id
+	ytdl.prefetch('YQHsXMglC9A')
+	# Stuck prefetch is cancelled and does not block the play request
+	assert ytdl.extract('YQHsXMglC9A') == 'https://rr1.googlevideo.com/videoplayback?id=YQHsXMglC9A'
+	release.set()
+
+
+def test_trace(ytdl):
+	ytdl._scores = {'count': 1}
+	url = 'https://rr1.googlevideo.com/videoplayback?expire=%s&itag=18' % int(time() + 7200)
+	stub_clients(ytdl, lambda video_id, client: {
+		'playabilityStatus': {'status': 'OK'},
+		'videoDetails': {'videoId': video_id},
+		'streamingData': {'formats': [{'itag': 18, 'url': url, 'mimeType': 'video/mp4'}]}
+	})
+	assert ytdl.extract('YQHsXMglC9A') == url
+	assert ytdl.extract('YQHsXMglC9A') == url
+	assert len(ytdl.traces) == 2
+	assert ytdl.traces[0]['url_cache'] == 'miss'
+	assert ytdl.traces[0]['clients'][0]['client'] == 3
+	assert ytdl.traces[0]['itag'] == '18'
+	assert ytdl.traces[1]['url_cache'] == 'hit'
+	assert ytdl.traces[1]['clients'] == []
+
+
+def test_unplayable_cache(ytdl):
+	from src.YouTubeVideoUrl import UnplayableError
+	ytdl._scores = {'count': 1}
+	requests = stub_clients(ytdl, lambda video_id, client: {
+		'playabilityStatus': {'status': 'ERROR', 'reason': 'Video unavailable'},
+		'videoDetails': {'videoId': video_id}
+	})
+	for cached in (False, True):
+		with pytest.raises(UnplayableError) as e:
+			ytdl.extract('a9LDPn-MO4I')
+		assert str(e.value) == 'Video unavailable' and e.value.cached == cached
+	assert requests == [3]
+	with pytest.raises(UnplayableError) as e:
+		ytdl.extract('a9LDPn-MO4I', force=True)
+	assert not e.value.cached and requests == [3, 3]
+	# Upcoming live stream can start soon, so it is requested every time
+	stub_clients(ytdl, lambda video_id, client: {
+		'playabilityStatus': {'status': 'LIVE_STREAM_OFFLINE', 'reason': 'Premieres in 5 minutes'},
+		'videoDetails': {'videoId': video_id}
+	})
+	with pytest.raises(RuntimeError) as e:
+		ytdl.extract('YQHsXMglC9A')
+	assert not isinstance(e.value, UnplayableError) and ytdl._load_unplayable('YQHsXMglC9A', None) is None
+
+
+def test_player_profile(tmpdir, monkeypatch):
+	player_js = ''.join((
+		'var Gk="-;+".split(";"),Hx={r:function(a){a.reverse()},s:function(a,b){a.splice(0,b)}};',
+		'var zz=function(a){return a};' * 1000,
+		'var sts={signatureTimestamp:20073};',
+		'Xy=function(a){a=a.split("");Hx.s(a,2);Hx.r(a);return a.join("")};',
+		'Nf=function(a){var b=a.split(""),c=b.length;b.reverse();return b.join(Gk[0])+c};',
+		'g.Cz=function(a){var b;a.get("n"))&&(b=Nf(b),a.set("n",b));return a};'))
+	downloads = []
+
+	def download_webpage(url, data=None, headers={}, decode=True):
+		downloads.append(url)
+		return player_js
+
+	for cached in (False, True):
+		ytdl = YouTubeVideoUrl(Cache(str(tmpdir)))
+		ytdl._player_id = ('abcd1234', time())
+		ytdl._download_webpage = download_webpage
+		assert ytdl._extract_signature_timestamp() == ('20073', 'abcd1234')
+		assert ytdl._extract_function('abcd1234', 'sig_abcd1234_6')('abcdef') == 'fedc'
+		assert ytdl._extract_function('abcd1234', 'nsig_abcd1234_3')('abc') == 'c-b-a3'
+		assert len(downloads) == 1
+	profile = ytdl._player_cache['abcd1234']
+	assert profile['sig'] == 'Xy' and profile['nsig'] == 'Nf'
+	assert 'zz' not in profile['code'] and profile['globals'] == [['Gk', '"-;+".split(";")']]
+	assert sorted(profile['symbols']['functions']) == ['Nf', 'Xy'] and list(profile['symbols']['objects']) == ['Hx']
+	# Functions are translated only when the option is used, then they are kept in the memory profile
+	assert 'python' not in profile
+	ytdl._translate_player('abcd1234', profile)
+	assert sorted(profile['python']) == ['nsig', 'sig']
+	# Translated code is executed, it is never stored to or loaded from the cache directory
+	cached = ytdl.cache.load('players', 'abcd1234')
+	assert 'python' not in cached
+	cached['python'] = {'sig': 'raise SystemExit'}
+	ytdl.cache.store('players', 'abcd1234', cached)
+	assert 'python' not in YouTubeVideoUrl(Cache(str(tmpdir)))._load_player('abcd1234')
+	decoder = PlayerDecoder(profile)
+	assert decoder.decode('sig', 'abcdef', True) == 'fedc'
+	assert decoder.decode('nsig', 'abc', True) == 'c-b-a3'
+	assert sorted(decoder.functions) == [('nsig', True), ('sig', True)]
+	# Decode functions are built once per player
+	decoders = ytdl._decoders['abcd1234'].functions
+	assert sorted(decoders) == [('nsig', False), ('sig', False)]
+	func = decoders['nsig', False]
+	ytdl._extract_function('abcd1234', 'nsig_abcd1234_4')('abcd')
+	assert ytdl._decoders['abcd1234'].functions['nsig', False] is func
+	# Profiles are pruned by the age of the cache file, the whole player code is not cached
+	os.utime(ytdl.cache._get_cache_fn('players', 'abcd1234'), (0, 0))
+	ytdl._prune_cache()
+	assert ytdl.cache.load('players', 'abcd1234') is None
+	monkeypatch.setattr('src.YouTubeVideoUrl.PLAYER_PROFILE_MAX_CODE', 100)
+	ytdl = YouTubeVideoUrl(Cache(str(tmpdir)))
+	ytdl._download_webpage = download_webpage
+	ytdl._load_player('abcd1234')
+	assert ytdl.cache.load('players', 'abcd1234') is None
+
+
+def test_player_lock(ytdl):
+	from threading import Event
+	from threading import Thread
+	started = Event()
+	release = Event()
+
+	def download_webpage(url, data=None, headers={}, decode=True):
+		started.set()
+		release.wait(5)
+		return ''
+
+	ytdl._download_webpage = download_webpage
+	profile = ytdl._player_cache['abcd1234'] = {'sig': None, 'nsig': None, 'python': {}}
+	thread = Thread(target=ytdl._load_player, args=('ef567890', ))
+	thread.start()
+	assert started.wait(5)
+	# Download and analysis of a new player do not block players which are already loaded
+	assert ytdl._load_player('abcd1234') is profile and thread.is_alive()
+	release.set()
+	thread.join(5)
+	assert 'ef567890' in ytdl._player_cache